@@ -2,21 +2,23 @@
 # please use Python >=3.9
 
 import itertools
+from dataclasses import dataclass, replace
 import matplotlib.pyplot as plt
 import numpy as np
-import random
 from sklearn.metrics import mean_squared_error
 from sklearn.model_selection import train_test_split
 from sklearn.calibration import calibration_curve
 import tensorflow as tf
-from tensorflow.keras import Input, Model
+from tensorflow.keras import Input, Model, activations
 from tensorflow.keras.backend import stack
-from tensorflow.keras.layers import Dense, Concatenate, Conv2D, Flatten, Reshape
+from tensorflow.keras.layers import Dense, Concatenate, Conv2D, Flatten, Layer, Reshape
 from tensorflow.keras.optimizers import Adam
 from tensorflow.python.framework.ops import disable_eager_execution
 from keras.models import load_model
 from keras.utils.vis_utils import plot_model
 
+from random_streams import child, get_rng
+
 PRINT_COMMENTS = True
 SHOW_PLOTS = True
 
@@ -38,6 +40,34 @@ PROBS = tf.convert_to_tensor(PROBS_RAW)
 
 BATCH_SIZE = 32
 N_TEST_CASES = BATCH_SIZE * 128
+VALIDATION_SPLIT = 0.2
+STEPS_PER_EPOCH = int(N_TEST_CASES * (1 - VALIDATION_SPLIT)) // BATCH_SIZE
+VALIDATION_STEPS = int(N_TEST_CASES * VALIDATION_SPLIT) // BATCH_SIZE
+
+
+@dataclass(frozen=True)
+class CoalitionGame:
+    '''sizes, true repayment probabilities and lending threshold of one coalition
+    experiment, passed explicitly to the losses and model builders so that several
+    configurations can be trained side by side; the module constants are the defaults'''
+    n_coalition: int = N_COALITION      # recommenders in the coalition
+    n_total: int = N_TOTAL              # all recommenders, honest ones report the true probabilities
+    m: int = M                          # borrowers
+    probs: tuple = tuple(PROBS_RAW)     # true repayment probability of each borrower
+    threshold: float = THRESHOLD        # lending threshold on the average report
+    epsilon: float = EPSILON            # reports are clipped to [epsilon, 1 - epsilon]
+
+    def __post_init__(self) -> None:
+        assert len(self.probs) == self.m, 'CoalitionGame(): one probability per borrower'
+        assert 0 < self.n_coalition <= self.n_total, 'CoalitionGame(): invalid coalition size'
+
+    @property
+    def n_others(self) -> int:
+        return self.n_total - self.n_coalition
+
+    @property
+    def probs_tensor(self):
+        return tf.constant(self.probs, dtype=tf.float32)
 
 
 # UTIL FUNCTIONS
@@ -53,26 +83,25 @@ def all_binary_strings(n):
 
 # LOSS FUNCTIONS
 
-def calculate_loss_in_profit(outcomes, reports):
-    # have to code simulation in tensorflow in differentiable way
-    coalition_reports = tf.reshape(reports, [N_COALITION, M])
-    other_reports = tf.tile(tf.reshape(PROBS, [1, M]), [
-                            N_TOTAL - N_COALITION, 1])
-    reports = tf.concat([coalition_reports, other_reports], axis=0)
-    reports = tf.clip_by_value(reports, EPSILON, 1 - EPSILON)
-    weights = tf.fill([N_TOTAL], 1/N_TOTAL)
-    beliefs = tf.linalg.matvec(reports, weights, transpose_a=True)
-    allocation = tf.cast(tf.greater(beliefs, THRESHOLD), tf.float32)
-    # outcomes = outcomes * allocation
-    # allocation = tf.math.round(sigmoid(beliefs, THRESHOLD))
-    # outcomes = allocation * outcomes
-
-    outcomes = allocation * PROBS
-
-    min_reports = (THRESHOLD - (tf.tile(tf.reshape(beliefs, [1, M]), [N_TOTAL, 1]) - (reports *
-                   tf.tile(tf.reshape(weights, [N_TOTAL, 1]), [1, M])))) * tf.tile(1 / tf.reshape(weights, [N_TOTAL, 1]), [1, M])
-    min_reports = tf.clip_by_value(min_reports, EPSILON, 1 - EPSILON)
-
+def coalition_mechanism(coalition_reports, other_reports, game=None):
+    '''batched truncated Winkler mechanism with equal weights: coalition_reports
+    (B, n_coalition, m) and other_reports (B, n_total - n_coalition, m) give the clipped
+    reports (B, n_total, m), beliefs (B, m) and minimum reports to get a loan (B, n_total, m)'''
+    game = game or CoalitionGame()
+    reports = tf.concat([coalition_reports, other_reports], axis=1)
+    reports = tf.clip_by_value(reports, game.epsilon, 1 - game.epsilon)
+    weights = tf.reshape(tf.fill([game.n_total], 1/game.n_total), [1, game.n_total, 1])
+    beliefs = tf.math.reduce_sum(reports * weights, axis=1)
+    min_reports = (game.threshold - (tf.expand_dims(beliefs, 1) -
+                   reports * weights)) * (1 / weights)
+    min_reports = tf.clip_by_value(min_reports, game.epsilon, 1 - game.epsilon)
+    return reports, beliefs, min_reports
+
+
+def coalition_outcome_payments(reports, min_reports, outcomes, game=None):
+    '''(B, n_coalition, m) outcome payments to the coalition, given outcomes (B, m)'''
+    game = game or CoalitionGame()
+    outcomes = tf.expand_dims(outcomes, 1)
     payments_repaid = outcomes * \
         (tf.math.log(reports) - tf.math.log(min_reports)) / \
         (-1 * tf.math.log(min_reports))
@@ -83,140 +112,337 @@ def calculate_loss_in_profit(outcomes, reports):
         reports, min_reports), tf.float32)
     # outcome_payments = (payments_repaid + payments_not_repaid) * \
     #     tf.math.round(sigmoid(reports, min_reports))
-    coalition_outcome_payments = outcome_payments[:N_COALITION, :]
-    return -1 * tf.math.reduce_sum(coalition_outcome_payments)
+    return outcome_payments[:, :game.n_coalition, :]
+
+
+def true_other_reports(batch_size, game=None):
+    '''(batch_size, n_total - n_coalition, m) reports of the recommenders outside the
+    coalition, who report the true probabilities'''
+    game = game or CoalitionGame()
+    return tf.tile(tf.reshape(game.probs_tensor, [1, 1, game.m]), [batch_size, game.n_others, 1])
+
+
+def calculate_loss_in_profit(outcomes, reports, game=None):
+    # have to code simulation in tensorflow in differentiable way
+    # batched: reports (B, n_coalition, m) gives the (B,) negative coalition profits
+    game = game or CoalitionGame()
+    coalition_reports = tf.reshape(reports, [-1, game.n_coalition, game.m])
+    other_reports = true_other_reports(tf.shape(coalition_reports)[0], game)
+    reports, beliefs, min_reports = coalition_mechanism(
+        coalition_reports, other_reports, game)
+    allocation = tf.cast(tf.greater(beliefs, game.threshold), tf.float32)
+    # outcomes = outcomes * allocation
+    # allocation = tf.math.round(sigmoid(beliefs, THRESHOLD))
+    # outcomes = allocation * outcomes
 
+    outcomes = allocation * game.probs_tensor
 
-def profit_loss(y_true, y_pred):
+    return -1 * tf.math.reduce_sum(
+        coalition_outcome_payments(reports, min_reports, outcomes, game), axis=[1, 2])
+
+
+def profit_loss(y_true, y_pred, game=None):
     # y_true is the binary outcome if allocated to the borrower; training data should have
     # the binary outcome ~ true probability of repayment for all borrowers
     # y_pred is the learned reports
-    result = tf.map_fn(
-        lambda x: calculate_loss_in_profit(x[0], x[1]), (y_true, y_pred), fn_output_signature=tf.float32)
-    return tf.math.reduce_sum(result)
+    return tf.math.reduce_sum(calculate_loss_in_profit(y_true, y_pred, game))
 
 
-def calculate_loss_in_desired_borrowers(reports, preferences):
+def calculate_loss_in_desired_borrowers(reports, preferences, game=None):
     # have to code simulation in tensorflow in differentiable way
-    coalition_reports = tf.reshape(reports, [N_COALITION, M])
-    other_reports = tf.tile(tf.reshape(PROBS, [1, M]), [
-                            N_TOTAL - N_COALITION, 1])
-    reports = tf.concat([coalition_reports, other_reports], axis=0)
-    reports = tf.clip_by_value(reports, EPSILON, 1 - EPSILON)
-    preferences = tf.reshape(preferences, [N_COALITION, M])
-    weights = tf.fill([N_TOTAL], 1/N_TOTAL)
-    beliefs = tf.linalg.matvec(reports, weights, transpose_a=True)
+    # batched: reports and preferences (B, n_coalition, m) give the (B,) negative utilities
+    game = game or CoalitionGame()
+    coalition_reports = tf.reshape(reports, [-1, game.n_coalition, game.m])
+    other_reports = true_other_reports(tf.shape(coalition_reports)[0], game)
+    _, beliefs, _ = coalition_mechanism(coalition_reports, other_reports, game)
+    preferences = tf.reshape(preferences, [-1, game.n_coalition, game.m])
     # sigmoid instead of step function for differentiability
     # allocation = tf.cast(tf.greater(beliefs, THRESHOLD), dtype=tf.float32)
-    allocation = sigmoid(beliefs, THRESHOLD, 250)
+    allocation = sigmoid(beliefs, game.threshold, 250)
     desirability_utilities = allocation * \
-        tf.math.reduce_sum(preferences, axis=0)
-    return -1 * tf.math.reduce_sum(desirability_utilities)
+        tf.math.reduce_sum(preferences, axis=1)
+    return -1 * tf.math.reduce_sum(desirability_utilities, axis=1)
 
 
-def desirability_loss(y_true, y_pred):
+def desirability_loss(y_true, y_pred, game=None):
     # y_true is ignored:
     # utility from inherent preference of borrower based on allocation of loan, not that borrower's repayment
     # y_pred is the learned reports concatenated with the inputs (how much each recommender cares about each borrower)
     reports, preferences = tf.split(y_pred, 2, axis=0)
-    result = tf.map_fn(
-        lambda x: calculate_loss_in_desired_borrowers(x[0], x[1]), (reports, preferences), fn_output_signature=tf.float32)
-    return tf.math.reduce_sum(result)
+    return tf.math.reduce_sum(calculate_loss_in_desired_borrowers(reports, preferences, game))
 
 
-def mixed_loss_old(desirability_importance=0.5):
+def mixed_loss_old(desirability_importance=0.5, game=None):
 
     def desirability_and_profit_loss_old(y_true, y_pred):
         reports, _ = tf.split(y_pred, 2, axis=0)
-        return desirability_importance * desirability_loss(y_true, y_pred) + \
+        return desirability_importance * desirability_loss(y_true, y_pred, game) + \
             (1-desirability_importance) * profit_loss(y_true,
-                                                      reports)  # need to remove preferences for profit calc
+                                                      reports, game)  # need to remove preferences for profit calc
 
     return desirability_and_profit_loss_old
 
 
-def mixed_loss(desirability_importance=0.5):
+def mixed_loss(desirability_importance=0.5, game=None):
+    # desirability_importance=None reads each example's importance (alpha) from the last
+    # column of y_true, for alpha-conditioned models
+    game = game or CoalitionGame()
 
-    def desirability_and_profit_loss_func(reports, other_reports, preferences, rand_outcomes):
-        coalition_reports = tf.reshape(reports, (N_COALITION, M))
-        other_reports = tf.reshape(other_reports, (N_TOTAL - N_COALITION, M))
-        preferences = tf.reshape(preferences, (N_COALITION, M))
-        # other_reports = tf.tile(tf.reshape(PROBS, [1, M]), [
-        #                         N_TOTAL - N_COALITION, 1])
-        reports = tf.concat([coalition_reports, other_reports], axis=0)
-        reports = tf.clip_by_value(reports, EPSILON, 1 - EPSILON)
-        weights = tf.fill([N_TOTAL], 1/N_TOTAL)
-        beliefs = tf.linalg.matvec(reports, weights, transpose_a=True)
-        allocation = tf.cast(tf.greater(beliefs, THRESHOLD), tf.float32)
+    def desirability_and_profit_loss_func(reports, other_reports, preferences, rand_outcomes, importance):
+        # batched over the first axis of every argument, returns (B,) losses
+        coalition_reports = tf.reshape(reports, (-1, game.n_coalition, game.m))
+        other_reports = tf.reshape(other_reports, (-1, game.n_others, game.m))
+        preferences = tf.reshape(preferences, (-1, game.n_coalition, game.m))
+        reports, beliefs, min_reports = coalition_mechanism(
+            coalition_reports, other_reports, game)
+        allocation = tf.cast(tf.greater(beliefs, game.threshold), tf.float32)
         outcomes = rand_outcomes * allocation
         # outcomes = allocation * PROBS
 
-        min_reports = (THRESHOLD - (tf.tile(tf.reshape(beliefs, [1, M]), [N_TOTAL, 1]) - (reports *
-                                                                                          tf.tile(tf.reshape(weights, [N_TOTAL, 1]), [1, M])))) * tf.tile(1 / tf.reshape(weights, [N_TOTAL, 1]), [1, M])
-        min_reports = tf.clip_by_value(min_reports, EPSILON, 1 - EPSILON)
-
-        payments_repaid = outcomes * \
-            (tf.math.log(reports) - tf.math.log(min_reports)) / \
-            (-1 * tf.math.log(min_reports))
-        payments_not_repaid = (1 - outcomes) * (tf.math.log(1 - reports) -
-                                                tf.math.log(1 - min_reports)) / (-1 * tf.math.log(min_reports))
-        # sigmoid for differentiability
-        outcome_payments = (payments_repaid + payments_not_repaid) * tf.cast(tf.greater(
-            reports, min_reports), tf.float32)
-        coalition_outcome_payments = outcome_payments[:N_COALITION, :]
+        coalition_payments = coalition_outcome_payments(
+            reports, min_reports, outcomes, game)
 
-        desirability_utilities = sigmoid(beliefs, THRESHOLD, 280) * \
-            tf.math.reduce_sum(preferences, axis=0)
+        desirability_utilities = sigmoid(beliefs, game.threshold, 280) * \
+            tf.math.reduce_sum(preferences, axis=1)
 
-        return -1 * ((1 - desirability_importance) * tf.math.reduce_sum(coalition_outcome_payments) +
-                     desirability_importance * tf.math.reduce_sum(desirability_utilities))
+        return -1 * ((1 - importance) * tf.math.reduce_sum(coalition_payments, axis=[1, 2]) +
+                     importance * tf.math.reduce_sum(desirability_utilities, axis=1))
 
     def desirability_and_profit_loss(y_true, y_pred):
         reports, preferences = tf.split(y_pred, 2, axis=0)
-        rand_outcomes = y_true[:, :M]
-        other_reports = y_true[:, M:]
-        result = tf.map_fn(
-            lambda x: desirability_and_profit_loss_func(x[0], x[1], x[2], x[3]), (reports, other_reports, preferences, rand_outcomes), fn_output_signature=tf.float32)
-        return tf.math.reduce_sum(result)
+        rand_outcomes = y_true[:, :game.m]
+        if desirability_importance is None:
+            other_reports = y_true[:, game.m:-1]
+            importance = y_true[:, -1]
+        else:
+            other_reports = y_true[:, game.m:]
+            importance = desirability_importance
+        return tf.math.reduce_sum(desirability_and_profit_loss_func(
+            reports, other_reports, preferences, rand_outcomes, importance))
 
     return desirability_and_profit_loss
 
 
-def mixed_loss_minimax(desirability_importance=0.5):
+def mixed_loss_minimax(desirability_importance=0.5, game=None):
 
     def desirability_and_profit_loss_minimax(y_true, y_pred):
         reports, preferences = tf.split(y_pred, 2, axis=0)
-        desirability_loss_vals = tf.map_fn(lambda x: calculate_loss_in_desired_borrowers(
-            x[0], x[1]), (reports, preferences), fn_output_signature=tf.float32)
-        profit_loss_vals = tf.map_fn(lambda x: calculate_loss_in_profit(
-            x[0], x[1]), (y_true, reports), fn_output_signature=tf.float32)
+        desirability_loss_vals = calculate_loss_in_desired_borrowers(
+            reports, preferences, game)
         # need to remove preferences for profit calc
+        profit_loss_vals = calculate_loss_in_profit(y_true, reports, game)
         return tf.math.reduce_max(desirability_importance * desirability_loss_vals +
                                   (1-desirability_importance) * profit_loss_vals)
 
     return desirability_and_profit_loss_minimax
 
 
-def profit_reports() -> None:
+def stacked_loss(loss, n_members):
+    '''loss of a stacked_collusion_model: the sum of loss over its n_members models,
+    evaluated as a single batch of members times samples'''
+
+    def stacked_members_loss(y_true, y_pred):
+        reports, preferences = tf.split(y_pred, 2, axis=0)
+        reports = tf.reshape(reports, [-1, *reports.shape[2:]])
+        preferences = tf.reshape(preferences, [-1, *preferences.shape[2:]])
+        return loss(tf.repeat(y_true, n_members, axis=0),
+                    tf.concat([reports, preferences], axis=0))
+
+    return stacked_members_loss
+
+
+def member_loss(loss, member):
+    '''loss of one member of a stacked_collusion_model, to track as a metric'''
+
+    def member_loss_func(y_true, y_pred):
+        reports, preferences = tf.split(y_pred, 2, axis=0)
+        return loss(y_true, tf.concat([reports[:, member], preferences[:, member]], axis=0))
+
+    member_loss_func.__name__ = f'member_{member}'
+    return member_loss_func
+
+
+# MODELS
+
+def stacked_glorot_uniform(shape, dtype=None):
+    '''glorot_uniform for each member of a (n_members, in, out) kernel'''
+    limit = np.sqrt(6 / (shape[-2] + shape[-1]))
+    return tf.random.uniform(shape, -limit, limit, dtype=dtype or tf.float32)
+
+
+class StackedDense(Layer):
+    '''n_members independent Dense layers evaluated together. Inputs (B, in) are shared
+    by all members, inputs (B, n_members, in) are per member; outputs are (B, n_members, units)'''
+
+    def __init__(self, n_members, units, activation=None, **kwargs):
+        super().__init__(**kwargs)
+        self.n_members = n_members
+        self.units = units
+        self.activation = activations.get(activation)
+
+    def build(self, input_shape):
+        self.kernel = self.add_weight(name='kernel', shape=(self.n_members, int(input_shape[-1]), self.units),
+                                      initializer=stacked_glorot_uniform)
+        self.bias = self.add_weight(name='bias', shape=(self.n_members, self.units),
+                                    initializer='zeros')
+        super().build(input_shape)
+
+    def call(self, inputs):
+        equation = 'bi,rio->bro' if inputs.shape.rank == 2 else 'bri,rio->bro'
+        return self.activation(tf.einsum(equation, inputs, self.kernel) + self.bias)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({'n_members': self.n_members, 'units': self.units,
+                       'activation': activations.serialize(self.activation)})
+        return config
+
+
+def stacked_collusion_model(n_members, game=None, alpha_input=False):
+    '''n_members collusion models with independent weights in one graph, for training
+    restarts together; outputs (2B, n_members, n_coalition, m) are each member's reports
+    concatenated with the inputs, as for a single collusion model. With alpha_input the
+    model takes [preferences, alpha (B, 1)] and learns reports for any alpha'''
+    game = game or CoalitionGame()
+    inputs = Input(shape=(game.n_coalition, game.m), dtype=tf.float32)
+    layer = Flatten()(inputs)
+    if alpha_input:
+        alpha = Input(shape=(1,), dtype=tf.float32)
+        layer = Concatenate(axis=1)([layer, alpha])
+    layer = StackedDense(n_members, game.n_coalition * game.m)(layer)
+    layer = StackedDense(n_members, game.n_coalition * game.m)(layer)
+    layer = StackedDense(n_members, game.n_coalition * game.m, activation='sigmoid')(layer)
+    # we have to concatenate the input biases in the final layer so they can appear in the loss function
+    # but the input biases never actually change
+    preferences = Reshape((1, game.n_coalition, game.m))(inputs)
+    if n_members > 1:
+        preferences = Concatenate(axis=1)([preferences] * n_members)
+    outputs = Concatenate(axis=0)([Reshape((n_members, game.n_coalition, game.m))(layer),
+                                   preferences])
+    return Model(inputs=[inputs, alpha] if alpha_input else inputs, outputs=outputs,
+                 name="stacked_collusion_model")
+
+
+# TRAINING DATA
+
+def sample_preferences(kind, batch_size, game=None, rng=None):
+    '''(batch_size, n_coalition, m) preferences x_{i,q} of the coalition members:
+    'single' - all members want the same random borrower, 'binary' - independent 0/1 wants,
+    'disagreement' - a random subset of the members wants borrower 0 and the rest borrower 1'''
+    game = game or CoalitionGame()
+    rng = get_rng(rng)
+    if kind == 'single':
+        wanted = np.eye(game.m)[rng.integers(0, game.m, batch_size)]
+        return np.repeat(wanted[:, np.newaxis], game.n_coalition, axis=1).astype(np.float32)
+    elif kind == 'binary':
+        return rng.integers(0, 2, (batch_size, game.n_coalition, game.m)).astype(np.float32)
+    elif kind == 'disagreement':
+        subset_size = rng.integers(0, game.n_coalition + 1, (batch_size, 1))
+        ranks = np.argsort(np.argsort(rng.random((batch_size, game.n_coalition)), axis=1), axis=1)
+        in_subset = ranks < subset_size
+        preferences = np.zeros((batch_size, game.n_coalition, game.m), dtype=np.float32)
+        preferences[..., 0] = in_subset
+        preferences[..., 1] = ~in_subset
+        return preferences
+    else:
+        assert False, 'sample_preferences(): invalid kind'
+
+
+def sample_reports(batch_size, n_reports, noise, game=None, rng=None):
+    '''(batch_size, n_reports, m) honest reports: the true probabilities plus normal noise'''
+    game = game or CoalitionGame()
+    return np.clip(get_rng(rng).normal(game.probs, noise, (batch_size, n_reports, game.m)),
+                   game.epsilon, 1 - game.epsilon).astype(np.float32)
+
+
+def sample_targets(batch_size, noise, game=None, rng=None):
+    '''(batch_size, m + (n_total - n_coalition) * m) y for mixed_loss: binary repayment
+    outcomes followed by the reports of the recommenders outside the coalition'''
+    # we sample the outcomes according to the true probabilities so the probability is in the training
+    # data, rather than the loss function (calling a random function is not differentiable)
+    game = game or CoalitionGame()
+    rng = get_rng(rng)
+    outcomes = rng.binomial(1, game.probs, (batch_size, game.m)).astype(np.float32)
+    other_reports = sample_reports(batch_size, game.n_others, noise, game, rng)
+    return np.concatenate([outcomes, np.reshape(other_reports, (batch_size, -1))], axis=1)
+
+
+def batch_spec(*shape):
+    '''float32 TensorSpec of batches of examples of the given shape, see coalition_dataset'''
+    return tf.TensorSpec((None, *shape), tf.float32)
+
+
+def coalition_specs(game=None):
+    '''batch_specs of preferences and mixed_loss targets, see sample_preferences and
+    sample_targets, from the game's dimensions'''
+    game = game or CoalitionGame()
+    return batch_spec(game.n_coalition, game.m), batch_spec(game.m * (1 + game.n_others))
+
+
+def coalition_dataset(sample_batch, signature, n_batches=None):
+    '''tf.data pipeline of the batches sample_batch(batch_size) returns, endless unless
+    n_batches is given, sampled ahead of training on a background thread. A finite
+    dataset is cached so that every epoch sees the same batches. signature is the
+    structure of batch_specs sample_batch returns; it is not sampled, so the
+    sampler's random stream only feeds the batches'''
+
+    def batches():
+        for _ in (itertools.count() if n_batches is None else range(n_batches)):
+            yield sample_batch(BATCH_SIZE)
+
+    dataset = tf.data.Dataset.from_generator(batches, output_signature=signature)
+    if n_batches is not None:
+        dataset = dataset.cache()
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def coalition_datasets(preferences, noise, game=None, rng=None, alpha_conditioned=False):
+    '''endless training and fixed validation datasets of (preferences, targets) batches for
+    mixed_loss, see sample_preferences and sample_targets; fit with STEPS_PER_EPOCH.
+    alpha_conditioned adds a uniform alpha per example, as an input and as the last column of y'''
+    game = game or CoalitionGame()
+    rng = get_rng(rng)
+
+    def sampler(rng):
+        def sample_batch(batch_size):
+            X = sample_preferences(preferences, batch_size, game, rng)
+            y = sample_targets(batch_size, noise, game, rng)
+            if not alpha_conditioned:
+                return X, y
+            alphas = rng.random((batch_size, 1)).astype(np.float32)
+            return (X, alphas), np.concatenate([y, alphas], axis=1)
+        return sample_batch
+
+    X_spec, y_spec = coalition_specs(game)
+    signature = ((X_spec, batch_spec(1)), batch_spec(game.m * (1 + game.n_others) + 1)) \
+        if alpha_conditioned else (X_spec, y_spec)
+    # each pipeline gets its own Generator, as they are sampled on their own threads
+    return coalition_dataset(sampler(child(rng)), signature), \
+        coalition_dataset(sampler(child(rng)), signature, VALIDATION_STEPS)
+
+
+def profit_reports(game=None, rng=None) -> None:
     # here we are just maximizing profit from the mechanism, resulting in accurate reports
     # X doesn't do anything, it's just stochastic noise for the network to run
-    X = np.random.random((N_TEST_CASES, N_COALITION, M))
+    game = game or CoalitionGame()
+    rng = get_rng(rng)
+    X = rng.random((N_TEST_CASES, game.n_coalition, game.m))
     # X = np.full((N_TEST_CASES, N * M), 0.5)
     # y is the binary outcome of repayment (if allocated to that borrower)
     # we sample y according to the true probabilities so the probability is in the training
     # data, rather than the loss function (calling a random function is not differentiable)
-    y = np.random.binomial(1, PROBS, (N_TEST_CASES, M)).astype(np.float32)
+    y = rng.binomial(1, game.probs, (N_TEST_CASES, game.m)).astype(np.float32)
 
-    inputs = Input(shape=(N_COALITION, M), dtype=tf.float32)
+    inputs = Input(shape=(game.n_coalition, game.m), dtype=tf.float32)
     layer = Flatten()(inputs)
-    layer = Dense(N_COALITION * M)(layer)
-    layer = Dense(N_COALITION * M)(layer)
-    layer = Dense(N_COALITION * M, activation='sigmoid')(layer)
-    outputs = Reshape((N_COALITION, M))(layer)
+    layer = Dense(game.n_coalition * game.m)(layer)
+    layer = Dense(game.n_coalition * game.m)(layer)
+    layer = Dense(game.n_coalition * game.m, activation='sigmoid')(layer)
+    outputs = Reshape((game.n_coalition, game.m))(layer)
 
     model = Model(inputs=inputs, outputs=outputs, name="collusion_model")
 
-    model.compile(loss=profit_loss,
+    model.compile(loss=lambda y_true, y_pred: profit_loss(y_true, y_pred, game),
                   optimizer=Adam(learning_rate=DEFAULT_LR, beta_1=DEFAULT_B1, epsilon=DEFAULT_EPSILON, amsgrad=True))
 
     # plot_model(model, 'model.png', show_shapes=True)
@@ -232,13 +458,13 @@ def profit_reports() -> None:
         plt.legend(['Training', 'Validation'], loc='upper left')
         plt.show()
 
-    predictions = model.predict(np.full((1, N_COALITION, M), 0.5))[0]
+    predictions = model.predict(np.full((1, game.n_coalition, game.m), 0.5))[0]
     print('mean: ' + str(np.mean(predictions, axis=0)))
     print('std: ' + str(np.std(predictions, axis=0)))
     print('')
 
 
-def desire_borrowers() -> None:
+def desire_borrowers(game=None, rng=None) -> None:
     # in this case the quantity that we are maximizing is actually the probabilities
     # that the desired people get loans
     # here, x_{i,q} represents how much that recommender i wants q to get a loan.
@@ -248,24 +474,26 @@ def desire_borrowers() -> None:
     # X = np.array([np.tile(np.reshape([int(j == index) for j in range(M)], (1, M)), (N_COALITION, M))
     #               for _, index in enumerate(indices)], dtype=np.float32)
 
-    X = np.random.randint(0, 2, (N_TEST_CASES, N_COALITION, M))
+    game = game or CoalitionGame()
+    rng = get_rng(rng)
+    X = rng.integers(0, 2, (N_TEST_CASES, game.n_coalition, game.m))
 
     # y is ignored
     y = np.zeros((N_TEST_CASES, 1)).astype(np.float32)
 
-    inputs = Input(shape=(N_COALITION, M), dtype=tf.float32)
+    inputs = Input(shape=(game.n_coalition, game.m), dtype=tf.float32)
     layer = Flatten()(inputs)
-    layer = Dense(N_COALITION * M)(layer)
-    layer = Dense(N_COALITION * M)(layer)
-    layer = Dense(N_COALITION * M, activation='sigmoid')(layer)
+    layer = Dense(game.n_coalition * game.m)(layer)
+    layer = Dense(game.n_coalition * game.m)(layer)
+    layer = Dense(game.n_coalition * game.m, activation='sigmoid')(layer)
     # we have to concatenate the input biases in the final layer so they can appear in the loss function
     # but the input biases never actually change
-    outputs = Concatenate(axis=0)([Reshape((1, N_COALITION, M))(layer),
-                                   Reshape((1, N_COALITION, M))(inputs)])
+    outputs = Concatenate(axis=0)([Reshape((1, game.n_coalition, game.m))(layer),
+                                   Reshape((1, game.n_coalition, game.m))(inputs)])
 
     model = Model(inputs=inputs, outputs=outputs, name="collusion_model")
 
-    model.compile(loss=desirability_loss,
+    model.compile(loss=lambda y_true, y_pred: desirability_loss(y_true, y_pred, game),
                   optimizer=Adam(learning_rate=DEFAULT_LR, beta_1=DEFAULT_B1, epsilon=DEFAULT_EPSILON, amsgrad=True))
     history = model.fit(X, y, validation_split=0.2,
                         epochs=20, batch_size=BATCH_SIZE, verbose=0)
@@ -280,10 +508,10 @@ def desire_borrowers() -> None:
 
     # iterate over borrowers that recommenders care about
     tests = []
-    for index in range(M):
-        test = np.zeros((1, M))
+    for index in range(game.m):
+        test = np.zeros((1, game.m))
         test[0, index] = 1
-        test = np.tile(test, [N_COALITION, 1])
+        test = np.tile(test, [game.n_coalition, 1])
         tests.append(test)
     predictions = model.predict(np.array(tests))
     predictions, _ = np.split(predictions, 2, axis=0)
@@ -296,59 +524,62 @@ def desire_borrowers() -> None:
     return predictions
 
 
-def desire_borrowers_and_profit(alpha=0.5, testname=None, nruns=5, noise=0.05):
+def desire_borrowers_and_profit(alpha=0.5, testname=None, nruns=5, noise=0.05, game=None, rng=None, stacked=True):
     # in this case recommenders care about both profits and helping their desired borrower get a loan
 
     # here, x_{i,q} represents how much that recommender i wants q to get a loan.
-    indices = np.random.randint(0, M, N_TEST_CASES)
-    X = np.array([np.tile(np.reshape([float(j == index) for j in range(M)], (1, M)), (N_COALITION, 1))
-                  for _, index in enumerate(indices)])
-
-    # X = np.random.randint(0, 2, (N_TEST_CASES, N_COALITION * M))
-
-    # y is the binary outcome of repayment (if allocated to that borrower)
-    # we sample y according to the true probabilities so the probability is in the training
-    # data, rather than the loss function (calling a random function is not differentiable)
-    y_outcomes = np.random.binomial(
-        1, PROBS, (N_TEST_CASES, M)).astype(np.float32)
-    y_noise = np.reshape(np.clip(np.random.normal(PROBS, noise,
-                                                  (N_TEST_CASES * (N_TOTAL - N_COALITION), M)),
-                                 EPSILON, 1-EPSILON),
-                         (N_TEST_CASES, (N_TOTAL - N_COALITION) * M))
-    y = np.concatenate([y_outcomes, y_noise], axis=1)
+    game = game or CoalitionGame()
+    # every recommender in the coalition wants the same borrower; y is the binary outcome of
+    # repayment (if allocated to that borrower) and the other recommenders' reports
+    train, validation = coalition_datasets('single', noise, game, rng)
 
     # pick best of nruns stochastic runs
-    best_model_loss = float('inf')
-    best_model = None
-    best_history = None
-    for _ in range(nruns):
-        inputs = Input(shape=(N_COALITION, M), dtype=tf.float32)
-        layer = Flatten()(inputs)
-        layer = Dense(N_COALITION * M)(layer)
-        layer = Dense(N_COALITION * M)(layer)
-        layer = Dense(N_COALITION * M, activation='sigmoid')(layer)
-        # we have to concatenate the input biases in the final layer so they can appear in the loss function
-        # but the input biases never actually change
-        outputs = Concatenate(axis=0)([Reshape((1, N_COALITION, M))(layer),
-                                       Reshape((1, N_COALITION, M))(inputs)])
-
-        model = Model(inputs=inputs, outputs=outputs, name="collusion_model")
-
-        # the mixed loss coefficient is what percent the recommenders care about their desired borrower
-        # as compared to profit
-        model.compile(loss=mixed_loss(alpha),
-                      optimizer=Adam(learning_rate=DEFAULT_LR, beta_1=DEFAULT_B1, epsilon=DEFAULT_EPSILON, amsgrad=True))
-        history = model.fit(X, y, validation_split=0.2,
-                            epochs=20, batch_size=BATCH_SIZE, verbose=0)
-
-        model_loss = history.history['val_loss'][-1]
-        if model_loss < best_model_loss:
-            best_model_loss = model_loss
-            best_model = model
-            best_history = history
-
-    plt.plot(best_history.history['loss'])
-    plt.plot(best_history.history['val_loss'])
+    if stacked:
+        # all runs as members of one model, trained together; the summed loss gives
+        # each member the gradients it would get on its own
+        loss = mixed_loss(alpha, game)
+        best_model = stacked_collusion_model(nruns, game)
+        best_model.compile(loss=stacked_loss(loss, nruns),
+                           optimizer=Adam(learning_rate=DEFAULT_LR, beta_1=DEFAULT_B1,
+                                          epsilon=DEFAULT_EPSILON, amsgrad=True),
+                           metrics=[member_loss(loss, member) for member in range(nruns)])
+        history = best_model.fit(train, validation_data=validation, steps_per_epoch=STEPS_PER_EPOCH,
+                                 epochs=20, verbose=0)
+        best_member = int(np.argmin([history.history[f'val_member_{member}'][-1]
+                                     for member in range(nruns)]))
+        best_history = {'loss': history.history[f'member_{best_member}'],
+                        'val_loss': history.history[f'val_member_{best_member}']}
+    else:
+        best_model_loss = float('inf')
+        best_member = 0
+        for _ in range(nruns):
+            inputs = Input(shape=(game.n_coalition, game.m), dtype=tf.float32)
+            layer = Flatten()(inputs)
+            layer = Dense(game.n_coalition * game.m)(layer)
+            layer = Dense(game.n_coalition * game.m)(layer)
+            layer = Dense(game.n_coalition * game.m, activation='sigmoid')(layer)
+            # we have to concatenate the input biases in the final layer so they can appear in the loss function
+            # but the input biases never actually change
+            outputs = Concatenate(axis=0)([Reshape((1, game.n_coalition, game.m))(layer),
+                                           Reshape((1, game.n_coalition, game.m))(inputs)])
+
+            model = Model(inputs=inputs, outputs=outputs, name="collusion_model")
+
+            # the mixed loss coefficient is what percent the recommenders care about their desired borrower
+            # as compared to profit
+            model.compile(loss=mixed_loss(alpha, game),
+                          optimizer=Adam(learning_rate=DEFAULT_LR, beta_1=DEFAULT_B1, epsilon=DEFAULT_EPSILON, amsgrad=True))
+            history = model.fit(train, validation_data=validation, steps_per_epoch=STEPS_PER_EPOCH,
+                                epochs=20, verbose=0)
+
+            model_loss = history.history['val_loss'][-1]
+            if model_loss < best_model_loss:
+                best_model_loss = model_loss
+                best_model = model
+                best_history = history.history
+
+    plt.plot(best_history['loss'])
+    plt.plot(best_history['val_loss'])
     plt.ylabel('Model loss')
     plt.xlabel('Epochs')
     plt.legend(['Training', 'Validation'], loc='upper left')
@@ -360,14 +591,14 @@ def desire_borrowers_and_profit(alpha=0.5, testname=None, nruns=5, noise=0.05):
 
     # iterate over borrowers that recommenders care about
     tests = []
-    for index in range(M):
-        test = np.zeros((1, M))
+    for index in range(game.m):
+        test = np.zeros((1, game.m))
         test[0, index] = 1
-        test = np.tile(test, [N_COALITION, 1])
+        test = np.tile(test, [game.n_coalition, 1])
         tests.append(test)
     predictions = best_model.predict(np.array(tests))
     predictions, _ = np.split(predictions, 2, axis=0)
-    predictions = np.array([prediction[0] for prediction in predictions])
+    predictions = np.array([prediction[best_member] for prediction in predictions])
     if PRINT_COMMENTS:
         for prediction in predictions:
             print('alpha: ' + str(alpha))
@@ -378,7 +609,49 @@ def desire_borrowers_and_profit(alpha=0.5, testname=None, nruns=5, noise=0.05):
     return predictions
 
 
-def desire_borrowers_and_profit_save_model(alpha=0.8, testname='savemodel', noise=0.02):
+def desire_borrowers_and_profit_alpha_conditioned(testname='alpha_conditioned', nruns=5, noise=0.05, epochs=20, game=None, rng=None):
+    # like desire_borrowers_and_profit, but alpha is an input of the network, drawn uniformly
+    # from [0, 1] for each example, so one training run covers every alpha. Returns the
+    # stacked model and its best member, see alpha_conditioned_predictions
+    game = game or CoalitionGame()
+    # y is the binary outcome of repayment, the other recommenders' reports and, last, alpha
+    train, validation = coalition_datasets('single', noise, game, rng, alpha_conditioned=True)
+
+    loss = mixed_loss(None, game)
+    model = stacked_collusion_model(nruns, game, alpha_input=True)
+    model.compile(loss=stacked_loss(loss, nruns),
+                  optimizer=Adam(learning_rate=DEFAULT_LR, beta_1=DEFAULT_B1,
+                                 epsilon=DEFAULT_EPSILON, amsgrad=True),
+                  metrics=[member_loss(loss, member) for member in range(nruns)])
+    history = model.fit(train, validation_data=validation, steps_per_epoch=STEPS_PER_EPOCH,
+                        epochs=epochs, verbose=0)
+    best_member = int(np.argmin([history.history[f'val_member_{member}'][-1]
+                                 for member in range(nruns)]))
+
+    plt.plot(history.history[f'member_{best_member}'])
+    plt.plot(history.history[f'val_member_{best_member}'])
+    plt.ylabel('Model loss')
+    plt.xlabel('Epochs')
+    plt.legend(['Training', 'Validation'], loc='upper left')
+    plt.savefig(f'results/{testname}.png', bbox_inches='tight')
+    if SHOW_PLOTS:
+        plt.show()
+    plt.close()
+    return model, best_member
+
+
+def alpha_conditioned_predictions(model, alphas, member=0, game=None):
+    '''reports (len(alphas), m, n_coalition, m) of an alpha-conditioned model for each alpha
+    and each borrower that the coalition cares about, as saved by test_alpha'''
+    game = game or CoalitionGame()
+    alphas = np.asarray(alphas, dtype=np.float32)
+    tests = np.tile(np.eye(game.m)[:, np.newaxis, :], (len(alphas), game.n_coalition, 1))
+    predictions = model.predict([tests, np.repeat(alphas, game.m)[:, np.newaxis]])
+    predictions, _ = np.split(predictions, 2, axis=0)
+    return np.reshape(predictions[:, member], (len(alphas), game.m, game.n_coalition, game.m))
+
+
+def desire_borrowers_and_profit_save_model(alpha=0.8, testname='savemodel', noise=0.02, game=None, rng=None):
     # in this case recommenders care about both profits and helping their desired borrower get a loan
 
     # here, x_{i,q} represents how much that recommender i wants q to get a loan.
@@ -386,35 +659,28 @@ def desire_borrowers_and_profit_save_model(alpha=0.8, testname='savemodel', nois
     # X = np.array([np.tile(np.reshape([float(j == index) for j in range(M)], (1, M)), (N_COALITION, 1))
     #               for _, index in enumerate(indices)])
 
-    X = np.random.randint(0, 2, (N_TEST_CASES, N_COALITION, M))
-
-    # y is the binary outcome of repayment (if allocated to that borrower)
-    # we sample y according to the true probabilities so the probability is in the training
-    # data, rather than the loss function (calling a random function is not differentiable)
-    y_outcomes = np.random.binomial(
-        1, PROBS, (N_TEST_CASES, M)).astype(np.float32)
-    y_noise = np.reshape(np.random.normal(
-        PROBS, noise, (N_TEST_CASES * N_COALITION, M)), (N_TEST_CASES, N_COALITION * M))
-    y = np.concatenate([y_outcomes, y_noise], axis=1)
+    game = game or CoalitionGame()
+    # y is the binary outcome of repayment (if allocated to that borrower) and the other recommenders' reports
+    train, validation = coalition_datasets('binary', noise, game, rng)
 
-    inputs = Input(shape=(N_COALITION, M), dtype=tf.float32)
+    inputs = Input(shape=(game.n_coalition, game.m), dtype=tf.float32)
     layer = Flatten()(inputs)
-    layer = Dense(N_COALITION * M)(layer)
-    layer = Dense(N_COALITION * M)(layer)
-    layer = Dense(N_COALITION * M, activation='sigmoid')(layer)
+    layer = Dense(game.n_coalition * game.m)(layer)
+    layer = Dense(game.n_coalition * game.m)(layer)
+    layer = Dense(game.n_coalition * game.m, activation='sigmoid')(layer)
     # we have to concatenate the input biases in the final layer so they can appear in the loss function
     # but the input biases never actually change
-    outputs = Concatenate(axis=0)([Reshape((1, N_COALITION, M))(layer),
-                                   Reshape((1, N_COALITION, M))(inputs)])
+    outputs = Concatenate(axis=0)([Reshape((1, game.n_coalition, game.m))(layer),
+                                   Reshape((1, game.n_coalition, game.m))(inputs)])
 
     model = Model(inputs=inputs, outputs=outputs, name="collusion_model")
 
     # the mixed loss coefficient is what percent the recommenders care about their desired borrower
     # as compared to profit
-    model.compile(loss=mixed_loss(alpha),
+    model.compile(loss=mixed_loss(alpha, game),
                   optimizer=Adam(learning_rate=DEFAULT_LR, beta_1=DEFAULT_B1, epsilon=DEFAULT_EPSILON, amsgrad=True))
-    history = model.fit(X, y, validation_split=0.2,
-                        epochs=20, batch_size=BATCH_SIZE, verbose=0)
+    history = model.fit(train, validation_data=validation, steps_per_epoch=STEPS_PER_EPOCH,
+                        epochs=20, verbose=0)
 
     model.save('coalition_alpha_08')
 
@@ -430,7 +696,7 @@ def desire_borrowers_and_profit_save_model(alpha=0.8, testname='savemodel', nois
     plt.close()
 
 
-def desire_borrowers_and_profit_disagreement(alpha=0.8, testname='disagreement'):
+def desire_borrowers_and_profit_disagreement(alpha=0.8, testname='disagreement', noise=0.05, game=None, rng=None):
     # in this case recommenders care about both profits and helping their desired borrower get a loan
 
     # here, x_{i,q} represents how much that recommender i wants q to get a loan.
@@ -438,42 +704,29 @@ def desire_borrowers_and_profit_disagreement(alpha=0.8, testname='disagreement')
     # X = np.array([np.tile(np.reshape([float(j == index) for j in range(M)], (1, M)), (N_COALITION, 1))
     #               for _, index in enumerate(indices)])
 
-    X = []
-    for _ in range(N_TEST_CASES):
-        xi = np.zeros((N_COALITION, M))
-        rand_indices = get_indices(
-            N_COALITION, random.randint(0, N_COALITION))
-        for i in range(N_COALITION):
-            if i in rand_indices:
-                xi[i, 0] = 1
-            else:
-                xi[i, 1] = 1
-        X.append(xi)
-    X = np.array(X)
-
-    # y is the binary outcome of repayment (if allocated to that borrower)
-    # we sample y according to the true probabilities so the probability is in the training
-    # data, rather than the loss function (calling a random function is not differentiable)
-    y = np.random.binomial(1, PROBS, (N_TEST_CASES, M)).astype(np.float32)
+    game = game or CoalitionGame()
+    # a random subset of the coalition wants borrower 0 and the rest borrower 1
+    # y is the binary outcome of repayment (if allocated to that borrower) and the other recommenders' reports
+    train, validation = coalition_datasets('disagreement', noise, game, rng)
 
-    inputs = Input(shape=(N_COALITION, M), dtype=tf.float32)
+    inputs = Input(shape=(game.n_coalition, game.m), dtype=tf.float32)
     layer = Flatten()(inputs)
-    layer = Dense(N_COALITION * M)(layer)
-    layer = Dense(N_COALITION * M)(layer)
-    layer = Dense(N_COALITION * M, activation='sigmoid')(layer)
+    layer = Dense(game.n_coalition * game.m)(layer)
+    layer = Dense(game.n_coalition * game.m)(layer)
+    layer = Dense(game.n_coalition * game.m, activation='sigmoid')(layer)
     # we have to concatenate the input biases in the final layer so they can appear in the loss function
     # but the input biases never actually change
-    outputs = Concatenate(axis=0)([Reshape((1, N_COALITION, M))(layer),
-                                   Reshape((1, N_COALITION, M))(inputs)])
+    outputs = Concatenate(axis=0)([Reshape((1, game.n_coalition, game.m))(layer),
+                                   Reshape((1, game.n_coalition, game.m))(inputs)])
 
     model = Model(inputs=inputs, outputs=outputs, name="collusion_model")
 
     # the mixed loss coefficient is what percent the recommenders care about their desired borrower
     # as compared to profit
-    model.compile(loss=mixed_loss(alpha),
+    model.compile(loss=mixed_loss(alpha, game),
                   optimizer=Adam(learning_rate=DEFAULT_LR, beta_1=DEFAULT_B1, epsilon=DEFAULT_EPSILON, amsgrad=True))
-    history = model.fit(X, y, validation_split=0.2,
-                        epochs=20, batch_size=BATCH_SIZE, verbose=0)
+    history = model.fit(train, validation_data=validation, steps_per_epoch=STEPS_PER_EPOCH,
+                        epochs=20, verbose=0)
 
     model.save('coalition_disagreement')
 
@@ -488,7 +741,7 @@ def desire_borrowers_and_profit_disagreement(alpha=0.8, testname='disagreement')
     # plt.show()
 
 
-def desire_borrowers_and_profit_disagreement_minimax(alpha=0.8, testname='disagreement_minimax'):
+def desire_borrowers_and_profit_disagreement_minimax(alpha=0.8, testname='disagreement_minimax', noise=0.05, game=None, rng=None):
     # in this case recommenders care about both profits and helping their desired borrower get a loan
 
     # here, x_{i,q} represents how much that recommender i wants q to get a loan.
@@ -496,42 +749,29 @@ def desire_borrowers_and_profit_disagreement_minimax(alpha=0.8, testname='disagr
     # X = np.array([np.tile(np.reshape([float(j == index) for j in range(M)], (1, M)), (N_COALITION, 1))
     #               for _, index in enumerate(indices)])
 
-    X = []
-    for _ in range(N_TEST_CASES):
-        xi = np.zeros((N_COALITION, M))
-        rand_indices = get_indices(
-            N_COALITION, random.randint(0, N_COALITION))
-        for i in range(N_COALITION):
-            if i in rand_indices:
-                xi[i, 0] = 1
-            else:
-                xi[i, 1] = 1
-        X.append(xi)
-    X = np.array(X)
-
-    # y is the binary outcome of repayment (if allocated to that borrower)
-    # we sample y according to the true probabilities so the probability is in the training
-    # data, rather than the loss function (calling a random function is not differentiable)
-    y = np.random.binomial(1, PROBS, (N_TEST_CASES, M)).astype(np.float32)
+    game = game or CoalitionGame()
+    # a random subset of the coalition wants borrower 0 and the rest borrower 1
+    # y is the binary outcome of repayment (if allocated to that borrower) and the other recommenders' reports
+    train, validation = coalition_datasets('disagreement', noise, game, rng)
 
-    inputs = Input(shape=(N_COALITION, M), dtype=tf.float32)
+    inputs = Input(shape=(game.n_coalition, game.m), dtype=tf.float32)
     layer = Flatten()(inputs)
-    layer = Dense(N_COALITION * M)(layer)
-    layer = Dense(N_COALITION * M)(layer)
-    layer = Dense(N_COALITION * M, activation='sigmoid')(layer)
+    layer = Dense(game.n_coalition * game.m)(layer)
+    layer = Dense(game.n_coalition * game.m)(layer)
+    layer = Dense(game.n_coalition * game.m, activation='sigmoid')(layer)
     # we have to concatenate the input biases in the final layer so they can appear in the loss function
     # but the input biases never actually change
-    outputs = Concatenate(axis=0)([Reshape((1, N_COALITION, M))(layer),
-                                   Reshape((1, N_COALITION, M))(inputs)])
+    outputs = Concatenate(axis=0)([Reshape((1, game.n_coalition, game.m))(layer),
+                                   Reshape((1, game.n_coalition, game.m))(inputs)])
 
     model = Model(inputs=inputs, outputs=outputs, name="collusion_model")
 
     # the mixed loss coefficient is what percent the recommenders care about their desired borrower
     # as compared to profit
-    model.compile(loss=mixed_loss_minimax(alpha),
+    model.compile(loss=mixed_loss_minimax(alpha, game),
                   optimizer=Adam(learning_rate=DEFAULT_LR, beta_1=DEFAULT_B1, epsilon=DEFAULT_EPSILON, amsgrad=True))
-    history = model.fit(X, y, validation_split=0.2,
-                        epochs=20, batch_size=BATCH_SIZE, verbose=0)
+    history = model.fit(train, validation_data=validation, steps_per_epoch=STEPS_PER_EPOCH,
+                        epochs=20, verbose=0)
 
     model.save('coalition_disagreement_minimax')
 
@@ -546,13 +786,14 @@ def desire_borrowers_and_profit_disagreement_minimax(alpha=0.8, testname='disagr
     # plt.show()
 
 
-def test_disagreement():
+def test_disagreement(game=None):
+    game = game or CoalitionGame()
     model = load_model('coalition_disagreement', custom_objects={
-                       'desirability_and_profit_loss': mixed_loss(0.8)})
+                       'desirability_and_profit_loss': mixed_loss(0.8, game)})
     tests = []
 
-    test = np.zeros((N_COALITION, M))
-    for i in range(N_COALITION):
+    test = np.zeros((game.n_coalition, game.m))
+    for i in range(game.n_coalition):
         if i < 2:
             test[i, 0] = 1
         else:
@@ -570,13 +811,14 @@ def test_disagreement():
             print('')
 
 
-def test_disagreement_minimax():
+def test_disagreement_minimax(game=None):
+    game = game or CoalitionGame()
     model = load_model('coalition_disagreement_minimax', custom_objects={
-                       'desirability_and_profit_loss_minimax': mixed_loss_minimax(0.8)})
+                       'desirability_and_profit_loss_minimax': mixed_loss_minimax(0.8, game)})
     tests = []
 
-    test = np.zeros((N_COALITION, M))
-    for i in range(N_COALITION):
+    test = np.zeros((game.n_coalition, game.m))
+    for i in range(game.n_coalition):
         if i < 2:
             test[i, 0] = 1
         else:
@@ -594,20 +836,27 @@ def test_disagreement_minimax():
             print('')
 
 
-def test_alpha():
-    predictions = []
-    alphas = np.linspace(0, 1, num=21)
-    for alpha in alphas:
-        print(alpha)
-        prediction = desire_borrowers_and_profit(alpha, 'test_alpha')
-        predictions.append(prediction)
-    predictions = np.array(predictions)
+def test_alpha(game=None, alphas=None, amortized=True):
+    # amortized trains one alpha-conditioned model and queries it for every alpha
+    alphas = np.linspace(0, 1, num=21) if alphas is None else np.asarray(alphas)
+    if amortized:
+        model, member = desire_borrowers_and_profit_alpha_conditioned(
+            'test_alpha_conditioned', game=game)
+        predictions = alpha_conditioned_predictions(model, alphas, member, game)
+    else:
+        predictions = []
+        for alpha in alphas:
+            print(alpha)
+            prediction = desire_borrowers_and_profit(alpha, 'test_alpha', game=game)
+            predictions.append(prediction)
+        predictions = np.array(predictions)
     with open('results/nn_alpha_predictions.npy', 'wb') as f:
         np.save(f, predictions)
 
 
-def test_alpha_post_process_aggregate():
-    alphas = np.linspace(0, 1, num=21)
+def test_alpha_post_process_aggregate(game=None, alphas=None):
+    game = game or CoalitionGame()
+    alphas = np.linspace(0, 1, num=21) if alphas is None else np.asarray(alphas)
     with open('results/nn_alpha_predictions.npy', 'rb') as f:
         predictions = np.load(f)
         deviations = []  # difference between true probs and actual reports
@@ -619,8 +868,8 @@ def test_alpha_post_process_aggregate():
         diff_in_collusive_report = []
         diff_in_collusive_report_stdev = []
         for prediction in predictions:
-            dev = [pred - np.tile(np.reshape(PROBS, [1, M]),
-                                  [N_COALITION, 1]) for pred in prediction]
+            dev = [pred - np.tile(np.reshape(game.probs, [1, game.m]),
+                                  [game.n_coalition, 1]) for pred in prediction]
             deviations.append(np.mean(dev))
             deviations_stdev.append(np.std(dev))
             collusive_dev = []
@@ -654,8 +903,9 @@ def test_alpha_post_process_aggregate():
                  'alpha', 'Average deviation', alphas, diff_in_collusive_report, diff_in_collusive_report_stdev)
 
 
-def test_alpha_post_process_per_borrower_old(savefile='results/nn_alpha_predictions.npy'):
-    alphas = np.linspace(0, 1, num=21)
+def test_alpha_post_process_per_borrower_old(savefile='results/nn_alpha_predictions.npy', game=None, alphas=None):
+    game = game or CoalitionGame()
+    alphas = np.linspace(0, 1, num=21) if alphas is None else np.asarray(alphas)
     with open(savefile, 'rb') as f:
         predictions = np.load(f)
         deviations = []  # difference between true probs and actual reports
@@ -664,8 +914,8 @@ def test_alpha_post_process_per_borrower_old(savefile='results/nn_alpha_predicti
         deviations_non_collusive_report = []
         diff_in_collusive_report = []
         for prediction in predictions:
-            dev = [pred - np.tile(np.reshape(PROBS, [1, M]),
-                                  [N_COALITION, 1]) for pred in prediction]
+            dev = [pred - np.tile(np.reshape(game.probs, [1, game.m]),
+                                  [game.n_coalition, 1]) for pred in prediction]
             deviations.append([np.mean(x) for x in dev])
             deviations_stdev.append([np.std(x) for x in dev])
             collusive_dev = []
@@ -693,19 +943,20 @@ def test_alpha_post_process_per_borrower_old(savefile='results/nn_alpha_predicti
                         'alpha', 'Average deviation', alphas, diff_in_collusive_report)
 
 
-def test_alpha_post_process_per_borrower(savefile='results/nn_alpha_predictions.npy'):
-    alphas = np.linspace(0, 1, num=21)
+def test_alpha_post_process_per_borrower(savefile='results/nn_alpha_predictions.npy', game=None, alphas=None):
+    game = game or CoalitionGame()
+    alphas = np.linspace(0, 1, num=21) if alphas is None else np.asarray(alphas)
     with open(savefile, 'rb') as f:
         predictions = np.load(f)
         collusive_reports = [
-            [[] for _ in range(len(alphas))] for _ in range(M)]
+            [[] for _ in range(len(alphas))] for _ in range(game.m)]
         non_collusive_reports = [
-            [[] for _ in range(len(alphas))] for _ in range(M)]
+            [[] for _ in range(len(alphas))] for _ in range(game.m)]
         for alpha_i, prediction in enumerate(predictions):
             for q, pred in enumerate(prediction):
                 # q is the preferred borrower
                 collusive_reports[q][alpha_i].extend(pred[:, q])
-                for q_prime in range(M):
+                for q_prime in range(game.m):
                     if q_prime != q:
                         non_collusive_reports[q_prime][alpha_i].extend(
                             pred[:, q_prime])
@@ -714,37 +965,37 @@ def test_alpha_post_process_per_borrower(savefile='results/nn_alpha_predictions.
         non_collusive_reports = np.mean(
             np.array(non_collusive_reports), axis=2)
 
-        for q in range(M):
-            plot = np.stack([collusive_reports[q], [PROBS_RAW[q] for _ in range(len(alphas))], [
-                            min_reports_to_get_loan(q, N_COALITION) for _ in range(len(alphas))]], axis=0)
+        for q in range(game.m):
+            plot = np.stack([collusive_reports[q], [game.probs[q] for _ in range(len(alphas))], [
+                            min_reports_to_get_loan(q, game.n_coalition, game) for _ in range(len(alphas))]], axis=0)
             save_fig_multiy(f'results/collusion_desired_alpha_borrower_{q+1}.png', 'Report on Desired Borrowers',
                             'alpha', f'Average report on preferred borrower {q+1}', alphas, plot, serieslabels=['Report', 'True probability', 'Min for loan'], legendtitle=None, speciallines=True)
 
-            plot = np.stack([non_collusive_reports[q], [PROBS_RAW[q] for _ in range(len(alphas))], [
-                            min_reports_to_get_loan(q, N_COALITION) for _ in range(len(alphas))]], axis=0)
+            plot = np.stack([non_collusive_reports[q], [game.probs[q] for _ in range(len(alphas))], [
+                            min_reports_to_get_loan(q, game.n_coalition, game) for _ in range(len(alphas))]], axis=0)
             save_fig_multiy(f'results/collusion_non_desired_alpha_borrower_{q+1}.png', 'Report on Non-Desired Borrowers',
                             'alpha', f'Average report on non-preferred borrower {q+1}', alphas, plot, serieslabels=['Report', 'True probability', 'Min for loan'], legendtitle=None, speciallines=True)
 
 
-def test_coalition_size():
-    global N_COALITION
-    save_n_coalition = N_COALITION
-    coalition_sizes = np.array([x + 1 for x in range(N_TOTAL)])
+def test_coalition_size(game=None):
+    game = game or CoalitionGame()
+    coalition_sizes = np.array([x + 1 for x in range(game.n_total)])
     predictions = []
     for size in coalition_sizes:
         print(size)
-        N_COALITION = size
-        prediction = desire_borrowers_and_profit(0.5, 'test_coalition_size')
+        # each size is its own game, so sizes could also be trained in parallel
+        prediction = desire_borrowers_and_profit(
+            0.5, 'test_coalition_size', game=replace(game, n_coalition=int(size)))
         predictions.append(prediction)
-    N_COALITION = save_n_coalition
     print(predictions)
     with open('results/nn_size_predictions.npz', 'wb') as f:
         # unpack predictions
         np.savez(f, *predictions)
 
 
-def test_coalition_size_post_process_old(savefile='results/nn_size_predictions.npz'):
-    coalition_sizes = np.array([x + 1 for x in range(N_TOTAL)])
+def test_coalition_size_post_process_old(savefile='results/nn_size_predictions.npz', game=None):
+    game = game or CoalitionGame()
+    coalition_sizes = np.array([x + 1 for x in range(game.n_total)])
     with open(savefile, 'rb') as f:
         npzfile = np.load(f)
         predictions = []
@@ -755,7 +1006,7 @@ def test_coalition_size_post_process_old(savefile='results/nn_size_predictions.n
         deviations_non_collusive_report = []
         diff_in_collusive_report = []
         for i, prediction in enumerate(predictions):
-            dev = [pred - np.tile(np.reshape(PROBS, [1, M]),
+            dev = [pred - np.tile(np.reshape(game.probs, [1, game.m]),
                                   [i+1, 1]) for pred in prediction]
             # coalition size is i+1
             deviations.append([np.mean(x) for x in dev])
@@ -784,22 +1035,23 @@ def test_coalition_size_post_process_old(savefile='results/nn_size_predictions.n
                         'Coalition size', 'Average deviation', coalition_sizes, diff_in_collusive_report)
 
 
-def test_coalition_size_post_process(savefile='results/nn_size_predictions.npz'):
-    coalition_sizes = np.array([x + 1 for x in range(N_TOTAL)])
+def test_coalition_size_post_process(savefile='results/nn_size_predictions.npz', game=None):
+    game = game or CoalitionGame()
+    coalition_sizes = np.array([x + 1 for x in range(game.n_total)])
     with open(savefile, 'rb') as f:
         npzfile = np.load(f)
         predictions = []
         for file in npzfile.files:
             predictions.append(npzfile[file])
         collusive_reports = [
-            [[] for _ in range(len(coalition_sizes))] for _ in range(M)]
+            [[] for _ in range(len(coalition_sizes))] for _ in range(game.m)]
         non_collusive_reports = [
-            [[] for _ in range(len(coalition_sizes))] for _ in range(M)]
+            [[] for _ in range(len(coalition_sizes))] for _ in range(game.m)]
         for coal_i, prediction in enumerate(predictions):
             for q, pred in enumerate(prediction):
                 # q is the preferred borrower
                 collusive_reports[q][coal_i].extend(pred[:, q])
-                for q_prime in range(M):
+                for q_prime in range(game.m):
                     if q_prime != q:
                         non_collusive_reports[q_prime][coal_i].extend(
                             pred[:, q_prime])
@@ -812,26 +1064,27 @@ def test_coalition_size_post_process(savefile='results/nn_size_predictions.npz')
         collusive_reports = np.array(collusive_reports)
         non_collusive_reports = np.array(non_collusive_reports)
 
-        for q in range(M):
-            plot = np.stack([collusive_reports[q], [PROBS_RAW[q] for _ in range(len(coalition_sizes))], [
-                            min_reports_to_get_loan(q, n_coalition+1) for n_coalition in range(len(coalition_sizes))]], axis=0)
+        for q in range(game.m):
+            plot = np.stack([collusive_reports[q], [game.probs[q] for _ in range(len(coalition_sizes))], [
+                            min_reports_to_get_loan(q, n_coalition+1, game) for n_coalition in range(len(coalition_sizes))]], axis=0)
             save_fig_multiy(f'results/collusion_size_desired_borrower_{q+1}.png', 'Report on Desired Borrowers',
                             'Coalition size', f'Average report on preferred borrower {q+1}', coalition_sizes, plot, serieslabels=['Report', 'True probability', 'Min for loan'], legendtitle=None, speciallines=True)
 
-            plot = np.stack([non_collusive_reports[q], [PROBS_RAW[q] for _ in range(len(coalition_sizes))], [
-                            min_reports_to_get_loan(q, n_coalition+1) for n_coalition in range(len(coalition_sizes))]], axis=0)
+            plot = np.stack([non_collusive_reports[q], [game.probs[q] for _ in range(len(coalition_sizes))], [
+                            min_reports_to_get_loan(q, n_coalition+1, game) for n_coalition in range(len(coalition_sizes))]], axis=0)
             save_fig_multiy(f'results/collusion_size_non_desired_borrower_{q+1}.png', 'Report on Non-Desired Borrowers',
                             'Coalition size', f'Average report on non-preferred borrower {q+1}', coalition_sizes, plot, serieslabels=['Report', 'True probability', 'Min for loan'], legendtitle=None, speciallines=True)
 
 
-def test_effects():
+def test_effects(game=None):
+    game = game or CoalitionGame()
     model = load_model('coalition_alpha_08', custom_objects={
-                       'desirability_and_profit_loss': mixed_loss(0.8)})
+                       'desirability_and_profit_loss': mixed_loss(0.8, game)})
     tests = []
-    for index in range(M):
-        test = np.zeros((1, M))
+    for index in range(game.m):
+        test = np.zeros((1, game.m))
         test[0, index] = 1
-        test = np.tile(test, [N_COALITION, 1])
+        test = np.tile(test, [game.n_coalition, 1])
         tests.append(test)
     predictions = model.predict(np.array(tests))
     predictions, _ = np.split(predictions, 2, axis=0)
@@ -858,9 +1111,9 @@ def save_fig(filename, title, xlabel, ylabel, x, y, err=None):
 
 def save_fig_multiy(filename, title, xlabel, ylabel, x, y, err=None, serieslabels=[i+1 for i in range(M)], legendtitle="Preferred borrower", speciallines=False):
     x = np.array(x)
-    y = np.hsplit(np.array(y), M) if not speciallines else np.split(y, 3)
+    y = np.hsplit(np.array(y), np.shape(y)[1]) if not speciallines else np.split(y, 3)
     if err:
-        err = np.hsplit(np.array(err), M)
+        err = np.hsplit(np.array(err), np.shape(err)[1])
         for yseries, errseries in zip(y, err):
             plt.errorbar(x, yseries.ravel(), errseries.ravel(), ecolor='black',
                          elinewidth=0.5, capsize=3, capthick=0.5)
@@ -878,21 +1131,17 @@ def save_fig_multiy(filename, title, xlabel, ylabel, x, y, err=None, serieslabel
     plt.close()
 
 
-def get_indices(n, k):
+def get_indices(n, k, rng=None):
+    '''k distinct indices in range(n), sorted'''
     assert k <= n
-    result = []
-    indices = [i for i in range(n)]
-    for _ in range(k):
-        selected = random.choice(indices)
-        indices.remove(selected)
-        result.append(selected)
-    return sorted(result)
+    return sorted(get_rng(rng).choice(n, k, replace=False).tolist())
 
 
-def min_reports_to_get_loan(q: int, n_coalition: int) -> float:
+def min_reports_to_get_loan(q: int, n_coalition: int, game=None) -> float:
     # this is the minimum avg report that coalition members have to average to get the borrower q a loan
+    game = game or CoalitionGame()
     return np.min([1.1, np.max([0.0,
-                                (N_TOTAL * THRESHOLD - (N_TOTAL - n_coalition) * PROBS_RAW[q]) / n_coalition])])
+                                (game.n_total * game.threshold - (game.n_total - n_coalition) * game.probs[q]) / n_coalition])])
 
 
 def main() -> None:
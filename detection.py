@@ -9,7 +9,6 @@ from tensorflow.keras.metrics import AUC
 from tensorflow.keras.models import load_model
 import matplotlib.pyplot as plt
 import numpy as np
-import random
 import scipy.stats as scipystats
 from sklearn.metrics import mean_squared_error
 from sklearn.model_selection import train_test_split
@@ -18,6 +17,7 @@ from sklearn.preprocessing import MinMaxScaler
 from statistics import NormalDist
 
 from coalition_winkler import mixed_loss
+from random_streams import get_rng
 
 
 auc = AUC()
@@ -37,7 +37,8 @@ class SingleRecommenderDataGenerator:
                  n_reports: int = 50,
                  belief_bias: float = 0,
                  belief_sd: float = 0.05,
-                 collusive_bias: float = 0.1
+                 collusive_bias: float = 0.1,
+                 rng=None                       # Generator, seed or None, see random_streams.get_rng
                  ) -> None:
         assert isinstance(alpha, int)
         assert isinstance(beta, int)
@@ -48,13 +49,14 @@ class SingleRecommenderDataGenerator:
         self.beta = beta
         self.n_reports = n_reports
         self.collusive_bias = collusive_bias
+        self.rng = get_rng(rng)
 
-        self.true_probs = np.random.beta(alpha, beta, n_reports)
+        self.true_probs = self.rng.beta(alpha, beta, n_reports)
         self.true_beliefs = np.clip(self.true_probs +
-                                    np.random.normal(
+                                    self.rng.normal(
                                         belief_bias, belief_sd, n_reports),
                                     0, 1)
-        self.outcomes = np.random.binomial(1, self.true_probs)
+        self.outcomes = self.rng.binomial(1, self.true_probs)
 
     def gen(self, type: ReportStrategy):
         '''returns outcomes and reports'''
@@ -77,6 +79,7 @@ class RecommenderDataGenerator:
                  belief_sd: float = 0.05,
                  collusive_bias: float = 0.1,
                  coalition_size: int = 1,
+                 rng=None,                      # Generator, seed or None, see random_streams.get_rng
                  ) -> None:
         self.alpha = alpha
         self.beta = beta
@@ -87,13 +90,14 @@ class RecommenderDataGenerator:
         self.m = m
         self.collusive_bias = collusive_bias
         self.coalition_size = coalition_size
+        self.rng = get_rng(rng)
 
-        self.true_probs = np.random.beta(alpha, beta, m)
+        self.true_probs = self.rng.beta(alpha, beta, m)
         self.true_beliefs = np.clip(np.tile(self.true_probs.transpose(), (self.n, 1)) +
-                                    np.random.normal(
+                                    self.rng.normal(
                                         belief_bias, belief_sd, (n, m)),
                                     0, 1)
-        self.outcomes = np.random.binomial(1, self.true_probs)
+        self.outcomes = self.rng.binomial(1, self.true_probs)
 
     def gen(self, type: ReportStrategy):
         '''returns outcomes and reports'''
@@ -102,8 +106,8 @@ class RecommenderDataGenerator:
         elif type == ReportStrategy.COLLUSIVE_ADV:
             assert self.n > 1
             assert self.m > 2
-            collusive_i = random.randint(0, self.n - 1)
-            collusive_js = random.randint(0, self.m - 1)
+            collusive_i = self.rng.integers(0, self.n)
+            collusive_js = self.rng.integers(0, self.m)
 
             reports = np.copy(self.true_beliefs)
             reports[collusive_i, :] = np.clip(reports[collusive_i, :] +
@@ -114,9 +118,9 @@ class RecommenderDataGenerator:
                                               0, 1)
             return self.outcomes, reports, collusive_i
         elif type == ReportStrategy.COLLUSIVE_FRAC:
-            collusive_j = random.randint(0, self.m - 1)
+            collusive_j = self.rng.integers(0, self.m)
             recommender_arr = [i for i in range(self.n)]
-            np.random.shuffle(recommender_arr)
+            self.rng.shuffle(recommender_arr)
             reports = np.copy(self.true_beliefs)
             for index in range(self.coalition_size):
                 i = recommender_arr[index]
@@ -373,7 +377,8 @@ def test_creditworthiness_coalition_size() -> None:
     plt.show()
 
 
-def test_learned_collusion():
+def test_learned_collusion(rng=None):
+    rng = get_rng(rng)
     model = load_model('coalition_alpha_08', custom_objects={
                        'desirability_and_profit_loss': mixed_loss(0.8)})
     N_TEST_CASES = 5000
@@ -381,18 +386,18 @@ def test_learned_collusion():
     N_TOTAL = 6
     M = 4
     PROBS = [0.43, 0.62, 0.70, 0.76]
-    tests = np.random.randint(0, 2, (N_TEST_CASES, N_COALITION, M))
+    tests = rng.integers(0, 2, (N_TEST_CASES, N_COALITION, M))
     predictions = model.predict(np.array(tests))
     predictions, _ = np.split(predictions, 2, axis=0)
     predictions = np.array([prediction[0] for prediction in predictions])
 
     true_reports = np.array([np.clip(np.tile(np.reshape(PROBS, (1, M)), (N_TOTAL - N_COALITION, 1)) +
-                                     np.random.normal(0, 0.1, (N_TOTAL - N_COALITION, M)), 0, 1) for _ in range(N_TEST_CASES)])
+                                     rng.normal(0, 0.1, (N_TOTAL - N_COALITION, M)), 0, 1) for _ in range(N_TEST_CASES)])
 
     X = []
     y = []
     for collusive_report, true_report in zip(predictions, true_reports):
-        rand_indices = get_indices(N_TOTAL, N_COALITION)
+        rand_indices = get_indices(N_TOTAL, N_COALITION, rng)
         for report, i in zip(collusive_report, rand_indices):
             true_report = np.insert(true_report, i, report, axis=0)
         yi = [float(i in rand_indices) for i in range(N_TOTAL)]
@@ -425,15 +430,10 @@ def test_learned_collusion():
     plt.show()
 
 
-def get_indices(n, k):
+def get_indices(n, k, rng=None):
+    '''k distinct indices in range(n), sorted'''
     assert k < n
-    result = []
-    indices = [i for i in range(n)]
-    for _ in range(k):
-        selected = random.choice(indices)
-        indices.remove(selected)
-        result.append(selected)
-    return sorted(result)
+    return sorted(get_rng(rng).choice(n, k, replace=False).tolist())
 
 
 def main() -> None:
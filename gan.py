@@ -21,7 +21,9 @@ from keras.utils.vis_utils import plot_model
 
 # from other files
 
-from coalition_winkler import mixed_loss
+from coalition_winkler import CoalitionGame, batch_spec, coalition_dataset, coalition_specs, \
+    mixed_loss, sample_preferences, sample_reports, sample_targets
+from random_streams import child, get_rng
 
 
 PRINT_COMMENTS = True
@@ -38,6 +40,7 @@ EPSILON = 0.001
 PROBS_RAW = [0.34, 0.41, 0.67, 0.81]
 assert len(PROBS_RAW) == M
 PROBS = tf.convert_to_tensor(PROBS_RAW)
+GAME = CoalitionGame(N_COALITION, N_TOTAL, M, tuple(PROBS_RAW), THRESHOLD, EPSILON)
 
 BATCH_SIZE = 32
 
@@ -114,38 +117,33 @@ def generate_and_save_data(generator, epoch, print_interval):
     return mean_reports, std_reports
 
 
-def main(epochs):
+def main(epochs, rng=None):
+    rng = get_rng(rng)
     generator = make_generator_model()
     discriminator = make_discriminator_model()
 
     generator_optimizer = Adam(3e-4, beta_1=0.95, epsilon=1e-8, amsgrad=True)
     discriminator_optimizer = Adam(2e-4, epsilon=1e-8, amsgrad=True)
 
-    @tf.function
-    def train_step():
-        indices = np.random.randint(0, M, BATCH_SIZE)
-        X = np.array([np.tile(np.reshape([float(j == index) for j in range(M)], (1, M)), (N_COALITION, 1))
-                      for _, index in enumerate(indices)])
-
-        y_outcomes = np.random.binomial(
-            1, PROBS, (BATCH_SIZE, M)).astype(np.float32)
-        y_noise = np.reshape(np.clip(np.random.normal(PROBS, NOISE,
-                                                      (BATCH_SIZE * (N_TOTAL - N_COALITION), M)),
-                                     EPSILON, 1-EPSILON),
-                             (BATCH_SIZE, (N_TOTAL - N_COALITION) * M))
-        y = np.concatenate([y_outcomes, y_noise], axis=1)
-
-        real_reports = np.reshape(np.clip(np.random.normal(PROBS, NOISE,
-                                                           (BATCH_SIZE * N_COALITION, M)),
-                                          EPSILON, 1-EPSILON),
-                                  (BATCH_SIZE, N_COALITION, M))
+    batch_rng = child(rng)  # used only by the pipeline's thread
+
+    def sample_gan_batch(batch_size):
+        # preferences, y for mixed_loss and honest reports for the discriminator
+        return sample_preferences('single', batch_size, GAME, batch_rng), \
+            sample_targets(batch_size, NOISE, GAME, batch_rng), \
+            sample_reports(batch_size, N_COALITION, NOISE, GAME, batch_rng)
 
+    # sampled on a background thread; fresh batches for every step
+    gan_batches = iter(coalition_dataset(sample_gan_batch,
+                                         (*coalition_specs(GAME), batch_spec(N_COALITION, M))))
+
+    @tf.function
+    def train_step(X, y, real_reports):
         with tf.GradientTape() as gen_tape, tf.GradientTape() as disc_tape:
             generated_reports = generator(X, training=True)
             generated_reports = tf.map_fn(
                 lambda x: x[0], generated_reports)
-            y = tf.cast(y, tf.float32)
-            utility_loss = mixed_loss(ALPHA)(
+            utility_loss = mixed_loss(ALPHA, GAME)(
                 y, generated_reports)
             generated_reports, _ = tf.split(generated_reports, 2, axis=0)
 
@@ -169,20 +167,13 @@ def main(epochs):
 
     def train(epochs):
         # train the generator first
-        indices = np.random.randint(0, M, BATCH_SIZE * 256)
-        X = np.array([np.tile(np.reshape([float(j == index) for j in range(M)], (1, M)), (N_COALITION, 1))
-                      for _, index in enumerate(indices)])
-
-        y_outcomes = np.random.binomial(
-            1, PROBS, (BATCH_SIZE * 256, M)).astype(np.float32)
-        y_noise = np.reshape(np.clip(np.random.normal(PROBS, NOISE,
-                                                      (BATCH_SIZE * 256 * (N_TOTAL - N_COALITION), M)),
-                                     EPSILON, 1-EPSILON),
-                             (BATCH_SIZE * 256, (N_TOTAL - N_COALITION) * M))
-        y = np.concatenate([y_outcomes, y_noise], axis=1)
-        generator.compile(loss=mixed_loss(ALPHA),
+        pretraining_rng = child(rng)  # used only by the pipeline's thread
+        pretraining_data = coalition_dataset(lambda batch_size: (
+            sample_preferences('single', batch_size, GAME, pretraining_rng),
+            sample_targets(batch_size, NOISE, GAME, pretraining_rng)), coalition_specs(GAME))
+        generator.compile(loss=mixed_loss(ALPHA, GAME),
                           optimizer=Adam(learning_rate=0.0015, epsilon=1e-8, amsgrad=True))
-        generator.fit(X, y, epochs=20, verbose=False)
+        generator.fit(pretraining_data, steps_per_epoch=256, epochs=20, verbose=False)
 
         discriminator_losses = []
         generator_losses = []
@@ -199,7 +190,7 @@ def main(epochs):
             gen_losses = []
             disc_losses = []
             for _ in range(128):
-                gen_loss, disc_loss = train_step()
+                gen_loss, disc_loss = train_step(*next(gan_batches))
                 gen_losses.append(gen_loss.numpy())
                 disc_losses.append(disc_loss.numpy())
             discriminator_losses.append(np.mean(disc_losses))
@@ -11,64 +11,108 @@ borrowers. The system then simulates the outcomes of different rating strategies
 for both recommenders and the principal in terms of repayments and recommender compensation
 '''
 
+from dataclasses import dataclass, replace
+
 import matplotlib.pyplot as plt
 import numpy as np
-from scipy.stats import beta
-from scipy.stats import rankdata
+from scipy.stats import norm
+
+from model import BatchedLendingModel, ElicitationStrategy, LendingModel, leave_one_out_scores
+from random_streams import StreamBatch, VariatePool, get_rng, stream
+
+
+STATISTICS = ('n_loans_made', 'n_repayments', 'mean_comp', 'std_comp', 'rec_comp_negative_pct') #statistics returned by run_rounds, in order
+
+@dataclass
+class SimulationConfig:
+    '''Parameters of a simulation. Defaults reproduce the original hard-coded experiment'''
+    n_recommenders: int = 5
+    n_borrowers: int = 6
+    budget: int = 4 #Maximum number of borrowers who can receive a loan
+    c: float = .6 #Lending threshold rating
+    mechanism: str = 'vcg_scoring' #'truncated_winkler', 'vcg_scoring', 'model_winkler', 'model_vcg'
+    base_rule: str = 'quadratic' #scoring rule behind 'truncated_winkler', any key of SCORING_RULES
+    n_rounds: int = 10
+    n_iterations: int = 5 #Run the simulation n_iterations times
+    use_weights: bool = True
+    weights_window: int = None #if set, weights only use the last weights_window rounds
+    weights_decay: float = None #if set, each earlier round's contributions are discounted by this factor
+    shift_a: float = .5 #The upward bias of each recommender is beta(shift_a, shift_b)
+    shift_b: float = 5
+    rec_accuracy_a_b: float = 10 #value to use as a and b in the beta distribution for each recommender's accuracy
+    #Honesty Parameters
+    honesty_type: str = 'collusion' #any key of HONESTY_TYPES: {'honest', 'random_misreports', 'misreports_select_recommenders', 'collusion', 'optimistic'}
+    rand_misreport_rate: float = .5 #fraction of reports which are misreports under 'random_misreports' honesty type
+    frac_misreports_1: float = .5 #fraction of misreports which are 1 in all honesty types. All misreports other than 1 are 0.
+    frac_dishonest_recommenders: float = .5 #fraction of recommenders who are dishonest in 'misreports_select_recommenders' and 'collusion' honesty types
+    frac_misreports_by_dishonest_recs: float = .5 #fraction of reports (or borrowers, under 'collusion') on which dishonest recommenders misreport
+    batched: bool = True #run_simulation advances all iterations together instead of one after another
+    chunk_size: int = None #batched iterations per chunk, all of them if None
+    seed: int = None #if set, iteration k draws from random_streams.stream(k, seed), so results do not depend on batching, chunk_size or how chunks are spread over workers
+    variate_block_size: int = None #if set, the round loop's beta and uniform draws are sliced from blocks of this many variates (random_streams.VariatePool)
+    variate_background: bool = False #generate the next variate blocks on background threads
+    verbose: bool = True #print round-by-round progress
 
 
 def main(n_recommenders, n_borrowers, budget, c):
     #inputs = recommenders, borrowers, budget, lending threshold c
     #This function simulates the truncated-winkler or 0-1 VCG for n_rounds rounds
+    return run_rounds(replace(SimulationConfig(), n_recommenders=n_recommenders,
+                              n_borrowers=n_borrowers, budget=budget, c=c))
+
+def run_rounds(config, batch_shape=(), rng=None, variates=None):
+    #This function simulates the mechanism in config for config.n_rounds rounds
+    #and returns one array per statistic, indexed by round. batch_shape runs that
+    #many independent simulations together as one array program; each statistic
+    #is then batch_shape + (n_rounds,). rng is the random stream, see random_streams.get_rng.
+    #variates is an open VariatePool shared across calls, see run_variates
+    return run_mechanisms(config, (config.mechanism,), batch_shape, rng, variates)[config.mechanism]
+
+def run_mechanisms(config, mechanisms, batch_shape=(), rng=None, variates=None):
+    #Like run_rounds, but every mechanism is run on the same repayment probabilities,
+    #beliefs, reports and outcome draws (common random numbers). Each mechanism keeps
+    #its own weights, since they depend on its lending history.
+    #Returns {mechanism: statistics as returned by run_rounds}
+    rng = get_rng(rng)
+    own_variates = variates is None and config.variate_block_size is not None #pool made (and closed) here
+    if variates is None: variates = variate_pool(config, rng) if own_variates else rng #source of the per-round beta and uniform draws
 
     #0 Parameters
+    n_recommenders = config.n_recommenders
+    n_borrowers = config.n_borrowers
     '''
     #2021 Feb recommender knowledge parameters
     alpha = .75 #This represents the quality of recommenders' knowledge of borrower repayment probability. Alpha is the weight of the true probabilities, and 1-alpha is the weight of random noise in recommender beliefs
     p = alpha*np.tile(repayment_probs, (n_recommenders, 1)) + \
             (1-alpha)*np.random.random((n_recommenders, n_borrowers)) #recommender beliefs - |N| x |M|
     '''
-    mechanism = 'vcg_scoring' #'truncated_winkler', 'vcg_scoring'
-    shift = beta.rvs(.5, 5, size=n_recommenders) #The upward bias of each recommender
-    rec_accuracy_a_b_vector = [10]*n_recommenders #value to use as a and b in the beta distribution for each recommender's accuracy. True belief will be trim(true_prob + skew + beta(a,b) - .5, 0, 1)
-    rec_accuracy_a_b_matrix = np.tile(rec_accuracy_a_b_vector,(n_borrowers,1)).T
-    n_rounds = 10
-    use_weights = True
+    shift = variates.beta(config.shift_a, config.shift_b, size=batch_shape + \
+                (n_recommenders,)) #The upward bias of each recommender
+    rec_accuracy_a_b = config.rec_accuracy_a_b #value to use as a and b in the beta distribution for each recommender's accuracy. True belief will be trim(true_prob + skew + beta(a,b) - .5, 0, 1)
+    n_rounds = config.n_rounds
+    use_weights = config.use_weights
 
     #0.1 Honesty Parameters
-    honesty_type = 'collusion' #{'honest', 'random_misreports', 'misreports_select_recommenders', 'collusion'}
-    rand_misreport_rate = .5 #fraction of reports which are misreports under 'random_misreports' honesty type
-    frac_misreports_1 = .5 #fraction of misreports which are 1 in all honesty types. All misreports other than 1 are 0.
-    frac_dishonest_recommenders = .5 #fraction of recommenders who are dishonest in 'misreports_select_recommenders' and 'collusion' honesty types
-    frac_misreports_by_dishonest_recs = .5 #In honesty type 'misreports_select_recommenders', the fraction of reports by dishonest recommenders which are misreports. In honesty type 'collusion', this is the fraction of all potential borrowers on whom dishonest recommenders misreport. Note this number is rounded down to the nearest integer number of borrowers.
-
-    if honesty_type in ['misreports_select_recommenders', 'collusion']: #Set which recommenders will be colluding in all rounds
-        rand_rec_ranks = rankdata(np.random.random(n_recommenders))
-        misreporting_recommenders = np.where(rand_rec_ranks <= n_recommenders*\
-                    frac_dishonest_recommenders, 1, np.zeros((1,n_recommenders)))[0] #vector with 1s for misreporting recommenders and 0 for honest recommenders
-        print('misreporting_recommenders: ', misreporting_recommenders)
+    misreport = HONESTY_TYPES[config.honesty_type]
+    misreporting_recommenders = select_misreporting_recommenders(n_recommenders, \
+                config.frac_dishonest_recommenders, batch_shape, rng) #Set which recommenders will be misreporting in all rounds
+    if config.verbose: print('misreporting_recommenders: ', misreporting_recommenders)
     #0.2 Setting Recommender Honesty
-    recommender_honesty = np.zeros(n_recommenders)
-    recommender_honesty = np.where(rankdata(np.random.random(n_recommenders)) \
-                        > frac_dishonest_recommenders*n_recommenders,\
+    recommender_honesty = np.where(random_ranks(batch_shape + (n_recommenders,), rng) \
+                        > config.frac_dishonest_recommenders*n_recommenders,\
                         1, 0) #1 for honest, 0 for dishonest
 
-    #0.3 Creating lists where round-by-round data will be stored
-    n_loans_made = []
-    n_repayments = []
-    mean_comp = []
-    std_comp = []
-    rec_comp_negative_pct = []
+    #0.3 Creating arrays where round-by-round data will be stored
+    #(n_loans_made, n_repayments, mean_comp, std_comp, rec_comp_negative_pct) per mechanism
+    results = {mechanism: tuple(np.zeros(batch_shape + (n_rounds,)) for _ in STATISTICS) \
+                for mechanism in mechanisms}
+
+    weight_estimators = {mechanism: BudescuChenWeights(n_recommenders, config.weights_window, \
+                        config.weights_decay, batch_shape) for mechanism in mechanisms}
 
     for i in range(n_rounds):
-        if use_weights == True and (i == 0 or np.sum(multi_round_lending_decisions) \
-                    == 0): weights = np.ones(n_recommenders)/n_recommenders #Use equal weights for all recommenders
-        elif use_weights == True: weights = \
-                        generate_weights(reports, multi_round_lending_decisions,\
-                        multi_round_outcomes, n_recommenders, n_borrowers)
-        print('Round: ', i, 'weights: ',np.round(weights,2))
         #1 Borrow Prob and Recommender Belief Creation
-        repayment_probs = beta.rvs(3,2, size=n_borrowers) #True repayment probability for each borrower
+        repayment_probs = variates.beta(3,2, size=batch_shape + (n_borrowers,)) #True repayment probability for each borrower
         '''
         print('repayment_probs',repayment_probs)
         print('n_recommenders',n_recommenders)
@@ -80,79 +124,36 @@ def main(n_recommenders, n_borrowers, budget, c):
         print('beta.rvs(rec_accuracy_a_b_matrix, rec_accuracy_a_b_matrix, size=(n_recommenders, n_borrowers))',\
                     beta.rvs(rec_accuracy_a_b_matrix, rec_accuracy_a_b_matrix, size=(n_recommenders, n_borrowers)))
         '''
-        p = np.tile(repayment_probs, (n_recommenders,1)) + np.tile(shift, \
-                            (n_borrowers,1)).T + beta.rvs(rec_accuracy_a_b_matrix, \
-                            rec_accuracy_a_b_matrix, size=(n_recommenders, \
-                            n_borrowers)) - .5
+        p = repayment_probs[..., np.newaxis, :] + shift[..., np.newaxis] + \
+                            variates.beta(rec_accuracy_a_b, rec_accuracy_a_b, \
+                            size=batch_shape + (n_recommenders, n_borrowers)) - .5
         p = np.clip(p,0,1) #ensures that no values lie outside of 0 and 1
 
         #2 Reporting / Misreporting Mechanism
-        p_hat = p.copy() #truthful reporting
-
-        if honesty_type == 'random_misreports':
-            #A random subset of all reports are set to 0 or 1
-            n_reports = n_recommenders * n_borrowers
-            rand_ranks = rankdata(np.random.random(p.shape)).reshape(p.shape)
-            p_hat = np.where(rand_ranks <= n_reports * rand_misreport_rate * \
-                     frac_misreports_1, 1, p_hat)
-            p_hat = np.where((rand_ranks > n_reports * rand_misreport_rate * \
-                     frac_misreports_1) & (rand_ranks <= \
-                     n_reports * rand_misreport_rate), 0, p_hat)
-
-        elif honesty_type == 'misreports_select_recommenders':
-            #A subset of recommenders each chooses a random set of borrowers on whom to missreport. The other recommenders are honest.
-            for j in range(n_recommenders):
-                if misreporting_recommenders[j] == 0.: continue #skip misreport setting for honest recommenders
-                rand_bor_ranks = rankdata(np.random.random(n_borrowers))
-                p_hat[j] = np.where(rand_bor_ranks <= n_borrowers*\
-                            frac_misreports_by_dishonest_recs \
-                            * frac_misreports_1, 1, p_hat[j])
-                p_hat[j] = np.where((rand_bor_ranks > n_borrowers*\
-                            frac_misreports_by_dishonest_recs \
-                            * frac_misreports_1) & (rand_bor_ranks <= \
-                            n_borrowers*frac_misreports_by_dishonest_recs), 0, p_hat[j])
-
-        elif honesty_type == 'collusion':
-            #A subset of recommenders together chooses a random set of borrowers on whom they will coordinate misreports. The other recommenders are honest.
-            #Note that "collusion" has no effect on whether borrowers repay.
-            rand_bor_ranks = rankdata(np.random.random(n_borrowers))
-            for j in range(n_borrowers):
-                if rand_bor_ranks[j] > n_borrowers*frac_misreports_by_dishonest_recs:\
-                            continue
-                if rand_bor_ranks[j] <= n_borrowers*frac_misreports_by_dishonest_recs*\
-                            frac_misreports_1:
-                    p_hat[:,j] = np.where(misreporting_recommenders == 1, 1, p_hat[:,j])
-                else:
-                    p_hat[:,j] = np.where(misreporting_recommenders == 1, 0, p_hat[:,j])
-
-        #3 Repayment and Recommender Compensation Calculation
-        if mechanism == 'truncated_winkler':
-                    expected_payout, actual_payout, lending_decisions, \
-                    repayment_outcomes = truncated_winkler(p, p_hat, \
-                    repayment_probs, c, weights)
-        elif mechanism == 'vcg_scoring':
-                    expected_payout, actual_payout, lending_decisions, \
-                    repayment_outcomes = vcg(p, p_hat, \
-                    repayment_probs, budget, c, weights)
-
-        #4 Data Calculation & Storage
-        if mechanism == 'truncated_winkler': comp_by_recommender = np.sum(actual_payout, axis=1)
-        else: comp_by_recommender = actual_payout
-        n_loans_made += [np.sum(lending_decisions)]
-        n_repayments += [np.sum(repayment_outcomes)]
-        mean_comp += [np.mean(comp_by_recommender)]
-        std_comp += [np.std(comp_by_recommender)]
-        rec_comp_negative_pct += [np.sum(np.where(comp_by_recommender < 0, 1,\
-                            0)) / p.shape[0]]
-        if i == 0 and use_weights == True:
-            reports = p_hat
-            multi_round_lending_decisions = lending_decisions
-            multi_round_outcomes = repayment_outcomes
-        elif i > 0 and use_weights == True:
-            reports = np.hstack((reports, p_hat))
-            multi_round_lending_decisions = np.hstack((multi_round_lending_decisions, \
-                        lending_decisions))
-            multi_round_outcomes = np.hstack((multi_round_outcomes,repayment_outcomes))
+        p_hat = misreport(p, misreporting_recommenders, config, rng)
+
+        outcome_draws = variates.random(batch_shape + (n_borrowers,)) #shared by all mechanisms
+
+        for mechanism in mechanisms:
+            if use_weights == True: weights = weight_estimators[mechanism].weights() #equal weights until a loan has been observed
+            else: weights = np.ones(batch_shape + (n_recommenders,))/n_recommenders
+            if config.verbose: print('Round: ', i, mechanism, 'weights: ',np.round(weights,2))
+
+            #3 Repayment and Recommender Compensation Calculation
+            comp_by_recommender, lending_decisions, repayment_outcomes = run_mechanism(\
+                        mechanism, p, p_hat, repayment_probs, weights, config, outcome_draws, rng)
+
+            #4 Data Calculation & Storage
+            n_loans_made, n_repayments, mean_comp, std_comp, rec_comp_negative_pct = \
+                        results[mechanism]
+            n_loans_made[..., i] = np.sum(lending_decisions, axis=-1)
+            n_repayments[..., i] = np.sum(repayment_outcomes, axis=-1)
+            mean_comp[..., i] = np.mean(comp_by_recommender, axis=-1)
+            std_comp[..., i] = np.std(comp_by_recommender, axis=-1)
+            rec_comp_negative_pct[..., i] = np.sum(np.where(comp_by_recommender < 0, 1,\
+                                0), axis=-1) / n_recommenders
+            if use_weights == True:
+                weight_estimators[mechanism].update(p_hat, lending_decisions, repayment_outcomes)
 
         #5 Printing
         '''
@@ -168,47 +169,297 @@ def main(n_recommenders, n_borrowers, budget, c):
         print('mean_rec_comp_std',np.mean(comp_by_recommender))
         print('rec_comp_negative_pct',rec_comp_negative_pct)
         '''
-    return np.asarray(n_loans_made), np.asarray(n_repayments), \
-                np.asarray(mean_comp), np.asarray(std_comp), \
-                np.asarray(rec_comp_negative_pct)
-
-def truncated_winkler(p, p_hat, repayment_probs, c, weights):
+    if own_variates: variates.close()
+    return results
+
+def run_mechanism(mechanism, p, p_hat, repayment_probs, weights, config, outcome_draws=None, rng=None):
+    #Runs one round of mechanism on (possibly batched) beliefs p and reports p_hat.
+    #Returns each recommender's compensation, the lending decisions and the repayment outcomes
+    if mechanism == 'truncated_winkler':
+        expected_payout, actual_payout, lending_decisions, \
+                    repayment_outcomes = truncated_winkler(p, p_hat, \
+                    repayment_probs, config.c, weights, config.base_rule, outcome_draws, rng)
+        return np.sum(actual_payout, axis=-1), lending_decisions, repayment_outcomes
+    elif mechanism == 'vcg_scoring':
+        expected_payout, actual_payout, lending_decisions, \
+                    repayment_outcomes = vcg(p, p_hat, \
+                    repayment_probs, config.budget, config.c, weights, config.verbose, \
+                    outcome_draws, rng)
+        return actual_payout, lending_decisions, repayment_outcomes
+    elif mechanism in ['model_winkler', 'model_vcg']:
+        #model.py's log-scoring Winkler or top-k VCG, one BatchedLendingModel scenario per simulation
+        batch_shape = p_hat.shape[:-2]
+        n_recommenders, n_borrowers = p_hat.shape[-2:]
+        k = int(np.prod(batch_shape))
+        model = BatchedLendingModel(k, n_recommenders, n_borrowers,
+                        true_probabilities=np.reshape(repayment_probs, (k, n_borrowers)),
+                        true_beliefs=np.reshape(p, (k, n_recommenders, n_borrowers)),
+                        reports=np.reshape(np.clip(p_hat, LendingModel.EPSILON, 1), \
+                                           (k, n_recommenders, n_borrowers)),
+                        threshold=config.c,
+                        weights=np.reshape(np.broadcast_to(weights, batch_shape + \
+                                           (n_recommenders,)), (k, n_recommenders)),
+                        liquidity=min(config.budget, n_borrowers),
+                        rng=rng)
+        model.elicit(ElicitationStrategy.WINKLER if mechanism == 'model_winkler' else \
+                    ElicitationStrategy.VCG, outcome_draws=None if outcome_draws is None \
+                    else np.reshape(outcome_draws, (k, n_borrowers))) #recommenders with zero weight score 0
+        comp_by_recommender = np.sum(model.outcome_payments, axis=-1) - model.immediate_payments
+        return np.reshape(comp_by_recommender, batch_shape + (n_recommenders,)), \
+                    np.reshape(model.allocation, batch_shape + (n_borrowers,)), \
+                    np.reshape(model.outcomes, batch_shape + (n_borrowers,))
+    assert False, 'run_mechanism(): Mechanism invalid'
+
+def run_simulation(config=None):
+    #Runs config.n_iterations independent simulations of config.n_rounds rounds each.
+    #Returns one (n_iterations, n_rounds) array per statistic returned by run_rounds
+    config = config or SimulationConfig()
+    results = tuple(np.zeros((config.n_iterations, config.n_rounds)) for _ in STATISTICS)
+    variates = run_variates(config)
+    try:
+        if config.batched:
+            chunk_size = config.chunk_size or config.n_iterations
+            for chunk, start in enumerate(range(0, config.n_iterations, chunk_size)):
+                for result, rounds in zip(results, run_chunk(config, chunk, variates)):
+                    result[start:start + chunk_size] = rounds
+            return results
+        for k in range(config.n_iterations):
+            if config.verbose: print('Iteration: ',k)
+            for result, rounds in zip(results, run_rounds(config, rng=iteration_rng(config, k), \
+                        variates=variates)):
+                result[k] = rounds
+        return results
+    finally:
+        if variates is not None: variates.close()
+
+def run_chunk(config, chunk, variates=None):
+    #Runs chunk number chunk of run_simulation's batched iterations. With config.seed
+    #set, a worker running any subset of the chunks gets the same results for them
+    #as run_simulation does. variates is a pool shared by the chunks, see run_variates
+    chunk_size = config.chunk_size or config.n_iterations
+    iterations = range(chunk * chunk_size, min((chunk + 1) * chunk_size, config.n_iterations))
+    return run_rounds(config, (len(iterations),), iteration_rng(config, iterations), variates)
+
+def iteration_rng(config, iterations):
+    #Random stream of iterations, a range of iteration numbers (batched) or a single one.
+    #Under config.seed, iteration k draws from stream(k, seed) whichever batch or chunk
+    #it runs in; else the default stream
+    if config.seed is None: return get_rng()
+    if isinstance(iterations, range): return StreamBatch(stream(k, config.seed) for k in iterations)
+    return stream(iterations, config.seed)
+
+def run_variates(config):
+    #VariatePool shared by every batch of an unseeded run, so its blocks and background
+    #threads are made once per run; None if the run needs none. Seeded runs draw each
+    #iteration from its own pool instead, which lives as long as the iteration's batch
+    if config.variate_block_size is None or config.seed is not None: return None
+    return variate_pool(config, get_rng())
+
+def variate_pool(config, rng):
+    #VariatePool drawing from rng, one per iteration if rng is a StreamBatch
+    if isinstance(rng, StreamBatch):
+        return StreamBatch(variate_pool(config, source) for source in rng.sources)
+    return VariatePool(rng, config.variate_block_size, config.variate_background)
+
+def compare_mechanisms(config=None, mechanisms=('truncated_winkler', 'vcg_scoring')):
+    #Runs config.n_iterations simulations of every mechanism on common random numbers
+    #and returns (results, differences): results maps each mechanism to its
+    #(n_iterations, n_rounds) statistics, and differences maps each mechanism after
+    #the first to paired_differences against the first
+    config = config or SimulationConfig()
+    results = run_mechanisms(config, mechanisms, (config.n_iterations,), \
+                iteration_rng(config, range(config.n_iterations)))
+    differences = {mechanism: paired_differences(results[mechanism], results[mechanisms[0]]) \
+                for mechanism in mechanisms[1:]}
+    return results, differences
+
+def paired_differences(results, baseline_results):
+    #Per statistic, the mean over iterations of results - baseline_results (each
+    #iteration averaged over rounds) and its standard error. Iterations that share
+    #random numbers cancel most of the noise the two mechanisms have in common
+    differences = {}
+    for name, result, baseline in zip(STATISTICS, results, baseline_results):
+        paired = np.nanmean(result - baseline, axis=-1)
+        differences[name] = (np.mean(paired), np.std(paired, ddof=1) / np.sqrt(len(paired)))
+    return differences
+
+def print_comparison(differences, baseline):
+    #Prints compare_mechanisms' paired differences with 95% confidence half-widths
+    for mechanism, stats in differences.items():
+        print(mechanism, '-', baseline)
+        for name, (mean, standard_error) in stats.items():
+            print('   ', name, np.round(mean, 3), '+/-', np.round(1.96*standard_error, 3))
+
+#Per-iteration metrics for sequential stopping, each mapping run_rounds statistics to one value per iteration
+ITERATION_METRICS = {
+    'n_loans': lambda results: np.mean(results[0], axis=-1),
+    'repayment_rate': lambda results: np.sum(results[1], axis=-1) / np.sum(results[0], axis=-1), #nan for iterations without loans, which are skipped
+    'mean_comp': lambda results: np.mean(results[2], axis=-1),
+    'rec_comp_vol': lambda results: np.nanmean(results[3], axis=-1),
+    'rec_comp_negative_pct': lambda results: np.mean(results[4], axis=-1)}
+
+class RunningStats:
+    '''Streaming mean and variance (Welford), updated a batch of values at a time
+    with the parallel merge of Chan et al., so memory does not grow with the sample'''
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0. #sum of squared deviations from the mean
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if values.size == 0: return
+        batch_mean = np.mean(values)
+        batch_m2 = np.sum((values - batch_mean)**2)
+        count = self.count + values.size
+        delta = batch_mean - self.mean
+        self.mean += delta * values.size / count
+        self.m2 += batch_m2 + delta**2 * self.count * values.size / count
+        self.count = count
+
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else np.inf
+
+    def half_width(self, confidence=.95):
+        #half-width of the normal confidence interval for the mean
+        return norm.ppf(.5 + confidence/2) * np.sqrt(self.variance() / max(self.count, 1))
+
+def run_until_precise(config=None, targets=None, confidence=.95, max_iterations=10**5):
+    #Runs batches of config.n_iterations simulations until the confidence interval
+    #half-width of every metric in targets ({ITERATION_METRICS key: half-width}) is
+    #at most its target, or max_iterations have run. Returns {metric: RunningStats}
+    config = config or SimulationConfig()
+    targets = targets or {'repayment_rate': .01, 'mean_comp': .01, 'rec_comp_negative_pct': .01}
+    stats = {metric: RunningStats() for metric in ITERATION_METRICS}
+    n_iterations = 0
+    variates = run_variates(config)
+    try:
+        while n_iterations < max_iterations:
+            batch_size = min(config.n_iterations, max_iterations - n_iterations)
+            results = run_rounds(config, (batch_size,), iteration_rng(config, \
+                        range(n_iterations, n_iterations + batch_size)), variates)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                for metric, running_stats in stats.items():
+                    running_stats.update(ITERATION_METRICS[metric](results))
+            n_iterations += batch_size
+            if config.verbose: print('Iterations: ', n_iterations)
+            if all(stats[metric].half_width(confidence) <= target for metric, target \
+                        in targets.items()):
+                break
+    finally:
+        if variates is not None: variates.close()
+    return stats
+
+def print_precision(stats, confidence=.95):
+    #Prints run_until_precise's metrics with their confidence half-widths
+    for metric, running_stats in stats.items():
+        print(metric, np.round(running_stats.mean, 3), '+/-', \
+                    np.round(running_stats.half_width(confidence), 3), '( n =', running_stats.count, ')')
+
+def print_summary(results):
+    #Prints the statistics of run_simulation averaged over iterations and rounds
+    n_loans_array, n_repayments_array, mean_recommender_comp_array,\
+                rec_comp_vol_array, rec_comp_negative_pct_array = results
+    print('n_loans',np.round(np.mean(n_loans_array),2))
+    print('repayment_rate',np.round(np.sum(n_repayments_array) / np.sum(n_loans_array),2))
+    print('mean_recommender_comp',np.round(np.mean(mean_recommender_comp_array),2))
+    print('rec_comp_vol',np.round(np.nanmean(rec_comp_vol_array),2))
+    print('rec_comp_negative_pct',np.round(np.mean(rec_comp_negative_pct_array),2))
+
+def random_ranks(shape, rng=None):
+    #Ranks 1..shape[-1] of uniform draws along the last axis, i.e. an independent
+    #random permutation for every other index. Same as rankdata on each row
+    return np.argsort(np.argsort(get_rng(rng).random(shape), axis=-1), axis=-1) + 1
+
+def select_misreporting_recommenders(n_recommenders, frac_dishonest_recommenders, batch_shape=(), rng=None):
+    #vector (batch_shape + (n_recommenders,)) with 1s for misreporting recommenders and 0 for honest recommenders
+    return np.where(random_ranks(batch_shape + (n_recommenders,), rng) <= n_recommenders*\
+                frac_dishonest_recommenders, 1., 0.)
+
+def set_misreports(p, ranks, n_misreports, frac_misreports_1):
+    #Reports whose rank is at most n_misreports become misreports: the first
+    #frac_misreports_1 of them are 1, the rest 0. ranks broadcasts against p
+    return np.where(ranks <= n_misreports*frac_misreports_1, 1, np.where(ranks <= \
+                n_misreports, 0, p))
+
+#Misreporting strategies. Each maps beliefs p (..., n_recommenders, n_borrowers) to
+#reports, given misreporting_recommenders (..., n_recommenders), a SimulationConfig and
+#a random stream. Leading dimensions batch independent iterations.
+def honest_reports(p, misreporting_recommenders, config, rng=None):
+    #truthful reporting
+    return p.copy()
+
+def random_misreports(p, misreporting_recommenders, config, rng=None):
+    #A random subset of all reports are set to 0 or 1
+    n_reports = p.shape[-2] * p.shape[-1]
+    ranks = random_ranks(p.shape[:-2] + (n_reports,), rng).reshape(p.shape)
+    return set_misreports(p, ranks, n_reports * config.rand_misreport_rate, \
+                config.frac_misreports_1)
+
+def select_recommenders_misreports(p, misreporting_recommenders, config, rng=None):
+    #A subset of recommenders each chooses a random set of borrowers on whom to missreport. The other recommenders are honest.
+    ranks = random_ranks(p.shape, rng) #one borrower permutation per recommender
+    p_hat = set_misreports(p, ranks, p.shape[-1] * config.frac_misreports_by_dishonest_recs, \
+                config.frac_misreports_1)
+    return np.where(misreporting_recommenders[..., np.newaxis] == 1, p_hat, p)
+
+def collusion_misreports(p, misreporting_recommenders, config, rng=None):
+    #A subset of recommenders together chooses a random set of borrowers on whom they will coordinate misreports. The other recommenders are honest.
+    #Note that "collusion" has no effect on whether borrowers repay.
+    ranks = random_ranks(p.shape[:-2] + (1, p.shape[-1]), rng) #one borrower permutation shared by all recommenders
+    p_hat = set_misreports(p, ranks, p.shape[-1] * config.frac_misreports_by_dishonest_recs, \
+                config.frac_misreports_1)
+    return np.where(misreporting_recommenders[..., np.newaxis] == 1, p_hat, p)
+
+def optimistic_misreports(p, misreporting_recommenders, config, rng=None):
+    #Misreporting recommenders report 1 on every borrower. The other recommenders are honest.
+    return np.where(misreporting_recommenders[..., np.newaxis] == 1, 1., p)
+
+HONESTY_TYPES = {'honest': honest_reports,
+                 'random_misreports': random_misreports,
+                 'misreports_select_recommenders': select_recommenders_misreports,
+                 'collusion': collusion_misreports,
+                 'optimistic': optimistic_misreports}
+
+def truncated_winkler(p, p_hat, repayment_probs, c, weights, base_rule='quadratic', outcome_draws=None, rng=None):
     #This function runs the truncated winkler scoring system with the given parameters
-    base_rule = 'quadratic' #logarithmic option not yet programmed up.
+    #base_rule is any key of SCORING_RULES. All arrays may carry the same leading
+    #batch dimensions: p and p_hat (..., n, m), repayment_probs (..., m), weights (..., n)
+    #outcome_draws (..., m) are uniforms in [0,1) to use instead of fresh ones from rng for repayment outcomes
+    weights = np.asarray(weights)
     #0 Lending Decisions
     #print('repayment_probs',repayment_probs)
 
     #lending_decisions = np.where(p_hat.sum(axis=0) > c*p.shape[0], 1, 0) #w/o weights
-    lending_decisions = np.where(np.matmul(weights.T, p_hat) > c, 1, 0)
+    aggregated_reports = np.matmul(weights[..., np.newaxis, :], p_hat)[..., 0, :]
+    lending_decisions = np.where(aggregated_reports > c, 1, 0)
     #print('lending_decisions',lending_decisions)
 
     #1.0 Calculate Thresholds ciq
-    ciq = np.zeros(p.shape) #matrix of lending thresholds by recommender / borrower combo
-    for i in range(p.shape[0]): #index over recommenders
-        #ciq[i,:] = p.shape[0] * c - (p_hat.sum(axis=0) - p_hat[i]) #w/o weights
-        if weights[i] < 10**-6: ciq[i,:] = np.ones(p.shape[1]) #this person has no weight and will not be able to decide who gets a loan.
-        else:
-            ciq[i,:] = (c - np.matmul(weights.T, p_hat) + weights[i]*p_hat[i,:])/weights[i]
+    #ciq = p.shape[0] * c - (p_hat.sum(axis=0) - p_hat) #w/o weights
+    w = weights[..., np.newaxis]
+    no_weight = w < 10**-6 #these recommenders have no weight and will not be able to decide who gets a loan.
+    ciq = np.where(no_weight, 1, (c - aggregated_reports[..., np.newaxis, :] + \
+                w*p_hat) / np.where(no_weight, 1, w)) #matrix of lending thresholds by recommender / borrower combo
     ciq = np.clip(ciq, 0.01, .99)
     #print('ciq',ciq)
 
     #1.5 Calculate expected scores for each recommender and borrower
-    if base_rule == 'quadratic':
-        scores_repay, scores_default = winkler_quadratic_scores(p_hat, ciq,\
-                        lending_decisions)
+    scores_repay, scores_default = winkler_scores(p_hat, ciq, lending_decisions, \
+                    base_rule)
     expected_payout = np.multiply(scores_repay, p) + np.multiply(\
                         scores_default, (1-p))
 
     #2 Repayment outcomes
-    repayment_outcomes = np.multiply(np.where(np.random.random(\
-                lending_decisions.shape) > (1-repayment_probs), 1, 0),\
+    if outcome_draws is None: outcome_draws = get_rng(rng).random(lending_decisions.shape)
+    repayment_outcomes = np.multiply(np.where(outcome_draws > (1-repayment_probs), 1, 0),\
                 lending_decisions)
-    actual_payout = np.multiply(scores_repay, repayment_outcomes) + \
-                np.multiply(scores_default, (1-repayment_outcomes)) #payouts when all recommenders have weight 1
-    actual_payout = np.multiply(actual_payout, \
-                np.asarray(weights).reshape((len(weights),1))) #payouts scaled by recommender weight
+    actual_payout = np.multiply(scores_repay, repayment_outcomes[..., np.newaxis, :]) + \
+                np.multiply(scores_default, (1-repayment_outcomes[..., np.newaxis, :])) #payouts when all recommenders have weight 1
+    actual_payout = np.multiply(actual_payout, w) #payouts scaled by recommender weight
 
-    if np.abs(np.sum(actual_payout)) > 10**5: #Loop to check into extreme value problems
+    if np.max(np.abs(np.sum(actual_payout, axis=(-2,-1)))) > 10**5: #Loop to check into extreme value problems, per simulation
         print('weights',weights)
         print('p_hat',p_hat)
         print('lending_decisions',lending_decisions)
@@ -223,85 +474,93 @@ def truncated_winkler(p, p_hat, repayment_probs, c, weights):
 
     return expected_payout, actual_payout, lending_decisions, repayment_outcomes
 
-def winkler_quadratic_scores(p_hat, ciq, lending_decisions):
-    #Returns matrices of payouts in the case of repayment or default. 0 where
-    #loans not made. Assumes all recommenders have weight 1 (we weight when calculating actual payout)
-    denominator = 2 - 4*ciq + 2 * ciq*ciq
-    scores_repay = (2*p_hat - p_hat*p_hat - (1-p_hat)*(1-p_hat) - 2*ciq + \
-                    ciq*ciq + (1-ciq)*(1-ciq)) / denominator
-    scores_default = (2*(1-p_hat) - p_hat*p_hat - (1-p_hat)*(1-p_hat) - \
-                      2*(1-ciq) + ciq*ciq + (1-ciq)*(1-ciq)) / denominator
-
-    if np.max(scores_repay) > 10**5 or np.min(scores_repay) < -10**4: #Loop to check into extreme value problems
-        print('p_hat',p_hat)
-        print('ciq',ciq)
-        print('denominator',denominator)
-        print('scores_repay',scores_repay)
-        print('scores_default',scores_default)
-        exit()
-
+def quadratic_score(p, o):
+    #Quadratic (Brier) score of forecast p when the outcome o \in {0,1} occurs
+    return 2*(p*o + (1-p)*(1-o)) - p*p - (1-p)*(1-p)
+
+def logarithmic_score(p, o):
+    #Logarithmic score of forecast p when the outcome o \in {0,1} occurs. Forecasts
+    #are kept off 0 and 1 so that misreports of exactly 0 or 1 stay finite
+    p = np.clip(p, 10**-6, 1 - 10**-6)
+    return o*np.log(p) + (1-o)*np.log(1-p)
+
+def spherical_score(p, o):
+    #Spherical score of forecast p when the outcome o \in {0,1} occurs
+    return (p*o + (1-p)*(1-o)) / np.sqrt(p*p + (1-p)*(1-p))
+
+SCORING_RULES = {'quadratic': quadratic_score,
+                 'logarithmic': logarithmic_score,
+                 'spherical': spherical_score}
+
+def winkler_scores(p_hat, ciq, lending_decisions, base_rule='quadratic'):
+    #Returns matrices of Winkler-normalized payouts in the case of repayment or default
+    #under base_rule, (S(p_hat,o) - S(ciq,o)) / (S(1,1) - S(ciq,1)). 0 where loans not
+    #made. Assumes all recommenders have weight 1 (we weight when calculating actual payout)
+    #Broadcasts over leading batch dimensions: lending_decisions is (..., m)
+    score = SCORING_RULES[base_rule]
+    denominator = score(1., 1) - score(ciq, 1)
+    scores_repay = (score(p_hat, 1) - score(ciq, 1)) / denominator
+    scores_default = (score(p_hat, 0) - score(ciq, 0)) / denominator
+    lending_decisions = lending_decisions[..., np.newaxis, :]
     return lending_decisions*scores_repay, lending_decisions*scores_default
 
 
-def vcg(p, p_hat, repayment_probs, budget, c, weights):
+def vcg(p, p_hat, repayment_probs, budget, c, weights, verbose=True, outcome_draws=None, rng=None):
     #This function runs the VCG scoring mechanism with a reserve
+    #All arrays may carry the same leading batch dimensions: p and p_hat (..., n, m),
+    #repayment_probs (..., m), weights (..., n)
+    #outcome_draws (..., m) are uniforms in [0,1) to use instead of fresh ones from rng for repayment outcomes
     #0 Setup
-    n_recommenders = p.shape[0]
-    n_borrowers = p.shape[1]
+    batch_shape = p_hat.shape[:-2]
+    n_recommenders = p.shape[-2]
+    n_borrowers = p.shape[-1]
+    weights = np.asarray(weights)
     #augment p_hat with reserve borrowers and reserve recommender
-    p_hat = np.vstack((p_hat, np.zeros((1,n_borrowers))))
+    p_hat = np.concatenate((p_hat, np.zeros(batch_shape + (1,n_borrowers))), axis=-2)
     tmp_array = np.vstack((np.zeros((n_recommenders,budget)), np.full((1,budget),\
                     c)))
-    p_hat = np.hstack((p_hat, tmp_array))
-    weights_aug = np.hstack((weights,np.asarray([1])))
+    p_hat = np.concatenate((p_hat, np.broadcast_to(tmp_array, batch_shape + \
+                    tmp_array.shape)), axis=-1)
+    weights_aug = np.concatenate((weights, np.ones(batch_shape + (1,))), axis=-1)
 
     #1 Lending decisions
     #sums = np.sum(p_hat, axis = 0) #w/o weights
-    sums = np.matmul(weights_aug, p_hat)
-    sums.sort()
-    threshold = sums[-budget]
-    sums = np.matmul(weights_aug, p_hat)
-    lending_decisions = np.where(sums[:n_borrowers] >= threshold, 1, 0) #Will not allocate any reserve borrowers yet
-    lending_decisions = np.hstack((lending_decisions, np.zeros((budget,))))
-
-    if np.sum(lending_decisions) < budget: #allocates just enough reserve borrowers to fill the budget quota
-        lending_decisions[n_borrowers: int(n_borrowers + budget - \
-                    np.sum(lending_decisions))] = 1
+    sums = np.matmul(weights_aug[..., np.newaxis, :], p_hat)[..., 0, :]
+    threshold = np.partition(sums, -budget, axis=-1)[..., -budget]
+    lending_decisions = np.where(sums[..., :n_borrowers] >= threshold[..., np.newaxis], \
+                1, 0) #Will not allocate any reserve borrowers yet
+    n_reserve = budget - np.sum(lending_decisions, axis=-1) #allocates just enough reserve borrowers to fill the budget quota
+    lending_decisions = np.concatenate((lending_decisions, np.where(np.arange(budget) < \
+                n_reserve[..., np.newaxis], 1, 0)), axis=-1)
 
     #2 Expected Score
-    payments = np.zeros(n_recommenders)
-    expected_payout = np.zeros(n_recommenders)
-
-    for j in range(n_recommenders): #loop over borrowers to calculate payment t and expected score
-        p_hat_less_j = np.delete(p_hat, j, 0)
-        weights_aug_less_j = np.delete(weights_aug, j)
-        sums_j = np.matmul(weights_aug_less_j, p_hat_less_j)
-        sums_j.sort()
-        threshold = sums_j[-budget]
-        sums_j = np.matmul(weights_aug_less_j, p_hat_less_j)
-        lending_decisions_j = np.where(sums_j[:n_borrowers] >= threshold, 1, 0) #Will not allocate any reserve borrowers yet
-        lending_decisions_j = np.hstack((lending_decisions_j, np.zeros((budget,))))
-        if np.sum(lending_decisions_j) < budget: #allocates just enough reserve borrowers to fill the budget quota
-            lending_decisions_j[n_borrowers: int(n_borrowers + budget - \
-                             np.sum(lending_decisions_j))] = 1
-        payments[j] = np.sum(np.multiply(sums_j, lending_decisions_j)) - \
-                    np.sum(np.multiply(sums_j, lending_decisions)) #value to everyone else without i present - value to everyone else with i present
-        expected_payout[j] = np.sum(np.multiply(p[j,:],\
-                    lending_decisions[:n_borrowers]))*weights[j] - payments[j] #This is the expected payout from the recommender's perspective, assuming his/her beliefs are true
+    #Removing recommender j only shifts each sum by weights[j]*p_hat[j], so all
+    #leave-one-out sums come from one (n_recommenders, n_borrowers + budget) pass
+    sums_less_j = leave_one_out_scores(weights_aug, p_hat)[..., :n_recommenders, :]
+    thresholds = np.partition(sums_less_j, -budget, axis=-1)[..., -budget] #budget-th largest sum for each j
+    lending_decisions_j = np.where(sums_less_j[..., :n_borrowers] >= \
+                thresholds[..., np.newaxis], 1, 0) #Will not allocate any reserve borrowers yet
+    n_reserve_j = budget - np.sum(lending_decisions_j, axis=-1) #allocates just enough reserve borrowers to fill the budget quota
+    lending_decisions_j = np.concatenate((lending_decisions_j, np.where(np.arange(budget) < \
+                n_reserve_j[..., np.newaxis], 1, 0)), axis=-1)
+    payments = np.sum(np.multiply(sums_less_j, lending_decisions_j), axis=-1) - \
+                np.matmul(sums_less_j, lending_decisions[..., np.newaxis])[..., 0] #value to everyone else without i present - value to everyone else with i present
+    lending_decisions = lending_decisions[..., :n_borrowers]
+    expected_payout = np.matmul(p, lending_decisions[..., np.newaxis])[..., 0]*weights - \
+                payments #This is the expected payout from the recommender's perspective, assuming his/her beliefs are true
 
     #print('payments t:', np.round(payments,2))
     #print('expected_payout', np.round(expected_payout,2))
     #3 Repayment Outcomes
-    repayment_outcomes = np.multiply(np.where(np.random.random(\
-                n_borrowers) > (1-repayment_probs), 1, 0),\
-                lending_decisions[:n_borrowers])
-    actual_payout = np.sum(repayment_outcomes)*weights - payments
+    if outcome_draws is None: outcome_draws = get_rng(rng).random(batch_shape + (n_borrowers,))
+    repayment_outcomes = np.multiply(np.where(outcome_draws > (1-repayment_probs), 1, 0),\
+                lending_decisions)
+    actual_payout = np.sum(repayment_outcomes, axis=-1, keepdims=True)*weights - payments
     #actual_payout = np.sum(repayment_outcomes) - payments
     #print('repayment_outcomes', repayment_outcomes)
-    print('actual_payout',np.round(actual_payout,2))
+    if verbose: print('actual_payout',np.round(actual_payout,2))
 
-    return expected_payout, actual_payout, lending_decisions[:n_borrowers],\
-                repayment_outcomes
+    return expected_payout, actual_payout, lending_decisions, repayment_outcomes
 
 def generate_weights(reports, multi_round_lending_decisions,
                      multi_round_outcomes, n_recommenders, n_borrowers):
@@ -317,19 +576,10 @@ def generate_weights(reports, multi_round_lending_decisions,
     print('n_recommenders',n_recommenders)
     print('n_borrowers',n_borrowers)
     '''
-    mean_recommender_contributions = np.zeros(n_recommenders)
-    aggregated_reports = np.sum(reports, axis=0) / n_recommenders #simple average of reports; we could use weighted reports
-    group_scores = brier(aggregated_reports, multi_round_outcomes) #includes an outcome of 0 for borrowers who did not receive a loan
-    mean_group_score = np.matmul(group_scores, multi_round_lending_decisions.T) \
-                / np.sum(multi_round_lending_decisions)
-    for i in range(n_recommenders):
-        agg_reports_without_recommender = (np.sum(reports, axis=0) - reports[i,:])\
-                    / (n_recommenders - 1)
-        scores_without_recommender = brier(agg_reports_without_recommender, \
-                    multi_round_outcomes)
-        mean_recommender_contributions[i] = mean_group_score - \
-                    np.matmul(scores_without_recommender, multi_round_lending_decisions.T) \
-                / np.sum(multi_round_lending_decisions)
+    recommender_contributions, group_score = brier_contributions(reports, \
+                multi_round_lending_decisions, multi_round_outcomes)
+    mean_recommender_contributions = recommender_contributions / \
+                np.sum(multi_round_lending_decisions)
     positive_contributions = np.clip(mean_recommender_contributions, 0, 10**6)
     if np.sum(positive_contributions) > 0: #case where at least one person has made a postiive contribution
         weights = positive_contributions / np.sum(positive_contributions)
@@ -339,6 +589,76 @@ def generate_weights(reports, multi_round_lending_decisions,
     #print('weights',weights)
     return weights
 
+class BudescuChenWeights:
+    '''Budescu & Chen weights maintained round by round.
+    Equivalent to generate_weights over the full history, but keeps running sums
+    of each recommender's leave-one-out contributions, so each update costs
+    O(n_recommenders * n_borrowers) regardless of how many rounds have been seen.
+    window keeps only the last window rounds (in a ring buffer); decay instead
+    discounts earlier rounds geometrically. At most one of them may be set.
+    batch_shape keeps independent weights for that many simulations at once.
+    '''
+    def __init__(self, n_recommenders, window=None, decay=None, batch_shape=()):
+        assert window is None or decay is None, 'BudescuChenWeights(): Set at most one of window and decay'
+        assert window is None or window > 0, 'BudescuChenWeights(): window must be positive'
+        assert decay is None or 0 < decay <= 1, 'BudescuChenWeights(): decay must be in (0, 1]'
+        self.n_recommenders = n_recommenders
+        self.window = window
+        self.decay = decay
+        self.contribution_sums = np.zeros(batch_shape + (n_recommenders,)) #sum over loans of group score - score without recommender
+        self.n_loans = np.zeros(batch_shape) #number of loans the sums run over
+        self.n_rounds = 0
+        if window is not None:
+            self.round_contributions = np.zeros((window,) + batch_shape + (n_recommenders,))
+            self.round_loans = np.zeros((window,) + batch_shape)
+
+    def update(self, reports, lending_decisions, outcomes):
+        #Adds one round: reports is n_recommenders by n_borrowers, lending_decisions
+        #and outcomes are 1 by n_borrowers, all behind batch_shape
+        contributions, _ = brier_contributions(reports, lending_decisions, outcomes)
+        loans = np.sum(lending_decisions, axis=-1)
+
+        if self.window is not None:
+            slot = self.n_rounds % self.window #overwrite the oldest round once the buffer is full
+            self.contribution_sums += contributions - self.round_contributions[slot]
+            self.n_loans += loans - self.round_loans[slot]
+            self.round_contributions[slot] = contributions
+            self.round_loans[slot] = loans
+        elif self.decay is not None:
+            self.contribution_sums = self.decay*self.contribution_sums + contributions
+            self.n_loans = self.decay*self.n_loans + loans
+        else:
+            self.contribution_sums += contributions
+            self.n_loans += loans
+        self.n_rounds += 1
+
+    def weights(self):
+        #Normalized positive mean contributions, equal weights if there are none
+        n_loans = np.where(self.n_loans > 0, self.n_loans, 1)[..., np.newaxis] #sums are 0 without loans
+        positive_contributions = np.clip(self.contribution_sums / n_loans, 0, 10**6)
+        total = np.sum(positive_contributions, axis=-1, keepdims=True)
+        return np.where(total > 0, positive_contributions / np.where(total > 0, total, 1), \
+                    1/self.n_recommenders) #Use equal weights for all recommenders if no one has made a positive contribution
+
+def brier_contributions(reports, lending_decisions, outcomes):
+    '''Leave-one-out Brier contributions behind the Budescu & Chen weights.
+    reports is n_recommenders by T, lending_decisions and outcomes are 1 by T,
+    all behind any leading batch dimensions.
+    Returns each recommender's contribution (group score minus the score of the
+    average without them) and the group score, both summed over the loans made.
+    The leave-one-out averages come from one column sum, so this is O(n_recommenders * T)
+    '''
+    n_recommenders = reports.shape[-2]
+    lending_decisions = np.asarray(lending_decisions)[..., np.newaxis]
+    outcomes = np.asarray(outcomes)[..., np.newaxis, :]
+    report_sums = np.sum(reports, axis=-2, keepdims=True)
+    group_scores = brier(report_sums / n_recommenders, outcomes) #simple average of reports; includes an outcome of 0 for borrowers who did not receive a loan
+    scores_without_recommender = brier((report_sums - reports) / (n_recommenders - 1), \
+                outcomes) #row i averages everyone but recommender i
+    recommender_contributions = np.matmul(group_scores - scores_without_recommender, \
+                lending_decisions)[..., 0]
+    return recommender_contributions, np.matmul(group_scores, lending_decisions)[..., 0, 0]
+
 def brier(preds, outcomes):
     #This function takes a set of preds \in [0,1] for binary events and calculates the brier score against actual outcomes \in {0,1}
     preds_of_outcomes = 1 - preds - outcomes + 2*np.multiply(preds, outcomes) #predictions made of the outcomes that actually occurred
@@ -348,35 +668,11 @@ def brier(preds, outcomes):
 
 ##### CODE TO RUN THE SIMULATION #####
 
-n = 5 #Run the simulation n times
-
-for k in range(n):
-    print('Iteration: ',k)
-    #1 Parameter Settings
-    n_recommenders = 5
-    n_borrowers = 6
-    budget = 4 #Maximum number of borrowers who can receive a loan
-    c = .6 #Lending threshold rating
-
-    #2 Simulation Loops
-    if k == 0: n_loans_array, n_repayments_array, mean_recommender_comp_array,\
-                rec_comp_vol_array, rec_comp_negative_pct_array = \
-                main(n_recommenders, n_borrowers, budget, c)
-    else:
-        n_loans_made, n_repayments, mean_comp, std_comp, rec_comp_negative_pct\
-                    = main(n_recommenders, n_borrowers, budget, c)
-        n_loans_array = np.vstack((n_loans_array,n_loans_made))
-        n_repayments_array = np.vstack((n_repayments_array,n_repayments))
-        mean_recommender_comp_array = np.vstack((mean_recommender_comp_array,mean_comp))
-        rec_comp_vol_array = np.vstack((rec_comp_vol_array,std_comp))
-        rec_comp_negative_pct_array = np.vstack((rec_comp_negative_pct_array,rec_comp_negative_pct))
-
-
-print('n_loans',np.round(np.mean(n_loans_array),2))
-print('repayment_rate',np.round(np.sum(n_repayments_array) / np.sum(n_loans_array),2))
-print('mean_recommender_comp',np.round(np.mean(mean_recommender_comp_array),2))
-print('rec_comp_vol',np.round(np.nanmean(rec_comp_vol_array),2))
-print('rec_comp_negative_pct',np.round(np.mean(rec_comp_negative_pct_array),2))
+if __name__ == '__main__':
+    print_summary(run_simulation(SimulationConfig()))
+    print_precision(run_until_precise(SimulationConfig(n_iterations=500, verbose=False)))
+    results, differences = compare_mechanisms(SimulationConfig(n_iterations=1000, verbose=False))
+    print_comparison(differences, 'truncated_winkler')
 
 
 '''Technical mean_recommender_contributions
@@ -1,13 +1,25 @@
 # model.py
 # please use Python >=3.9
 
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum, auto
+import heapq
 import numpy as np
 # import numpy.typing as npt
 import numpy.testing as testing
-import pulp
+import os
+import queue
+from random_streams import get_rng, streams
+from scipy import sparse
+import time
 from typing import Optional
 
+try:
+    import pulp
+except ImportError:
+    # only needed for the AllocationSolver.PULP reference solver
+    pulp = None
+
 
 class BeliefNoise(Enum):
     ZERO = auto()
@@ -24,8 +36,26 @@ class ElicitationStrategy(Enum):
     VCG = auto()
 
 
+class AllocationSolver(Enum):
+    TOP_K = auto()      # exact partial selection, default
+    PULP = auto()       # reference CBC integer program
+
+
+class OnlinePolicy(Enum):
+    GREEDY = auto()     # fund anyone above threshold while liquidity lasts
+    SECRETARY = auto()  # observe a prefix of the stream, then fund anyone above its top-k cutoff
+
+
 class LendingModel:
-    '''Simulates borrowers-recommenders-lender system'''
+    '''Simulates borrowers-recommenders-lender system
+
+    Reports may be a sparse matrix when recommenders only rate the borrowers they
+    know. Missing reports abstain instead of counting as 0: a borrower's belief is
+    the mean of the reports it received, weighted by its reporters' weights
+    renormalized to sum to 1, and a borrower nobody reported on gets belief 0 and
+    is never funded. Sparse results therefore equal dense ones only when every
+    entry is reported, see sparse_aggregate().
+    '''
 
     @classmethod
     @property
@@ -47,54 +77,94 @@ class LendingModel:
                  weights=None,
                  # max # of accepted borrowers
                  liquidity: Optional[int] = None,
+                 # preallocated buffers for Winkler elicitation, may be shared across models
+                 workspace: Optional['WinklerWorkspace'] = None,
+                 # False skips the checks below and uses float64 inputs without copying
+                 validate: bool = True,
+                 # random stream (Generator or seed), random_streams' default stream if None
+                 rng=None,
                  ) -> None:
         assert n > 0, 'init(): n must be positive'
         assert m > 0, 'init(): m must be positive'
+        as_array = np.array if validate else np.asarray
+        self.rng = get_rng(rng)
 
         # borrowers
         self.m = np.int32(m)
-        self.true_probabilities = np.array(nullish(true_probabilities,
-                                                   np.random.rand(m)),
+        self.true_probabilities = as_array(self.rng.random(m) if true_probabilities is None
+                                           else true_probabilities,
                                            dtype=np.float64)
         self.outcomes = np.zeros(m, np.int32)
 
         # recommenders
         self.n = np.int32(n)
-        # recommenders have same true beliefs by default
-        self.true_beliefs = np.array(nullish(true_beliefs,
-                                             np.tile(self.true_probabilities.transpose(), (self.n, 1))),
-                                     dtype=np.float64)
-        # recommenders make true reports by default
-        self.reports = np.array(nullish(reports,
-                                        self.true_beliefs),
-                                dtype=np.float64)
+        # sparse (CSR/COO) beliefs and reports only cover the borrowers a recommender
+        # knows; missing reports abstain, see sparse_aggregate()
+        self.SPARSE = sparse.issparse(true_beliefs) or sparse.issparse(reports)
+        if self.SPARSE:
+            self.true_beliefs = sparse.csr_matrix(nullish(true_beliefs, reports),
+                                                  dtype=np.float64, copy=True)
+            self.reports = sparse.csr_matrix(nullish(reports, self.true_beliefs),
+                                             dtype=np.float64, copy=True)
+        else:
+            # recommenders have same true beliefs by default
+            self.true_beliefs = as_array(np.tile(self.true_probabilities.transpose(), (self.n, 1))
+                                         if true_beliefs is None else true_beliefs,
+                                         dtype=np.float64)
+            # recommenders make true reports by default
+            self.reports = np.array(self.true_beliefs) if reports is None else \
+                as_array(reports, dtype=np.float64)
         self.immediate_payments = np.zeros(n)
-        self.outcome_payments = np.zeros((n, m))
+        self.outcome_payments = sparse.csr_matrix(
+            (n, m)) if self.SPARSE else np.zeros((n, m))
 
         # lender
         self.threshold = np.float64(threshold)
-        self.weights = np.array(nullish(weights,
+        self.weights = as_array(nullish(weights,
                                         np.full(n, 1/n)),
                                 dtype=np.float64)
         self.liquidity = np.int32(nullish(liquidity,
                                           m))
         self.allocation = np.zeros(m, np.int32)
+        # aggregated reports, kept current by update_report() and update_recommender()
+        self.beliefs = None
+        self.workspace = workspace
 
         # flags to ensure proper usage
         self.REPORT_STRATEGY = None
         self.ELICITATION_STRATEGY = None
+        self.ALLOCATION_SOLVER = None
+        self.EXPECTED_PAYMENTS = None
+        # variance of outcome payments (expected Winkler elicitation only)
+        self.outcome_payments_variance = None
+        # seconds per ILP solve, actual allocation first (AllocationSolver.PULP only)
+        self.solve_times = None
+        # uniform draws behind the outcomes, if given to elicit()
+        self.outcome_draws = None
+        self.VALIDATE = validate
+        # False while the arrays may still be the caller's (validate=False), see _own_inputs()
+        self.OWNS_INPUTS = validate
 
+        if validate:
+            self._validate()
+
+    def _validate(self) -> None:
+        '''util for __init__() and reset()'''
         # normalization checks
         assert np.logical_and(self.true_probabilities >= 0,
                               self.true_probabilities <= 1).all(), 'init(): True probabilities must be in [0, 1]'
-        assert np.logical_and(self.true_beliefs >= 0,
-                              self.true_beliefs <= 1).all(), 'init(): True beliefs must be in [0, 1]'
+        assert np.logical_and(entries(self.true_beliefs) >= 0,
+                              entries(self.true_beliefs) <= 1).all(), 'init(): True beliefs must be in [0, 1]'
         assert 0 <= self.threshold <= 1, 'init(): Threshold must be in [0, 1]'
         assert np.logical_and(self.weights >= 0,
                               self.weights <= 1).all(), 'init(): Weights must be in [0, 1]'
         testing.assert_almost_equal(
             np.sum(self.weights), 1), 'init(): Recommender weights must be normalized'
         assert 1 <= self.liquidity <= self.m, 'init(): Liquidity must be in {1, ..., m}'
+        assert self.workspace is None or self.workspace.n == self.n, \
+            'init(): Workspace must be sized for n recommenders'
+        assert self.workspace is None or not self.SPARSE, \
+            'init(): Workspace requires dense reports'
 
         # dimensionality checks
         assert self.true_probabilities.shape == (
@@ -114,36 +184,177 @@ class LendingModel:
         assert self.outcome_payments.shape == (
             self.n, self.m), 'init(): Dimension of outcome payments must be (n x m)'
 
+    def reset(self,
+              # new borrower repayment probabilities
+              true_probabilities=None,
+              # new recommenders' beliefs of probs, true probabilities by default
+              true_beliefs=None,
+              # new recommenders' reports of probs, true beliefs by default
+              reports=None) -> None:
+        '''prepare for another draw, copying new inputs into the existing arrays'''
+        assert not self.SPARSE, 'reset(): Sparse reports cannot be reset'
+        self._own_inputs()
+        if true_probabilities is not None:
+            np.copyto(self.true_probabilities, true_probabilities)
+        if true_beliefs is not None:
+            np.copyto(self.true_beliefs, true_beliefs)
+        elif true_probabilities is not None:
+            np.copyto(self.true_beliefs, self.true_probabilities)
+        if self.reports is self.true_beliefs:
+            self.reports = np.empty_like(self.true_beliefs)
+        if reports is not None:
+            np.copyto(self.reports, reports)
+        elif true_beliefs is not None or true_probabilities is not None:
+            np.copyto(self.reports, self.true_beliefs)
+
+        self.outcomes.fill(0)
+        self.allocation.fill(0)
+        self.immediate_payments.fill(0)
+        self.outcome_payments.fill(0)
+        self.beliefs = None
+        self.outcome_payments_variance = None
+        self.solve_times = None
+        self.outcome_draws = None
+        self.REPORT_STRATEGY = None
+        self.ELICITATION_STRATEGY = None
+        self.ALLOCATION_SOLVER = None
+        self.EXPECTED_PAYMENTS = None
+
+        if self.VALIDATE:
+            self._validate()
+
+    def _own_inputs(self) -> None:
+        '''util for methods that write into the input arrays: copies them on the first
+        write, so that the writes never reach the caller's arrays under validate=False'''
+        if self.OWNS_INPUTS:
+            return
+        aliased = self.reports is self.true_beliefs
+        self.true_probabilities = np.array(self.true_probabilities)
+        self.true_beliefs = np.array(self.true_beliefs)
+        self.reports = self.true_beliefs if aliased else np.array(self.reports)
+        self.OWNS_INPUTS = True
+
+    def reseed(self, seed=None) -> None:
+        '''reset() to a fresh default draw: uniformly random repayment probabilities
+        that all recommenders believe and report truthfully. A seed (or Generator)
+        replaces the model's random stream first'''
+        if seed is not None:
+            self.rng = get_rng(seed)
+        self.reset(true_probabilities=self.rng.random(self.m))
+
     def add_beliefs_noise(self, type: BeliefNoise, param: float = 0.05) -> None:
         if type == BeliefNoise.ZERO:
             pass
+        elif type == BeliefNoise.GAUSSIAN and self.SPARSE:
+            self.true_beliefs.data += self.rng.normal(0, param,
+                                                       self.true_beliefs.nnz)
         elif type == BeliefNoise.GAUSSIAN:
-            self.true_beliefs += np.random.normal(0, param, (self.n, self.m))
+            # not in place: true beliefs may still be the caller's array, or the reports
+            self.true_beliefs = self.true_beliefs + self.rng.normal(0, param, (self.n, self.m))
         else:
             assert False, 'add_beliefs_noise(): Belief noise type invalid'
-        self.true_beliefs = np.clip(self.true_beliefs, 0, 1)
+        self.true_beliefs = clip_entries(self.true_beliefs, 0, 1)
 
     def make_reports(self, type: ReportStrategy, param: float = 0.05) -> None:
         self.REPORT_STRATEGY = type
         if type == ReportStrategy.TRUE_BELIEFS:
             self.reports = self.true_beliefs
+        elif type == ReportStrategy.GAUSSIAN and self.SPARSE:
+            self.reports = self.true_beliefs.copy()
+            self.reports.data += self.rng.normal(0, param, self.reports.nnz)
         elif type == ReportStrategy.GAUSSIAN:
             self.reports = self.true_beliefs + \
-                np.random.normal(0, param, (self.n, self.m))
+                self.rng.normal(0, param, (self.n, self.m))
         else:
             assert False, 'make_reports(): Report type invalid'
-        self.reports = np.clip(self.reports, LendingModel.EPSILON, 1)
+        self.reports = clip_entries(self.reports, LendingModel.EPSILON, 1)
 
-    def elicit(self, type: ElicitationStrategy) -> None:
+    def elicit(self, type: ElicitationStrategy,
+               solver: AllocationSolver = AllocationSolver.TOP_K,
+               # lender constraints beyond liquidity, implies AllocationSolver.PULP
+               program: Optional['VCGProgram'] = None,
+               # bound on parallel leave-one-out ILP solves
+               max_workers: Optional[int] = None,
+               # WINKLER only: pay E[payment] under true probabilities, no outcome draws
+               expected: bool = False,
+               # uniforms in [0, 1), (m); borrower q repays iff outcome_draws[q] > 1 - prob
+               outcome_draws=None) -> None:
         assert not self.ELICITATION_STRATEGY, 'cannot elicit() twice'
+        assert not expected or type == ElicitationStrategy.WINKLER, \
+            'elicit(): Expected payments require Winkler elicitation'
+        assert not self.SPARSE or type == ElicitationStrategy.WINKLER, \
+            'elicit(): Sparse reports require Winkler elicitation'
+        assert outcome_draws is None or not expected, \
+            'elicit(): Expected payments do not draw outcomes'
+        assert program is None or (program.m == self.m and program.liquidity == self.liquidity and
+                                   program.threshold == self.threshold), \
+            'elicit(): Program must have the model\'s m, liquidity and threshold'
+        if outcome_draws is not None:
+            self.outcome_draws = np.asarray(outcome_draws, dtype=np.float64)
+            assert self.outcome_draws.shape == (
+                self.m, ), 'elicit(): Dimension of outcome draws must be (m)'
         self.ELICITATION_STRATEGY = type
+        self.ALLOCATION_SOLVER = solver if program is None else AllocationSolver.PULP
+        self.EXPECTED_PAYMENTS = expected
         if type == ElicitationStrategy.WINKLER:
             self._elicit_winkler()
         elif type == ElicitationStrategy.VCG:
-            self._elicit_vcg()
+            self._elicit_vcg(program, max_workers)
         else:
             assert False, 'elicit(): Elicitation strategy invalid'
 
+    def update_report(self, i: int, q: int, value: float) -> None:
+        '''revise recommender i's report on borrower q after Winkler elicitation, in O(n)'''
+        self._assert_updatable()
+        self._own_inputs()
+        value = np.clip(value, LendingModel.EPSILON, 1)
+        self.beliefs[q] += self.weights[i] * (value - self.reports[i, q])
+        self.reports[i, q] = value
+        self._reelicit_winkler(np.array([q]))
+
+    def update_recommender(self, i: int, row) -> None:
+        '''revise all of recommender i's reports after Winkler elicitation, in O(m)
+        plus O(n) per borrower whose report changed'''
+        self._assert_updatable()
+        self._own_inputs()
+        row = np.clip(np.array(row, dtype=np.float64),
+                      LendingModel.EPSILON, 1)
+        assert row.shape == (
+            self.m, ), 'update_recommender(): Dimension of row must be (m)'
+        changed = np.flatnonzero(row != self.reports[i])
+        self.beliefs += self.weights[i] * (row - self.reports[i])
+        self.reports[i] = row
+        self._reelicit_winkler(changed)
+
+    def _assert_updatable(self) -> None:
+        '''util for update_report() and update_recommender()'''
+        assert self.ELICITATION_STRATEGY == ElicitationStrategy.WINKLER, \
+            'updates require a prior Winkler elicit()'
+        assert not self.SPARSE, 'updates require dense reports'
+
+    def _reelicit_winkler(self, borrowers) -> None:
+        '''_elicit_winkler() restricted to the given borrowers, whose beliefs changed'''
+        if borrowers.size == 0:
+            return
+        beliefs = self.beliefs[borrowers]
+        allocation = (beliefs > self.threshold).astype(int)
+        newly_allocated = np.logical_and(allocation,
+                                         np.logical_not(self.allocation[borrowers]))
+        self.allocation[borrowers] = allocation
+        probs = np.where(allocation, self.true_probabilities[borrowers], 0)
+        reports = self.reports[:, borrowers]
+        if self.EXPECTED_PAYMENTS:
+            self.outcome_payments[:, borrowers], self.outcome_payments_variance[:, borrowers] = \
+                winkler_expected_payments(
+                    reports, self.weights, beliefs, self.threshold, probs)
+            return
+        # borrowers keep their realized outcome while they stay allocated
+        outcomes = np.where(newly_allocated, self._draw_outcomes(probs, borrowers),
+                            np.where(allocation, self.outcomes[borrowers], 0))
+        self.outcomes[borrowers] = outcomes
+        self.outcome_payments[:, borrowers] = winkler_outcome_payments(reports, self.weights, beliefs,
+                                                                       self.threshold, outcomes)
+
     def _get_score_winkler(self, i: int, q: int) -> np.float64:
         '''util for _elicit_winkler()'''
         # no longer needed in vectorized implementation below
@@ -168,87 +379,96 @@ class LendingModel:
         return np.dot(self.weights, self.reports[:, q])
 
     def _elicit_winkler(self) -> None:
+        if self.SPARSE:
+            self._elicit_winkler_sparse()
+            return
         # beliefs = [self._get_linear_aggregator(q) for q in range(self.m)]
         beliefs = np.matmul(self.weights, self.reports)
+        self.beliefs = beliefs
         self.allocation = (beliefs > self.threshold).astype(int)
         probs = np.where(self.allocation, self.true_probabilities, 0)
-        self.outcomes = np.random.binomial(1, probs)
+        if self.EXPECTED_PAYMENTS and self.workspace is not None:
+            self.outcome_payments_variance = np.zeros((self.n, self.m))
+            self.workspace.expected_payments(self.reports, self.weights, beliefs, self.threshold,
+                                             probs, self.outcome_payments,
+                                             self.outcome_payments_variance)
+            return
+        elif self.EXPECTED_PAYMENTS:
+            self.outcome_payments, self.outcome_payments_variance = winkler_expected_payments(
+                self.reports, self.weights, beliefs, self.threshold, probs)
+            return
+        self.outcomes = self._draw_outcomes(probs)
+        if self.workspace is not None:
+            self.workspace.outcome_payments(self.reports, self.weights, beliefs, self.threshold,
+                                            self.outcomes, self.outcome_payments)
+            return
         # self.outcome_payments = np.array(
         #     [[self._get_score_winkler(i, q) for q in range(self.m)] for i in range(self.n)])
+        self.outcome_payments = winkler_outcome_payments(self.reports, self.weights, beliefs,
+                                                         self.threshold, self.outcomes)
 
-        # this is an nxm matrix after a ton of array broadcasting
-        min_reports = (self.threshold - (beliefs - self.reports *
-                       self.weights[:, np.newaxis])) / self.weights[:, np.newaxis]
-        min_reports = np.clip(
-            min_reports, LendingModel.EPSILON, 1 - LendingModel.EPSILON)
-
-        # more vectorized computation
-        payment_indicators = (self.reports > min_reports).astype(int)
-        reports = np.clip(self.reports, LendingModel.EPSILON,
-                          1 - LendingModel.EPSILON)
-        payments_repaid = self.outcomes * \
-            (np.log(reports) - np.log(min_reports)) / \
-            (-1 * np.log(min_reports))
-        payments_not_repaid = (1 - self.outcomes) * (np.log(1 - reports) -
-                                                     np.log(1 - min_reports)) / (-1 * np.log(min_reports))
-        self.outcome_payments = payment_indicators * \
-            (payments_repaid + payments_not_repaid)
+    def _elicit_winkler_sparse(self) -> None:
+        '''_elicit_winkler() in O(nnz) for sparse reports'''
+        beliefs, scores_repaid, scores_not_repaid = sparse_winkler_scores(self.reports, self.weights,
+                                                                          self.threshold)
+        self.allocation = (beliefs > self.threshold).astype(int)
+        probs = np.where(self.allocation, self.true_probabilities, 0)
+        # payments are only owed on reported entries, so they share the reports' pattern
+        reported = self.reports.indices
+        if self.EXPECTED_PAYMENTS:
+            mean = probs[reported] * scores_repaid + \
+                (1 - probs[reported]) * scores_not_repaid
+            variance = probs[reported] * (1 - probs[reported]) * \
+                (scores_repaid - scores_not_repaid) ** 2
+            self.outcome_payments = sparse_like(self.reports, mean)
+            self.outcome_payments_variance = sparse_like(self.reports, variance)
+            return
+        self.outcomes = self._draw_outcomes(probs)
+        self.outcome_payments = sparse_like(self.reports,
+                                            self.outcomes[reported] * scores_repaid +
+                                            (1 - self.outcomes[reported]) * scores_not_repaid)
+
+    def _draw_outcomes(self, probs, borrowers=slice(None)):
+        '''util for elicitation: outcomes of the given borrowers, from outcome_draws if given'''
+        draws = None if self.outcome_draws is None else self.outcome_draws[borrowers]
+        return bernoulli_outcomes(probs, draws, self.rng)
 
     def _get_vcg_allocation(self, ignore_i: Optional[int] = None):
-        '''util for _elicit_vcg()'''
+        '''util for _elicit_vcg(), top-k only: ILP allocations go through solve_vcg()'''
         assert ignore_i is None or isinstance(
             ignore_i, int), '_get_vcg_allocation(): ignoreRecommender must be int'
 
-        solver = pulp.LpProblem('VCG_Allocation', pulp.LpMaximize)
-
         # ignore_i removes effect of recommender i
         weights = self.weights if ignore_i is None else np.delete(
             self.weights, ignore_i)
         reports = self.reports if ignore_i is None else np.delete(
             self.reports, ignore_i, 0)
-
-        coeffs = np.append(weights.dot(reports),
-                           # add liquidity no. of reserve borrowers have decision of threshold
-                           np.full(self.liquidity, self.threshold))
-
-        variables = [pulp.LpVariable(str(i), lowBound=0, upBound=1, cat='Integer')
-                     for i in range(coeffs.size)]
-
-        # objective
-        solver += pulp.lpSum([variables[i] * coeffs[i]
-                              for i in range(coeffs.size)])
-
-        # constraints
-        solver += pulp.lpSum(variables) <= self.liquidity
-
-        solver.solve(pulp.PULP_CBC_CMD(msg=False))
-        # print("Status: ", pulp.LpStatus[solver.status])
-
-        allocation = np.array([variable.varValue for variable in variables],
-                              dtype=np.int32)
-        # remove reserve borrowers
-        return allocation[:coeffs.size - self.liquidity]
+        return top_k_allocation(weights.dot(reports), self.liquidity, self.threshold)
 
     def _get_scores_vcg(self, allocation):
         return self.reports.dot(allocation) * self.weights
 
-    def _elicit_vcg(self) -> None:
-        self.allocation = self._get_vcg_allocation()
-        scores = self._get_scores_vcg(self.allocation)
-
-        # immediate payments
-        for i in range(self.n):
-            alt_allocation = self._get_vcg_allocation(ignore_i=i)
-            alt_scores = self._get_scores_vcg(alt_allocation)
-            self.immediate_payments[i] = np.sum(
-                np.delete(alt_scores, i)) - np.sum(np.delete(scores, i))
+    def _elicit_vcg(self, program: Optional['VCGProgram'] = None,
+                    max_workers: Optional[int] = None) -> None:
+        if self.ALLOCATION_SOLVER == AllocationSolver.TOP_K:
+            self.allocation = self._get_vcg_allocation()
+            self.immediate_payments = vcg_immediate_payments(self.weights, self.reports,
+                                                             self.allocation, self.liquidity,
+                                                             self.threshold)
+        elif self.ALLOCATION_SOLVER == AllocationSolver.PULP:
+            program = nullish(program, VCGProgram(
+                self.m, self.liquidity, self.threshold))
+            self.allocation, self.immediate_payments, self.solve_times = solve_vcg(
+                program, self.weights, self.reports, max_workers)
+        else:
+            assert False, 'elicit_vcg(): Allocation solver invalid'
 
         # outcome payments
         for q in range(self.m):
             assert self.allocation[q] == 0 or self.allocation[q] == 1, 'elicit_vcg(): Allocation must be binary'
             if self.allocation[q]:
-                self.outcomes[q] = np.random.binomial(
-                    1, self.true_probabilities[q])
+                self.outcomes[q] = self._draw_outcomes(
+                    self.true_probabilities[q], q)
                 if self.outcomes[q]:
                     for i in range(self.n):
                         self.outcome_payments[i, q] = self.weights[i]
@@ -270,6 +490,728 @@ class LendingModel:
             f'outcome payments:\n{self.outcome_payments}'
 
 
+class BatchedLendingModel:
+    '''Simulates k independent borrowers-recommenders-lender systems at once'''
+
+    def __init__(self,
+                 k: int,    # number of scenarios
+                 n: int,    # number of recommenders
+                 m: int,    # number of borrowers
+                 # borrower repayment probabilities, (k x m)
+                 true_probabilities=None,
+                 # recommenders' beliefs of probs, (k x n x m)
+                 true_beliefs=None,
+                 # recommenders' reports of probs, (k x n x m)
+                 reports=None,
+                 # lender's threshold
+                 threshold: float = 0.5,
+                 # weights given to recommenders, (n) shared or (k x n)
+                 weights=None,
+                 # max # of accepted borrowers
+                 liquidity: Optional[int] = None,
+                 # random stream (Generator or seed), random_streams' default stream if None
+                 rng=None,
+                 ) -> None:
+        assert k > 0, 'init(): k must be positive'
+        assert n > 0, 'init(): n must be positive'
+        assert m > 0, 'init(): m must be positive'
+        self.rng = get_rng(rng)
+
+        # borrowers
+        self.k = np.int32(k)
+        self.m = np.int32(m)
+        self.true_probabilities = np.array(self.rng.random((k, m)) if true_probabilities is None
+                                           else true_probabilities,
+                                           dtype=np.float64)
+        self.outcomes = np.zeros((k, m), np.int32)
+
+        # recommenders
+        self.n = np.int32(n)
+        # recommenders have same true beliefs by default
+        self.true_beliefs = np.array(nullish(true_beliefs,
+                                             np.repeat(self.true_probabilities[:, np.newaxis, :], n, axis=1)),
+                                     dtype=np.float64)
+        # recommenders make true reports by default
+        self.reports = np.array(nullish(reports,
+                                        self.true_beliefs),
+                                dtype=np.float64)
+        self.immediate_payments = np.zeros((k, n))
+        self.outcome_payments = np.zeros((k, n, m))
+
+        # lender
+        self.threshold = np.float64(threshold)
+        self.weights = np.array(np.broadcast_to(nullish(weights,
+                                                        np.full(n, 1/n)),
+                                                (k, n)),
+                                dtype=np.float64)
+        self.liquidity = np.int32(nullish(liquidity,
+                                          m))
+        self.allocation = np.zeros((k, m), np.int32)
+
+        # flags to ensure proper usage
+        self.REPORT_STRATEGY = None
+        self.ELICITATION_STRATEGY = None
+        self.EXPECTED_PAYMENTS = None
+        # variance of outcome payments (expected Winkler elicitation only)
+        self.outcome_payments_variance = None
+        # uniform draws behind the outcomes, if given to elicit()
+        self.outcome_draws = None
+
+        # normalization checks
+        assert np.logical_and(self.true_probabilities >= 0,
+                              self.true_probabilities <= 1).all(), 'init(): True probabilities must be in [0, 1]'
+        assert np.logical_and(self.true_beliefs >= 0,
+                              self.true_beliefs <= 1).all(), 'init(): True beliefs must be in [0, 1]'
+        assert 0 <= self.threshold <= 1, 'init(): Threshold must be in [0, 1]'
+        assert np.logical_and(self.weights >= 0,
+                              self.weights <= 1).all(), 'init(): Weights must be in [0, 1]'
+        testing.assert_almost_equal(
+            np.sum(self.weights, axis=1), np.ones(k)), 'init(): Recommender weights must be normalized'
+        assert 1 <= self.liquidity <= self.m, 'init(): Liquidity must be in {1, ..., m}'
+
+        # dimensionality checks
+        assert self.true_probabilities.shape == (
+            self.k, self.m), 'init(): Dimension of true probabilities must be (k x m)'
+        assert self.true_beliefs.shape == (
+            self.k, self.n, self.m), 'init(): Dimension of true beliefs must be (k x n x m)'
+        assert self.reports.shape == (
+            self.k, self.n, self.m), 'init(): Dimension of recommender reports must be (k x n x m)'
+
+    def add_beliefs_noise(self, type: BeliefNoise, param: float = 0.05) -> None:
+        if type == BeliefNoise.ZERO:
+            pass
+        elif type == BeliefNoise.GAUSSIAN:
+            # not in place, as in LendingModel.add_beliefs_noise()
+            self.true_beliefs = self.true_beliefs + self.rng.normal(0, param,
+                                                                    (self.k, self.n, self.m))
+        else:
+            assert False, 'add_beliefs_noise(): Belief noise type invalid'
+        self.true_beliefs = np.clip(self.true_beliefs, 0, 1)
+
+    def make_reports(self, type: ReportStrategy, param: float = 0.05) -> None:
+        self.REPORT_STRATEGY = type
+        if type == ReportStrategy.TRUE_BELIEFS:
+            self.reports = self.true_beliefs
+        elif type == ReportStrategy.GAUSSIAN:
+            self.reports = self.true_beliefs + \
+                self.rng.normal(0, param, (self.k, self.n, self.m))
+        else:
+            assert False, 'make_reports(): Report type invalid'
+        self.reports = np.clip(self.reports, LendingModel.EPSILON, 1)
+
+    def elicit(self, type: ElicitationStrategy,
+               # WINKLER only: pay E[payment] under true probabilities, no outcome draws
+               expected: bool = False,
+               # uniforms in [0, 1), (k x m); borrower q repays iff outcome_draws[s, q] > 1 - prob
+               outcome_draws=None) -> None:
+        assert not self.ELICITATION_STRATEGY, 'cannot elicit() twice'
+        assert not expected or type == ElicitationStrategy.WINKLER, \
+            'elicit(): Expected payments require Winkler elicitation'
+        assert outcome_draws is None or not expected, \
+            'elicit(): Expected payments do not draw outcomes'
+        if outcome_draws is not None:
+            self.outcome_draws = np.asarray(outcome_draws, dtype=np.float64)
+            assert self.outcome_draws.shape == (
+                self.k, self.m), 'elicit(): Dimension of outcome draws must be (k x m)'
+        self.ELICITATION_STRATEGY = type
+        self.EXPECTED_PAYMENTS = expected
+        if type == ElicitationStrategy.WINKLER:
+            self._elicit_winkler()
+        elif type == ElicitationStrategy.VCG:
+            self._elicit_vcg()
+        else:
+            assert False, 'elicit(): Elicitation strategy invalid'
+
+    def _elicit_winkler(self) -> None:
+        # (k x 1 x n) @ (k x n x m) -> (k x m)
+        beliefs = np.matmul(self.weights[:, np.newaxis, :],
+                            self.reports)[:, 0, :]
+        self.allocation = (beliefs > self.threshold).astype(int)
+        probs = np.where(self.allocation, self.true_probabilities, 0)
+        if self.EXPECTED_PAYMENTS:
+            self.outcome_payments, self.outcome_payments_variance = winkler_expected_payments(
+                self.reports, self.weights, beliefs, self.threshold, probs)
+            return
+        self.outcomes = bernoulli_outcomes(probs, self.outcome_draws, self.rng)
+        self.outcome_payments = winkler_outcome_payments(self.reports, self.weights, beliefs,
+                                                         self.threshold, self.outcomes)
+
+    def _elicit_vcg(self) -> None:
+        beliefs = np.matmul(self.weights[:, np.newaxis, :],
+                            self.reports)[:, 0, :]
+        self.allocation = top_k_allocation(beliefs, self.liquidity,
+                                           self.threshold)
+        self.immediate_payments = vcg_immediate_payments(self.weights, self.reports,
+                                                         self.allocation, self.liquidity,
+                                                         self.threshold)
+        probs = np.where(self.allocation, self.true_probabilities, 0)
+        self.outcomes = bernoulli_outcomes(probs, self.outcome_draws, self.rng)
+        self.outcome_payments = self.outcomes[:, np.newaxis, :] * \
+            self.weights[:, :, np.newaxis]
+
+    def __getitem__(self, s: int) -> LendingModel:
+        '''scenario s as a standalone LendingModel, for inspection'''
+        model = LendingModel(self.n, self.m,
+                             true_probabilities=self.true_probabilities[s],
+                             true_beliefs=self.true_beliefs[s],
+                             reports=self.reports[s],
+                             threshold=self.threshold,
+                             weights=self.weights[s],
+                             liquidity=self.liquidity,
+                             rng=self.rng)
+        model.REPORT_STRATEGY = self.REPORT_STRATEGY
+        model.ELICITATION_STRATEGY = self.ELICITATION_STRATEGY
+        model.EXPECTED_PAYMENTS = self.EXPECTED_PAYMENTS
+        if self.outcome_payments_variance is not None:
+            model.outcome_payments_variance = self.outcome_payments_variance[s]
+        model.allocation = self.allocation[s]
+        model.outcomes = self.outcomes[s]
+        if self.outcome_draws is not None:
+            model.outcome_draws = self.outcome_draws[s]
+        model.immediate_payments = self.immediate_payments[s]
+        model.outcome_payments = self.outcome_payments[s]
+        return model
+
+    def __str__(self):
+        return ''.join(str(self[s]) for s in range(self.k))
+
+
+class OnlineLendingModel:
+    '''Simulates a lender facing a stream of borrowers under Winkler elicitation
+
+    Borrowers arrive one at a time or in micro-batches and are funded or rejected
+    on arrival against the remaining liquidity. Recommenders are only scored on
+    funded borrowers, and their payments are accumulated as they happen, so memory
+    is O(liquidity + n) however long the stream is.
+    '''
+
+    def __init__(self,
+                 n: int,    # number of recommenders
+                 # max # of accepted borrowers over the whole stream
+                 liquidity: int,
+                 # lender's threshold
+                 threshold: float = 0.5,
+                 # weights given to recommenders
+                 weights=None,
+                 policy: OnlinePolicy = OnlinePolicy.GREEDY,
+                 # expected # of borrowers in the stream (SECRETARY only)
+                 horizon: Optional[int] = None,
+                 # fraction of the horizon only observed (SECRETARY only)
+                 observe_fraction: float = 1 / np.e,
+                 # random stream (Generator or seed), random_streams' default stream if None
+                 rng=None,
+                 ) -> None:
+        assert n > 0, 'init(): n must be positive'
+        assert liquidity > 0, 'init(): Liquidity must be positive'
+        assert policy != OnlinePolicy.SECRETARY or horizon is not None, \
+            'init(): Secretary policy requires a horizon'
+
+        # recommenders
+        self.n = np.int32(n)
+        self.outcome_payments = np.zeros(n)
+        self.rng = get_rng(rng)
+
+        # lender
+        self.threshold = np.float64(threshold)
+        self.weights = np.array(nullish(weights,
+                                        np.full(n, 1/n)),
+                                dtype=np.float64)
+        self.liquidity = np.int32(liquidity)
+        self.remaining_liquidity = np.int32(liquidity)
+        self.policy = policy
+        self.n_observe = np.int64(0 if horizon is None else
+                                  np.floor(horizon * observe_fraction))
+
+        # stream statistics
+        self.n_arrived = np.int64(0)
+        self.n_funded = np.int64(0)
+        self.n_repaid = np.int64(0)
+        # min-heap of the liquidity best beliefs seen while observing
+        self.observed = []
+
+        # normalization checks
+        assert 0 <= self.threshold <= 1, 'init(): Threshold must be in [0, 1]'
+        assert np.logical_and(self.weights >= 0,
+                              self.weights <= 1).all(), 'init(): Weights must be in [0, 1]'
+        testing.assert_almost_equal(
+            np.sum(self.weights), 1), 'init(): Recommender weights must be normalized'
+        assert 0 <= observe_fraction < 1, 'init(): Observe fraction must be in [0, 1)'
+
+        # dimensionality checks
+        assert self.weights.shape == (
+            self.n, ), 'init(): Dimensions of recommender weights must be (n)'
+
+    @property
+    def cutoff(self) -> np.float64:
+        '''belief a borrower must beat to be funded once observation is over'''
+        if self.policy == OnlinePolicy.SECRETARY and len(self.observed) == self.liquidity:
+            return max(self.threshold, self.observed[0])
+        return self.threshold
+
+    def arrive(self, reports, true_probabilities):
+        '''reports: (n) or (n x b), true_probabilities: scalar or (b);
+        returns the allocation of the arriving borrowers, (b)
+
+        Min reports are taken against the cutoff the borrowers were funded at, not the
+        threshold: a report is only rewarded if it was needed to beat the cutoff. The
+        remaining liquidity plays no part, since borrowers are funded in arrival order
+        and any belief above the cutoff would have been funded in the same place.
+        '''
+        reports = np.array(reports, dtype=np.float64).reshape((self.n, -1))
+        true_probabilities = np.array(true_probabilities,
+                                      dtype=np.float64).reshape(-1)
+        b = reports.shape[1]
+        assert true_probabilities.shape == (
+            b, ), 'arrive(): Dimension of true probabilities must be (b)'
+
+        beliefs = np.matmul(self.weights, reports)
+        allocation = np.zeros(b, np.int32)
+
+        # borrowers arriving during the observation prefix are never funded
+        n_observing = int(np.clip(self.n_observe - self.n_arrived, 0, b))
+        for belief in beliefs[:n_observing]:
+            if len(self.observed) < self.liquidity:
+                heapq.heappush(self.observed, belief)
+            elif belief > self.observed[0]:
+                heapq.heapreplace(self.observed, belief)
+        self.n_arrived += b
+
+        # fund eligible borrowers in arrival order until liquidity runs out
+        cutoff = self.cutoff
+        eligible = np.flatnonzero(beliefs[n_observing:] > cutoff) + n_observing
+        funded = eligible[:self.remaining_liquidity]
+        if funded.size == 0:
+            return allocation
+        allocation[funded] = 1
+        self.remaining_liquidity -= funded.size
+        self.n_funded += funded.size
+
+        outcomes = self.rng.binomial(1, true_probabilities[funded])
+        self.n_repaid += np.sum(outcomes)
+        scores_repaid, scores_not_repaid = winkler_scores(reports[:, funded], self.weights,
+                                                          beliefs[funded], cutoff)
+        self.outcome_payments += np.matmul(scores_repaid, outcomes) + \
+            np.matmul(scores_not_repaid, 1 - outcomes)
+        return allocation
+
+    def __str__(self):
+        return '\n================================================\n\n' + \
+            f'{self.policy}\n\n' + \
+            f'n: {self.n}\n\n' + \
+            f'recommender weights:\n{self.weights}\n\n' + \
+            f'lender threshold: {self.threshold}\n\n' + \
+            f'lender cutoff: {self.cutoff}\n\n' + \
+            f'lender liquidity: {self.remaining_liquidity} of {self.liquidity} left\n\n' + \
+            f'borrowers arrived, funded, repaid: {self.n_arrived, self.n_funded, self.n_repaid}\n\n' + \
+            f'outcome payments:\n{self.outcome_payments}'
+
+
+# KERNELS
+
+def bernoulli_outcomes(probs, draws=None, rng=None):
+    '''Bernoulli(probs) outcomes, or outcomes of given uniform draws in [0, 1)
+
+    A borrower repays iff its draw exceeds 1 - prob, as in lending_simulation_v2,
+    so mechanisms given the same draws see the same outcomes (common random numbers).
+    '''
+    if draws is None:
+        return get_rng(rng).binomial(1, probs)
+    return (draws > 1 - probs).astype(int)
+
+
+def winkler_scores(reports, weights, beliefs, threshold):
+    '''truncated Winkler scores if repaid and if not repaid, broadcast over any leading
+    batch dimensions; zero where the report does not beat the min report
+
+    reports: (... x n x m), weights: (... x n), beliefs: (... x m)
+    Recommenders with zero weight cannot move a belief and always score zero.
+    '''
+    weights = weights[..., np.newaxis]
+    weighted = weights > 0
+
+    # this is an nxm matrix after a ton of array broadcasting
+    min_reports = (threshold - (beliefs[..., np.newaxis, :] - reports *
+                   weights)) / np.where(weighted, weights, 1)
+    return truncated_log_scores(reports, min_reports, weighted)
+
+
+def truncated_log_scores(reports, min_reports, weighted=True):
+    '''elementwise part of winkler_scores(), shared with sparse_winkler_scores();
+    weighted broadcasts against reports and is False where the weight is zero'''
+    min_reports = np.clip(
+        min_reports, LendingModel.EPSILON, 1 - LendingModel.EPSILON)
+
+    # more vectorized computation
+    payment_indicators = ((reports > min_reports) & weighted).astype(int)
+    reports = np.clip(reports, LendingModel.EPSILON,
+                      1 - LendingModel.EPSILON)
+    scores_repaid = payment_indicators * \
+        (np.log(reports) - np.log(min_reports)) / \
+        (-1 * np.log(min_reports))
+    scores_not_repaid = payment_indicators * (np.log(1 - reports) -
+                                              np.log(1 - min_reports)) / (-1 * np.log(min_reports))
+    return scores_repaid, scores_not_repaid
+
+
+def sparse_aggregate(weights, reports):
+    '''linear aggregation of sparse reports in O(nnz)
+
+    Missing reports abstain: each borrower's belief is the weighted mean of the
+    reports it received, with weights renormalized over its reporters, and a
+    borrower nobody reported on gets belief 0. With every entry reported this
+    is weights @ reports. Returns beliefs, weighted report sums and reporter
+    weight sums, each (m).
+    '''
+    reports = sparse.csr_matrix(reports)
+    reported = sparse_like(reports, np.ones(reports.nnz))
+    totals = reports.T.dot(weights)
+    weight_sums = reported.T.dot(weights)
+    beliefs = np.divide(totals, weight_sums, out=np.zeros(reports.shape[1]),
+                        where=weight_sums > 0)
+    return beliefs, totals, weight_sums
+
+
+def sparse_winkler_scores(reports, weights, threshold):
+    '''winkler_scores() for the stored entries of a sparse CSR report matrix, O(nnz)
+
+    Under sparse_aggregate(), the min report of recommender i on borrower q solves
+    (totals[q] - w_i * r_iq + w_i * min_report) / weight_sums[q] = threshold.
+    Returns beliefs (m) and the scores if repaid and if not repaid, both aligned
+    with reports.data.
+    '''
+    beliefs, totals, weight_sums = sparse_aggregate(weights, reports)
+    rows = np.repeat(np.arange(reports.shape[0]), np.diff(reports.indptr))
+    cols = reports.indices
+    entry_weights = weights[rows]
+    weighted = entry_weights > 0
+    min_reports = (threshold * weight_sums[cols] - (totals[cols] - entry_weights *
+                   reports.data)) / np.where(weighted, entry_weights, 1)
+    scores_repaid, scores_not_repaid = truncated_log_scores(reports.data, min_reports, weighted)
+    return beliefs, scores_repaid, scores_not_repaid
+
+
+def winkler_outcome_payments(reports, weights, beliefs, threshold, outcomes):
+    '''truncated Winkler payments for one realization of outcomes: (... x m)'''
+    scores_repaid, scores_not_repaid = winkler_scores(reports, weights,
+                                                      beliefs, threshold)
+    outcomes = outcomes[..., np.newaxis, :]
+    return outcomes * scores_repaid + (1 - outcomes) * scores_not_repaid
+
+
+def winkler_expected_payments(reports, weights, beliefs, threshold, probs):
+    '''mean and variance of truncated Winkler payments when outcomes are Bernoulli(probs)
+
+    The score is linear in the binary outcome, so no sampling is needed.
+    probs: (... x m), zero for borrowers who are not allocated
+    '''
+    scores_repaid, scores_not_repaid = winkler_scores(reports, weights,
+                                                      beliefs, threshold)
+    probs = probs[..., np.newaxis, :]
+    mean = probs * scores_repaid + (1 - probs) * scores_not_repaid
+    variance = probs * (1 - probs) * (scores_repaid - scores_not_repaid) ** 2
+    return mean, variance
+
+
+class WinklerWorkspace:
+    '''Preallocated buffers for the truncated Winkler kernel
+
+    Payments are computed over blocks of at most block_size borrowers, writing
+    into the buffers with out= arguments, so temporaries take O(n * block_size)
+    memory instead of O(n * m). recommender_totals() also never materializes
+    the (n x m) payment matrix.
+    '''
+
+    def __init__(self,
+                 n: int,    # number of recommenders
+                 # max # of borrowers per block
+                 block_size: int = 4096,
+                 ) -> None:
+        assert n > 0, 'WinklerWorkspace(): n must be positive'
+        assert block_size > 0, 'WinklerWorkspace(): block size must be positive'
+        self.n = np.int32(n)
+        self.block_size = np.int32(block_size)
+
+        self.min_reports = np.empty((n, block_size))
+        self.reports = np.empty((n, block_size))
+        self.denominators = np.empty((n, block_size))
+        self.scores_repaid = np.empty((n, block_size))
+        self.scores_not_repaid = np.empty((n, block_size))
+        self.indicators = np.empty((n, block_size), dtype=bool)
+
+    def _blocks(self, reports, weights, beliefs, threshold):
+        '''yields (borrower slice, repaid scores, not repaid scores) per block;
+        the score views are overwritten by the next block'''
+        assert reports.shape[0] == self.n, '_blocks(): Dimension of reports must be (n x m)'
+        m = reports.shape[1]
+        weights = weights[:, np.newaxis]
+        # zero weights score zero, see winkler_scores()
+        weighted = weights > 0
+        divisors = np.where(weighted, weights, 1)
+        for start in range(0, m, self.block_size):
+            block = slice(start, min(start + self.block_size, m))
+            width = block.stop - block.start
+            block_reports = reports[:, block]
+            min_reports = self.min_reports[:, :width]
+            clipped_reports = self.reports[:, :width]
+            denominators = self.denominators[:, :width]
+            scores_repaid = self.scores_repaid[:, :width]
+            scores_not_repaid = self.scores_not_repaid[:, :width]
+            indicators = self.indicators[:, :width]
+
+            # min_reports = (threshold - (beliefs - reports * weights)) / weights
+            np.multiply(block_reports, weights, out=min_reports)
+            np.subtract(beliefs[block], min_reports, out=min_reports)
+            np.subtract(threshold, min_reports, out=min_reports)
+            np.divide(min_reports, divisors, out=min_reports)
+            np.clip(min_reports, LendingModel.EPSILON,
+                    1 - LendingModel.EPSILON, out=min_reports)
+
+            np.greater(block_reports, min_reports, out=indicators)
+            np.logical_and(indicators, weighted, out=indicators)
+            np.clip(block_reports, LendingModel.EPSILON,
+                    1 - LendingModel.EPSILON, out=clipped_reports)
+
+            # denominators = -log(min_reports)
+            np.log(min_reports, out=denominators)
+            np.negative(denominators, out=denominators)
+
+            # scores_repaid = (log(reports) - log(min_reports)) / -log(min_reports)
+            np.log(clipped_reports, out=scores_repaid)
+            np.add(scores_repaid, denominators, out=scores_repaid)
+            np.divide(scores_repaid, denominators, out=scores_repaid)
+
+            # scores_not_repaid = (log(1 - reports) - log(1 - min_reports)) / -log(min_reports)
+            np.subtract(1, clipped_reports, out=scores_not_repaid)
+            np.log(scores_not_repaid, out=scores_not_repaid)
+            np.subtract(1, min_reports, out=clipped_reports)
+            np.log(clipped_reports, out=clipped_reports)
+            np.subtract(scores_not_repaid, clipped_reports,
+                        out=scores_not_repaid)
+            np.divide(scores_not_repaid, denominators, out=scores_not_repaid)
+
+            np.multiply(scores_repaid, indicators, out=scores_repaid)
+            np.multiply(scores_not_repaid, indicators, out=scores_not_repaid)
+            yield block, scores_repaid, scores_not_repaid
+
+    def outcome_payments(self, reports, weights, beliefs, threshold, outcomes, out=None):
+        '''same as winkler_outcome_payments(), written into out (n x m)'''
+        out = nullish(out, np.empty(reports.shape))
+        repaid = outcomes.astype(bool)
+        for block, scores_repaid, scores_not_repaid in self._blocks(reports, weights,
+                                                                    beliefs, threshold):
+            np.copyto(out[:, block], scores_not_repaid)
+            np.copyto(out[:, block], scores_repaid, where=repaid[block])
+        return out
+
+    def expected_payments(self, reports, weights, beliefs, threshold, probs,
+                          out=None, out_variance=None):
+        '''same as winkler_expected_payments(), written into out and out_variance (n x m)'''
+        out = nullish(out, np.empty(reports.shape))
+        out_variance = nullish(out_variance, np.empty(reports.shape))
+        for block, scores_repaid, scores_not_repaid in self._blocks(reports, weights,
+                                                                    beliefs, threshold):
+            block_probs = probs[block]
+            mean, variance = out[:, block], out_variance[:, block]
+            # variance = probs * (1 - probs) * (repaid - not repaid) ** 2
+            np.subtract(scores_repaid, scores_not_repaid, out=variance)
+            np.square(variance, out=variance)
+            np.multiply(variance, block_probs * (1 - block_probs), out=variance)
+            # mean = not repaid + probs * (repaid - not repaid)
+            np.subtract(scores_repaid, scores_not_repaid, out=mean)
+            np.multiply(mean, block_probs, out=mean)
+            np.add(mean, scores_not_repaid, out=mean)
+        return out, out_variance
+
+    def recommender_totals(self, reports, weights, beliefs, threshold, outcomes):
+        '''total outcome payment per recommender (n) without an (n x m) payment matrix'''
+        totals = np.zeros(self.n)
+        for block, scores_repaid, scores_not_repaid in self._blocks(reports, weights,
+                                                                    beliefs, threshold):
+            block_outcomes = outcomes[block]
+            totals += np.matmul(scores_repaid, block_outcomes) + \
+                np.matmul(scores_not_repaid, 1 - block_outcomes)
+        return totals
+
+
+def top_k_allocation(scores, liquidity: int, threshold: float):
+    '''VCG allocation without an ILP, broadcast over any leading batch dimensions
+
+    With only the cardinality constraint sum <= liquidity and liquidity reserve
+    borrowers valued at the threshold, the optimum funds the (at most) liquidity
+    largest scores that beat the threshold. argpartition finds them in O(m).
+    scores: (... x m)
+    '''
+    allocation = scores > threshold
+    if liquidity < scores.shape[-1]:
+        top = np.argpartition(-scores, liquidity - 1,
+                              axis=-1)[..., :liquidity]
+        in_top = np.zeros(scores.shape, dtype=bool)
+        np.put_along_axis(in_top, top, True, axis=-1)
+        allocation &= in_top
+    return allocation.astype(np.int32)
+
+
+def leave_one_out_scores(weights, reports):
+    '''aggregated scores with each recommender removed in turn, broadcast over any
+    leading batch dimensions
+
+    Removing recommender i only shifts each aggregate by weights[i] * reports[i], so
+    all n counterfactuals come from one pass. Row i of the result ignores recommender i.
+    weights: (... x n), reports: (... x n x m) -> (... x n x m)
+    '''
+    beliefs = np.matmul(weights[..., np.newaxis, :], reports)
+    return beliefs - weights[..., np.newaxis] * reports
+
+
+def vcg_immediate_payments(weights, reports, allocation, liquidity: int, threshold: float):
+    '''VCG immediate payments from the leave-one-out top-k allocations
+
+    Payment i is the value the other recommenders get from their best allocation
+    without i minus the value they get from the actual allocation.
+    allocation: (... x m) -> (... x n)
+    '''
+    scores = leave_one_out_scores(weights, reports)
+    alt_allocations = top_k_allocation(scores, liquidity, threshold)
+    return np.einsum('...im,...im->...i', scores, alt_allocations) - \
+        np.einsum('...im,...m->...i', scores, allocation)
+
+
+class VCGProgram:
+    '''VCG allocation ILP for lender constraints that top-k cannot express
+
+    The pulp model is built once; each solve only overwrites the objective
+    coefficients, so counterfactual allocations reuse the same constraints.
+    The copies that solve_vcg() hands to its worker threads are kept with the
+    program, so they are also built once however many times it is solved.
+    '''
+
+    def __init__(self,
+                 m: int,    # number of borrowers
+                 # max # of accepted borrowers
+                 liquidity: int,
+                 # lender's threshold, the value of each reserve borrower
+                 threshold: float,
+                 # loan size per borrower, (m)
+                 sizes=None,
+                 # max total size of accepted loans
+                 capital: Optional[float] = None,
+                 # sector label per borrower in {0, ..., # sectors - 1}, (m)
+                 sectors=None,
+                 # max # of accepted borrowers per sector, (# sectors)
+                 sector_caps=None,
+                 ) -> None:
+        assert pulp is not None, 'VCGProgram(): pulp must be installed'
+        assert (sizes is None) == (capital is None), \
+            'VCGProgram(): sizes and capital must be given together'
+        assert (sectors is None) == (sector_caps is None), \
+            'VCGProgram(): sectors and sector caps must be given together'
+
+        self.m = np.int32(m)
+        self.liquidity = np.int32(liquidity)
+        self.threshold = np.float64(threshold)
+        self.sizes = None if sizes is None else np.array(sizes, dtype=np.float64)
+        self.capital = capital
+        self.sectors = None if sectors is None else np.array(sectors, dtype=np.int32)
+        self.sector_caps = None if sector_caps is None else np.array(sector_caps,
+                                                                     dtype=np.int32)
+
+        assert self.sizes is None or self.sizes.shape == (
+            self.m, ), 'VCGProgram(): Dimension of sizes must be (m)'
+        assert self.sectors is None or self.sectors.shape == (
+            self.m, ), 'VCGProgram(): Dimension of sectors must be (m)'
+
+        # independent programs for parallel solves, see copies()
+        self._copies = []
+
+        self.problem = pulp.LpProblem('VCG_Allocation', pulp.LpMaximize)
+        self.variables = [pulp.LpVariable(f'x{q}', cat='Binary')
+                          for q in range(self.m)]
+        # liquidity no. of reserve borrowers have decision of threshold
+        self.reserve = pulp.LpVariable('reserve', lowBound=0, upBound=int(self.liquidity),
+                                       cat='Integer')
+
+        # objective, coefficients are overwritten by solve()
+        self.problem += pulp.lpSum(self.variables) + \
+            float(self.threshold) * self.reserve
+
+        # constraints
+        self.problem += pulp.lpSum(self.variables) + \
+            self.reserve <= int(self.liquidity)
+        if self.sizes is not None:
+            self.problem += pulp.lpSum([float(self.sizes[q]) * self.variables[q]
+                                        for q in range(self.m)]) <= self.capital
+        if self.sectors is not None:
+            for g, cap in enumerate(self.sector_caps):
+                self.problem += pulp.lpSum([self.variables[q] for q in range(self.m)
+                                            if self.sectors[q] == g]) <= int(cap)
+
+    def copy(self) -> 'VCGProgram':
+        '''independent program with the same constraints'''
+        return VCGProgram(self.m, self.liquidity, self.threshold,
+                          sizes=self.sizes, capital=self.capital,
+                          sectors=self.sectors, sector_caps=self.sector_caps)
+
+    def copies(self, count: int) -> list:
+        '''count independent programs with the same constraints, one per worker,
+        built on first request and reused by later calls'''
+        while len(self._copies) < count:
+            self._copies.append(self.copy())
+        return self._copies[:count]
+
+    def solve(self, scores):
+        '''returns the allocation maximizing scores and the seconds the solve took'''
+        assert scores.shape == (
+            self.m, ), 'solve(): Dimension of scores must be (m)'
+        for variable, score in zip(self.variables, scores):
+            self.problem.objective[variable] = float(score)
+
+        start = time.perf_counter()
+        self.problem.solve(pulp.PULP_CBC_CMD(msg=False))
+        elapsed = time.perf_counter() - start
+        # print("Status: ", pulp.LpStatus[self.problem.status])
+
+        allocation = np.array([round(variable.varValue) for variable in self.variables],
+                              dtype=np.int32)
+        return allocation, elapsed
+
+
+def solve_vcg(program: VCGProgram, weights, reports, max_workers: Optional[int] = None):
+    '''VCG allocation and immediate payments under the constraints of program
+
+    The n leave-one-out ILPs are dispatched to at most max_workers threads (CBC
+    runs as a subprocess, so threads do not contend for the GIL), each solving
+    on one of program.copies() at a time. Returns allocation (m), immediate payments (n) and
+    the seconds of each solve (n + 1), actual allocation first.
+    '''
+    n = weights.shape[0]
+    max_workers = nullish(max_workers, min(n, os.cpu_count() or 1))
+    assert max_workers > 0, 'solve_vcg(): max_workers must be positive'
+
+    allocation, elapsed = program.solve(np.matmul(weights, reports))
+    scores = leave_one_out_scores(weights, reports)
+
+    # a pulp problem is not safe to solve from two threads at once
+    idle = queue.SimpleQueue()
+    for worker_program in program.copies(max_workers):
+        idle.put(worker_program)
+
+    def solve_without(i: int):
+        worker_program = idle.get()
+        try:
+            return worker_program.solve(scores[i])
+        finally:
+            idle.put(worker_program)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(solve_without, range(n)))
+
+    alt_allocations = np.array([alt_allocation for alt_allocation, _ in results])
+    solve_times = np.array([elapsed] + [seconds for _, seconds in results])
+    immediate_payments = np.einsum('im,im->i', scores, alt_allocations) - \
+        np.matmul(scores, allocation)
+    return allocation, immediate_payments, solve_times
+
+
 def demo() -> None:
     # Default is uniformly random repayment probabilities, true beliefs that match
     # real probabilities, threshold of 0.5, equal recommender weights, unconstrained liquidity
@@ -294,6 +1236,74 @@ def demo() -> None:
     model.elicit(ElicitationStrategy.VCG)
     # print(model)
 
+    # Constraints top-k cannot express, e.g. loan sizes against a capital budget
+    # and sector caps, are solved as an ILP with parallel leave-one-out solves
+    model = LendingModel(n=3, m=4, threshold=0.3, liquidity=3)
+    model.make_reports(ReportStrategy.GAUSSIAN)
+    program = VCGProgram(model.m, model.liquidity, model.threshold,
+                         sizes=[1.0, 2.0, 1.5, 1.0], capital=3.0,
+                         sectors=[0, 0, 1, 1], sector_caps=[1, 2])
+    model.elicit(ElicitationStrategy.VCG, program=program, max_workers=2)
+    # print(model.solve_times)
+
+    # Many independent scenarios can be elicited in a single vectorized pass
+    model = BatchedLendingModel(k=1000, n=5, m=3)
+    model.add_beliefs_noise(BeliefNoise.GAUSSIAN)
+    model.make_reports(ReportStrategy.TRUE_BELIEFS)
+    model.elicit(ElicitationStrategy.WINKLER)
+    # print(model[0])
+
+    # Expected Winkler payments under the true probabilities, without sampling outcomes
+    model = LendingModel(n=5, m=3)
+    model.make_reports(ReportStrategy.TRUE_BELIEFS)
+    model.elicit(ElicitationStrategy.WINKLER, expected=True)
+    # print(model.outcome_payments, model.outcome_payments_variance)
+
+    # Sparse reports only rate the borrowers each recommender knows
+    reports = sparse.random(5, 1000, density=0.01, format='csr',
+                            random_state=get_rng())
+    model = LendingModel(n=5, m=1000, reports=reports)
+    model.make_reports(ReportStrategy.TRUE_BELIEFS)
+    model.elicit(ElicitationStrategy.WINKLER)
+    # print(model.outcome_payments)
+
+    # Revised reports re-price only the borrowers they touch
+    model = LendingModel(n=5, m=3)
+    model.elicit(ElicitationStrategy.WINKLER)
+    model.update_report(0, 1, 0.9)
+    model.update_recommender(2, [0.2, 0.6, 0.8])
+    # print(model)
+
+    # Borrowers can also arrive one at a time against a liquidity budget
+    model = OnlineLendingModel(n=5, liquidity=10, policy=OnlinePolicy.SECRETARY,
+                               horizon=1000)
+    rng = get_rng()
+    for _ in range(100):
+        probs = rng.random(10)
+        model.arrive(np.clip(probs + rng.normal(0, 0.05, (5, 10)),
+                             LendingModel.EPSILON, 1), probs)
+    # print(model)
+
+    # Monte Carlo loops can skip validation and reuse one model's arrays
+    model = LendingModel(n=5, m=3, validate=False, rng=0)
+    for _ in range(3):
+        model.reseed()
+        model.add_beliefs_noise(BeliefNoise.GAUSSIAN)
+        model.make_reports(ReportStrategy.TRUE_BELIEFS)
+        model.elicit(ElicitationStrategy.WINKLER)
+
+    # Independent seeded streams make scenarios reproducible however they are split
+    models = [LendingModel(n=5, m=3, rng=rng) for rng in streams(4, entropy=0)]
+    for model in models:
+        model.elicit(ElicitationStrategy.WINKLER)
+
+    # A workspace keeps Winkler temporaries to blocks of borrowers and can be reused
+    workspace = WinklerWorkspace(n=5, block_size=2)
+    for _ in range(3):
+        model = LendingModel(n=5, m=3, workspace=workspace)
+        model.make_reports(ReportStrategy.TRUE_BELIEFS)
+        model.elicit(ElicitationStrategy.WINKLER)
+
 
 def collusion() -> None:
     model = LendingModel(n=9, m=8)
@@ -311,5 +1321,24 @@ def nullish(x, y):
     return x if x is not None else y
 
 
+def entries(x):
+    '''stored values of a sparse matrix, or the array itself'''
+    return x.data if sparse.issparse(x) else x
+
+
+def clip_entries(x, a_min, a_max):
+    '''np.clip() that keeps the sparsity pattern of sparse matrices'''
+    if not sparse.issparse(x):
+        return np.clip(x, a_min, a_max)
+    x = x.copy()
+    np.clip(x.data, a_min, a_max, out=x.data)
+    return x
+
+
+def sparse_like(x, data):
+    '''CSR matrix with the sparsity pattern of CSR matrix x and the given values'''
+    return sparse.csr_matrix((data, x.indices.copy(), x.indptr.copy()), shape=x.shape)
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,233 @@
+# random_streams.py
+# please use Python >=3.9
+
+'''Seeded random number streams shared by the simulators
+
+Simulators take an optional numpy Generator (rng) and otherwise draw from the
+default stream, which seed() makes reproducible. For parallel work, stream(key)
+is the Generator of a key under the seed: the same seed and key give the same
+draws in any process and in any order, so a sweep split across workers by key
+reproduces a single-process run bit for bit. StreamBatch draws for a batch of
+simulations, each from its own stream, so batching does not change their draws.
+VariatePool serves variates from large pre-generated blocks to loops that draw
+only a few at a time.
+'''
+
+import operator
+import queue
+import threading
+from typing import Optional
+
+import numpy as np
+
+# root of every stream; without seed() it comes from fresh OS entropy
+_root = np.random.SeedSequence()
+_default = np.random.Generator(np.random.PCG64(_root))
+
+
+def seed(entropy: Optional[int] = None) -> None:
+    '''reseed the default stream and the root of all keyed streams'''
+    global _root, _default
+    _root = np.random.SeedSequence(entropy)
+    _default = np.random.Generator(np.random.PCG64(_root))
+
+
+def get_rng(rng=None) -> np.random.Generator:
+    '''rng itself if it is a Generator (or StreamBatch), a Generator seeded with it
+    if it is an int, else the default stream'''
+    if rng is None:
+        return _default
+    if isinstance(rng, (np.random.Generator, StreamBatch)):
+        return rng
+    return np.random.default_rng(rng)
+
+
+def stream(key, entropy: Optional[int] = None) -> np.random.Generator:
+    '''independent Generator for key (int or tuple of ints), a child of the seed()
+    root, or of SeedSequence(entropy) if entropy is given'''
+    root = _root if entropy is None else np.random.SeedSequence(entropy)
+    key = key if isinstance(key, tuple) else (key,)
+    return np.random.Generator(np.random.PCG64(
+        np.random.SeedSequence(root.entropy, spawn_key=root.spawn_key + key)))
+
+
+def streams(n: int, entropy: Optional[int] = None) -> list:
+    '''stream(0), ..., stream(n - 1), e.g. one per worker or scenario'''
+    return [stream(i, entropy) for i in range(n)]
+
+
+def child(rng=None) -> np.random.Generator:
+    '''independent Generator seeded from rng (see get_rng), for handing to another thread'''
+    return np.random.default_rng(get_rng(rng).integers(2**32, size=4))
+
+
+class StreamBatch:
+    '''Draws for a batch of independent simulations: row b of every draw comes
+    from sources[b] (Generators or VariatePools), so a simulation gets the same
+    variates whichever batch it runs in, as if it ran alone.
+
+    Sizes must lead with the batch dimension, len(sources). Each call costs one
+    draw per source, so prefer a single Generator when batching need not be
+    reproducible. close() closes the sources that can be closed.
+    '''
+
+    def __init__(self, sources) -> None:
+        self.sources = list(sources)
+
+    def beta(self, a, b, size=None):
+        return self._stack('beta', (a, b), size)
+
+    def binomial(self, n, p, size=None):
+        return self._stack('binomial', (n, p), size)
+
+    def normal(self, loc=0., scale=1., size=None):
+        return self._stack('normal', (loc, scale), size)
+
+    def random(self, size=None):
+        return self._stack('random', (), size)
+
+    def close(self) -> None:
+        for source in self.sources:
+            if hasattr(source, 'close'):
+                source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _stack(self, distribution, params, size):
+        size = (size, ) if np.ndim(size) == 0 else tuple(size)
+        assert size[:1] == (len(self.sources), ), \
+            'StreamBatch(): Size must lead with the number of sources'
+        return np.stack([getattr(source, distribution)(*params, size=size[1:])
+                         for source in self.sources])
+
+
+class VariatePool:
+    '''Serves beta, binomial, normal and uniform variates in slices of large
+    pre-generated blocks, for loops that draw a few at a time.
+
+    Each distinct (distribution, parameters) gets its own child stream of rng,
+    seeded on first use, so the draws do not depend on block_size or on whether
+    blocks are made ahead of time by a background thread (background=True).
+    Blocks start at min_block_size and double up to block_size, so short runs
+    do not pay for variates they never use.
+    Parameters must be scalars. Use as a context manager, or call close(), to
+    stop background threads.
+    '''
+
+    def __init__(self,
+                 rng=None,                  # Generator, seed or None, see get_rng
+                 block_size: int = 2**16,   # largest number of variates generated per block
+                 background: bool = False,  # generate the next blocks on a thread
+                 prefetch: int = 2,         # blocks kept ready per thread
+                 min_block_size: int = 256  # size of the first block of each stream
+                 ) -> None:
+        assert block_size > 0, 'VariatePool(): block_size must be positive'
+        assert prefetch > 0, 'VariatePool(): prefetch must be positive'
+        self.rng = get_rng(rng)
+        self.block_size = block_size
+        self.min_block_size = min(min_block_size, block_size)
+        self.background = background
+        self.prefetch = prefetch
+        self._sources = {}
+        self._closed = threading.Event()
+
+    def beta(self, a, b, size=None):
+        return self._take(('beta', a, b), size)
+
+    def binomial(self, n, p, size=None):
+        return self._take(('binomial', n, p), size)
+
+    def normal(self, loc=0., scale=1., size=None):
+        return self._take(('normal', loc, scale), size)
+
+    def random(self, size=None):
+        return self._take(('random',), size)
+
+    def close(self) -> None:
+        '''stops background threads; the pool cannot be used afterwards'''
+        self._closed.set()
+        for source in self._sources.values():
+            if source.thread is not None:
+                while source.thread.is_alive():     # free the queue so the thread sees the close
+                    try: source.queue.get_nowait()
+                    except queue.Empty: source.thread.join(.001)
+        self._sources = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _take(self, key, size):
+        source = self._sources.get(key)
+        if source is None:
+            source = self._start(key)
+        if size is None:
+            n = 1
+        elif np.ndim(size) == 0:  # int or numpy integer
+            n = operator.index(size)
+        else:
+            n = int(np.prod(size))
+        start = source.position
+        if start + n <= len(source.block):  # fast path: one slice of the current block
+            source.position = start + n
+            out = source.block[start:start + n]
+        else:
+            parts = [source.block[start:]]
+            n -= len(parts[0])
+            while n > 0:
+                source.block = self._next_block(key, source)
+                parts.append(source.block[:n])
+                n -= len(parts[-1])
+            source.position = len(parts[-1])
+            out = np.concatenate(parts)
+        return out[0] if size is None else out.reshape(size)
+
+    def _next_block(self, key, source):
+        assert not self._closed.is_set(), 'VariatePool(): pool is closed'
+        return source.queue.get() if source.thread is not None \
+            else self._generate(key, source)
+
+    def _start(self, key):
+        source = _Source(child(self.rng))
+        if self.background:
+            source.queue = queue.Queue(self.prefetch)
+            source.thread = threading.Thread(target=self._produce, args=(key, source),
+                                             daemon=True)
+            source.thread.start()
+        self._sources[key] = source
+        return source
+
+    def _produce(self, key, source) -> None:
+        while not self._closed.is_set():
+            block = self._generate(key, source)
+            while not self._closed.is_set():
+                try:
+                    source.queue.put(block, timeout=.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def _generate(self, key, source):
+        distribution, *params = key
+        size = source.next_size or self.min_block_size
+        source.next_size = min(2 * size, self.block_size)
+        return getattr(source.rng, distribution)(*params, size=size)
+
+
+class _Source:
+    '''child stream, current block and read position of one VariatePool key'''
+    __slots__ = ('rng', 'block', 'position', 'next_size', 'queue', 'thread')
+
+    def __init__(self, rng: np.random.Generator) -> None:
+        self.rng = rng
+        self.block = np.empty(0)
+        self.position = 0
+        self.next_size = 0
+        self.queue = None
+        self.thread = None
@@ -0,0 +1,205 @@
+# test_coalition_winkler.py
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from tensorflow.keras.optimizers import Adam  # noqa: E402
+from coalition_winkler import (BATCH_SIZE, VALIDATION_STEPS, CoalitionGame,  # noqa: E402
+                               StackedDense, alpha_conditioned_predictions, batch_spec, coalition_dataset,
+                               coalition_datasets, coalition_specs, desirability_loss, member_loss, mixed_loss,
+                               profit_loss, sample_preferences, sample_reports, sample_targets,
+                               sigmoid, stacked_collusion_model, stacked_loss)
+
+GAMES = [CoalitionGame(),
+         CoalitionGame(n_coalition=3, n_total=5, m=3, probs=(0.3, 0.6, 0.8), threshold=0.45)]
+
+
+def per_sample_loss(reports, other_reports, preferences, outcomes, importance, game, steepness=280):
+    '''the unbatched formula of one sample, as the losses computed it under tf.map_fn'''
+    reports = tf.concat([tf.reshape(reports, (game.n_coalition, game.m)),
+                         tf.reshape(other_reports, (game.n_others, game.m))], axis=0)
+    reports = tf.clip_by_value(reports, game.epsilon, 1 - game.epsilon)
+    weights = tf.fill([game.n_total], 1/game.n_total)
+    beliefs = tf.linalg.matvec(reports, weights, transpose_a=True)
+    allocation = tf.cast(tf.greater(beliefs, game.threshold), tf.float32)
+    outcomes = outcomes * allocation
+    weight_matrix = tf.tile(tf.reshape(weights, [game.n_total, 1]), [1, game.m])
+    min_reports = (game.threshold - (tf.tile(tf.reshape(beliefs, [1, game.m]), [game.n_total, 1]) -
+                                     reports * weight_matrix)) * (1 / weight_matrix)
+    min_reports = tf.clip_by_value(min_reports, game.epsilon, 1 - game.epsilon)
+    payments = (outcomes * (tf.math.log(reports) - tf.math.log(min_reports)) +
+                (1 - outcomes) * (tf.math.log(1 - reports) - tf.math.log(1 - min_reports))) / \
+        (-1 * tf.math.log(min_reports)) * tf.cast(tf.greater(reports, min_reports), tf.float32)
+    utilities = sigmoid(beliefs, game.threshold, steepness) * \
+        tf.math.reduce_sum(tf.reshape(preferences, (game.n_coalition, game.m)), axis=0)
+    return -1 * ((1 - importance) * tf.math.reduce_sum(payments[:game.n_coalition]) +
+                 importance * tf.math.reduce_sum(utilities))
+
+
+def fixed_batch(game, batch_size=8, seed=0):
+    '''reports, preferences and mixed_loss targets of a small reproducible batch'''
+    rng = np.random.default_rng(seed)
+    reports = rng.random((batch_size, game.n_coalition, game.m)).astype(np.float32)
+    preferences = sample_preferences('binary', batch_size, game, rng)
+    return reports, preferences, sample_targets(batch_size, 0.05, game, rng)
+
+
+@pytest.mark.parametrize('game', GAMES)
+@pytest.mark.parametrize('alpha', [0., 0.3, 1.])
+def test_mixed_loss_matches_per_sample_formula(game, alpha):
+    reports, preferences, y = fixed_batch(game)
+    expected = sum(per_sample_loss(reports[b], y[b, game.m:], preferences[b], y[b, :game.m], alpha, game)
+                   for b in range(len(y)))
+    loss = mixed_loss(alpha, game)(tf.constant(y), tf.constant(np.concatenate([reports, preferences])))
+    np.testing.assert_allclose(loss, expected, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize('game', GAMES)
+def test_profit_and_desirability_losses_match_per_sample_formula(game):
+    reports, preferences, y = fixed_batch(game)
+    probs = np.float32(game.probs)
+    true_reports = np.tile(probs, game.n_others)
+    expected_profit = sum(per_sample_loss(reports[b], true_reports, preferences[b], probs, 0., game)
+                          for b in range(len(y)))
+    expected_desirability = sum(per_sample_loss(reports[b], true_reports, preferences[b], probs, 1., game, 250)
+                                for b in range(len(y)))
+    np.testing.assert_allclose(profit_loss(tf.constant(y[:, :game.m]), tf.constant(reports), game),
+                               expected_profit, rtol=1e-4, atol=1e-5)
+    np.testing.assert_allclose(desirability_loss(None, tf.constant(np.concatenate([reports, preferences])), game),
+                               expected_desirability, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize('game', GAMES)
+def test_stacked_loss_sums_member_losses(game):
+    _, preferences, y = fixed_batch(game)
+    n_members = 3
+    members = np.random.default_rng(1).random(
+        (len(y), n_members, game.n_coalition, game.m)).astype(np.float32)
+    y_pred = tf.constant(np.concatenate([members, np.repeat(preferences[:, np.newaxis], n_members, axis=1)]))
+    loss = mixed_loss(0.3, game)
+    member_losses = [loss(tf.constant(y), tf.constant(np.concatenate([members[:, member], preferences])))
+                     for member in range(n_members)]
+    for member in range(n_members):
+        np.testing.assert_allclose(member_loss(loss, member)(tf.constant(y), y_pred),
+                                   member_losses[member], rtol=1e-5)
+    np.testing.assert_allclose(stacked_loss(loss, n_members)(tf.constant(y), y_pred),
+                               sum(member_losses), rtol=1e-4, atol=1e-5)
+
+
+def test_stacked_dense_evaluates_members_independently():
+    rng = np.random.default_rng(0)
+    layer = StackedDense(3, 4, activation='sigmoid')
+    shared = rng.random((5, 2)).astype(np.float32)
+    layer(shared)
+    kernel = rng.normal(size=(3, 2, 4)).astype(np.float32)
+    bias = rng.normal(size=(3, 4)).astype(np.float32)
+    layer.set_weights([kernel, bias])
+    per_member = rng.random((5, 3, 2)).astype(np.float32)
+    for member in range(3):
+        for inputs, member_inputs in [(shared, shared), (per_member, per_member[:, member])]:
+            expected = 1 / (1 + np.exp(-(member_inputs @ kernel[member] + bias[member])))
+            np.testing.assert_allclose(layer(inputs).numpy()[:, member], expected, rtol=1e-5)
+
+
+def test_stacked_model_tracks_each_member():
+    game = CoalitionGame()
+    rng = np.random.default_rng(0)
+    X = sample_preferences('single', 64, game, rng)
+    y = sample_targets(64, 0.05, game, rng)
+    n_members = 3
+    loss = mixed_loss(0.5, game)
+    model = stacked_collusion_model(n_members, game)
+    model.compile(loss=stacked_loss(loss, n_members), optimizer=Adam(),
+                  metrics=[member_loss(loss, member) for member in range(n_members)])
+    history = model.fit(X, y, validation_data=(X, y), batch_size=16, epochs=2, verbose=0).history
+    assert model.predict(X[:4]).shape == (8, n_members, game.n_coalition, game.m)
+    # the loss that picks the best member is the one the stacked loss sums
+    np.testing.assert_allclose(history['val_loss'],
+                               np.sum([history[f'val_member_{member}'] for member in range(n_members)], axis=0),
+                               rtol=1e-4)
+
+
+@pytest.mark.parametrize('game', GAMES)
+@pytest.mark.parametrize('alpha', [0., 0.3, 1.])
+def test_alpha_column_loss_matches_fixed_alpha(game, alpha):
+    reports, preferences, y = fixed_batch(game)
+    y_pred = tf.constant(np.concatenate([reports, preferences]))
+    alphas = np.full((len(y), 1), alpha, dtype=np.float32)
+    np.testing.assert_allclose(mixed_loss(None, game)(tf.constant(np.concatenate([y, alphas], axis=1)), y_pred),
+                               mixed_loss(alpha, game)(tf.constant(y), y_pred), rtol=1e-5)
+
+
+def test_alpha_column_loss_reads_each_example():
+    game = CoalitionGame()
+    reports, preferences, y = fixed_batch(game)
+    alphas = np.linspace(0, 1, len(y), dtype=np.float32)[:, np.newaxis]
+    expected = sum(mixed_loss(alphas[b, 0], game)(tf.constant(y[b:b + 1]),
+                                                   tf.constant(np.concatenate([reports[b:b + 1], preferences[b:b + 1]])))
+                   for b in range(len(y)))
+    np.testing.assert_allclose(mixed_loss(None, game)(tf.constant(np.concatenate([y, alphas], axis=1)),
+                                                      tf.constant(np.concatenate([reports, preferences]))),
+                               expected, rtol=1e-4, atol=1e-5)
+
+
+def test_alpha_conditioned_model_trains_on_alpha_datasets():
+    game = CoalitionGame()
+    n_members = 2
+    train, validation = coalition_datasets('single', 0.05, game, np.random.default_rng(0),
+                                           alpha_conditioned=True)
+    (X, alphas), y = next(iter(train))
+    np.testing.assert_array_equal(alphas[:, 0], y[:, -1])
+    loss = mixed_loss(None, game)
+    model = stacked_collusion_model(n_members, game, alpha_input=True)
+    model.compile(loss=stacked_loss(loss, n_members), optimizer=Adam(),
+                  metrics=[member_loss(loss, member) for member in range(n_members)])
+    history = model.fit(train, validation_data=validation, steps_per_epoch=2, epochs=1, verbose=0).history
+    assert set(history) >= {f'val_member_{member}' for member in range(n_members)}
+    assert model.predict([X, alphas]).shape == (2 * len(X), n_members, game.n_coalition, game.m)
+    assert alpha_conditioned_predictions(model, [0.2, 0.8], 1, game).shape == \
+        (2, game.m, game.n_coalition, game.m)
+
+
+@pytest.mark.parametrize('alpha_conditioned', [False, True])
+def test_coalition_datasets_match_their_signature(alpha_conditioned):
+    game = GAMES[1]
+    train, validation = coalition_datasets('binary', 0.05, game, np.random.default_rng(0),
+                                           alpha_conditioned=alpha_conditioned)
+    X_shape = (BATCH_SIZE, game.n_coalition, game.m)
+    y_shape = (BATCH_SIZE, game.m + game.n_others * game.m + alpha_conditioned)
+    expected = ((X_shape, (BATCH_SIZE, 1)), y_shape) if alpha_conditioned else (X_shape, y_shape)
+    for dataset in (train, validation):
+        batch = next(iter(dataset))
+        tf.nest.assert_same_structure(batch, dataset.element_spec)
+        assert all(spec.is_compatible_with(tensor) and tensor.dtype == tf.float32
+                   for spec, tensor in zip(tf.nest.flatten(dataset.element_spec), tf.nest.flatten(batch)))
+        assert tf.nest.map_structure(lambda tensor: tuple(tensor.shape), batch) == expected
+    # the validation batches are cached, the same every epoch
+    first, second = list(validation), list(validation)
+    assert len(first) == VALIDATION_STEPS
+    for a, b in zip(tf.nest.flatten(first), tf.nest.flatten(second)):
+        np.testing.assert_array_equal(a, b)
+
+
+def gan_sampler(game, rng):
+    return lambda batch_size: (sample_preferences('single', batch_size, game, rng),
+                               sample_targets(batch_size, 0.05, game, rng),
+                               sample_reports(batch_size, game.n_coalition, 0.05, game, rng))
+
+
+def test_coalition_dataset_unpacks_gan_batches():
+    game = CoalitionGame()
+    rng = np.random.default_rng(0)
+    signature = (*coalition_specs(game), batch_spec(game.n_coalition, game.m))
+    dataset = coalition_dataset(gan_sampler(game, rng), signature)
+    # the signature comes from the game, so building the pipeline draws nothing
+    np.testing.assert_array_equal(rng.random(3), np.random.default_rng(0).random(3))
+    rng = np.random.default_rng(0)
+    dataset = coalition_dataset(gan_sampler(game, rng), signature)
+    X, y, real_reports = next(iter(dataset))
+    assert X.shape == real_reports.shape == (BATCH_SIZE, game.n_coalition, game.m)
+    assert y.shape == (BATCH_SIZE, game.m * (1 + game.n_others))
+    assert {X.dtype, y.dtype, real_reports.dtype} == {tf.float32}
+    for tensor, expected in zip((X, y, real_reports), gan_sampler(game, np.random.default_rng(0))(BATCH_SIZE)):
+        np.testing.assert_array_equal(tensor, expected)
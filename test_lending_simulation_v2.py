@@ -0,0 +1,368 @@
+# test_lending_simulation_v2.py
+
+import importlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from scipy.stats import rankdata
+
+import lending_simulation_v2 as sim
+
+
+def random_round(rng, n_recommenders=5, n_borrowers=6, *batch_shape):
+    '''beliefs, reports with some 0/1 misreports, repayment probabilities, weights and
+    outcome draws of one round'''
+    repayment_probs = rng.beta(3, 2, batch_shape + (n_borrowers, ))
+    p = np.clip(repayment_probs[..., np.newaxis, :] +
+                rng.normal(0, .2, batch_shape + (n_recommenders, n_borrowers)), 0, 1)
+    p_hat = np.where(rng.random(p.shape) < .2, rng.integers(0, 2, p.shape), p)
+    weights = rng.random(batch_shape + (n_recommenders, ))
+    weights /= np.sum(weights, axis=-1, keepdims=True)
+    return p, p_hat, repayment_probs, weights, rng.random(batch_shape + (n_borrowers, ))
+
+
+def loop_vcg(p, p_hat, repayment_probs, budget, c, weights, outcome_draws):
+    #vcg() as it was before the leave-one-out sums were shared, one re-solve per recommender
+    n_recommenders, n_borrowers = p.shape
+    p_hat = np.vstack((p_hat, np.zeros((1, n_borrowers))))
+    p_hat = np.hstack((p_hat, np.vstack((np.zeros((n_recommenders, budget)), np.full((1, budget), c)))))
+    weights_aug = np.hstack((weights, [1]))
+
+    def allocate(sums):
+        threshold = np.sort(sums)[-budget]
+        decisions = np.hstack((np.where(sums[:n_borrowers] >= threshold, 1, 0), np.zeros(budget)))
+        decisions[n_borrowers:int(n_borrowers + budget - np.sum(decisions))] = 1
+        return decisions
+
+    lending_decisions = allocate(np.matmul(weights_aug, p_hat))
+    payments = np.zeros(n_recommenders)
+    expected_payout = np.zeros(n_recommenders)
+    for j in range(n_recommenders):
+        sums_j = np.matmul(np.delete(weights_aug, j), np.delete(p_hat, j, 0))
+        payments[j] = np.sum(sums_j * allocate(sums_j)) - np.sum(sums_j * lending_decisions)
+        expected_payout[j] = np.sum(p[j] * lending_decisions[:n_borrowers]) * weights[j] - payments[j]
+    repayment_outcomes = np.where(outcome_draws > 1 - repayment_probs, 1, 0) * lending_decisions[:n_borrowers]
+    actual_payout = np.sum(repayment_outcomes) * weights - payments
+    return expected_payout, actual_payout, lending_decisions[:n_borrowers], repayment_outcomes
+
+
+@pytest.mark.parametrize('budget', [1, 4, 6])
+def test_vcg_matches_one_re_solve_per_recommender(budget):
+    inputs = random_round(np.random.default_rng(budget), 5, 6, 3)
+    p, p_hat, repayment_probs, weights, draws = inputs
+    batched = sim.vcg(p, p_hat, repayment_probs, budget, .6, weights, False, draws)
+    for b in range(3):
+        expected = loop_vcg(*(array[b] for array in inputs[:3]), budget, .6, weights[b], draws[b])
+        single = sim.vcg(*(array[b] for array in inputs[:3]), budget, .6, weights[b], False, draws[b])
+        for result, batched_result, reference in zip(single, batched, expected):
+            np.testing.assert_allclose(result, reference, atol=1e-12)
+            np.testing.assert_allclose(batched_result[b], reference, atol=1e-12)
+
+
+def test_import_runs_nothing(capsys):
+    importlib.reload(sim)
+    assert capsys.readouterr().out == ''
+
+
+@pytest.mark.parametrize('mechanism', ['truncated_winkler', 'vcg_scoring'])
+def test_seeded_simulation_is_reproducible(mechanism):
+    config = sim.SimulationConfig(mechanism=mechanism, n_rounds=4, n_iterations=3, seed=7, verbose=False)
+    results = sim.run_simulation(config)
+    assert len(results) == len(sim.STATISTICS)
+    for statistic, repeated in zip(results, sim.run_simulation(config)):
+        assert statistic.shape == (3, 4)
+        np.testing.assert_array_equal(statistic, repeated)
+    n_loans_made, n_repayments, _, _, rec_comp_negative_pct = results
+    assert (n_repayments <= n_loans_made).all() and (n_loans_made <= config.n_borrowers).all()
+    if mechanism == 'vcg_scoring':
+        assert (n_loans_made <= config.budget).all()
+    assert ((0 <= rec_comp_negative_pct) & (rec_comp_negative_pct <= 1)).all()
+
+
+def random_history(rng, n_rounds, n_recommenders=5, n_borrowers=6, *batch_shape):
+    '''reports, lending decisions and outcomes of n_rounds rounds, round first'''
+    reports = rng.random((n_rounds,) + batch_shape + (n_recommenders, n_borrowers))
+    decisions = rng.integers(0, 2, (n_rounds,) + batch_shape + (n_borrowers,))
+    return reports, decisions, decisions * rng.integers(0, 2, decisions.shape)
+
+
+def history_weights(reports, decisions, outcomes):
+    #generate_weights over the whole history, its rounds side by side
+    return sim.generate_weights(np.concatenate(reports, axis=-1), np.concatenate(decisions),
+                                np.concatenate(outcomes), *reports.shape[1:])
+
+
+@pytest.mark.parametrize('window', [None, 1, 3])
+def test_running_weights_match_the_history(window):
+    history = random_history(np.random.default_rng(0), 7)
+    estimator = sim.BudescuChenWeights(5, window)
+    for t, step in enumerate(zip(*history)):
+        estimator.update(*step)
+        start = 0 if window is None else max(0, t + 1 - window)
+        np.testing.assert_allclose(estimator.weights(),
+                                   history_weights(*(array[start:t + 1] for array in history)))
+
+
+@pytest.mark.parametrize('decay', [1, .5])
+def test_decayed_weights_discount_each_earlier_round(decay):
+    history = random_history(np.random.default_rng(1), 5)
+    estimator = sim.BudescuChenWeights(5, decay=decay)
+    contributions = np.array([sim.brier_contributions(*step)[0] for step in zip(*history)])
+    loans = np.sum(history[1], axis=-1)
+    for t, step in enumerate(zip(*history)):
+        estimator.update(*step)
+        discounts = decay ** np.arange(t, -1, -1)
+        positive = np.clip(discounts @ contributions[:t + 1] / (discounts @ loans[:t + 1]), 0, None)
+        np.testing.assert_allclose(estimator.weights(), positive / np.sum(positive))
+    if decay == 1:
+        np.testing.assert_allclose(estimator.weights(), history_weights(*history))
+
+def test_batched_weights_match_each_simulation():
+    history = random_history(np.random.default_rng(2), 4, 5, 6, 3)
+    batched = sim.BudescuChenWeights(5, window=2, batch_shape=(3,))
+    singles = [sim.BudescuChenWeights(5, window=2) for _ in range(3)]
+    for reports, decisions, outcomes in zip(*history):
+        batched.update(reports, decisions, outcomes)
+        for b, single in enumerate(singles):
+            single.update(reports[b], decisions[b], outcomes[b])
+        np.testing.assert_allclose(batched.weights(), [single.weights() for single in singles])
+
+
+def loop_contributions(reports, lending_decisions, outcomes):
+    #generate_weights' contributions as they were before brier_contributions, one
+    #column sum and Brier vector per recommender, summed over the loans made
+    n_recommenders = reports.shape[0]
+    group_score = brier(np.sum(reports, axis=0) / n_recommenders, outcomes) @ lending_decisions
+    contributions = np.zeros(n_recommenders)
+    for i in range(n_recommenders):
+        without_i = (np.sum(reports, axis=0) - reports[i, :]) / (n_recommenders - 1)
+        contributions[i] = group_score - brier(without_i, outcomes) @ lending_decisions
+    return contributions, group_score
+
+
+def brier(preds, outcomes):
+    return 2*(1 - preds - outcomes + 2*preds*outcomes) - preds**2 - (1 - preds)**2
+
+
+@pytest.mark.parametrize('n_recommenders', [2, 5, 40])
+def test_brier_contributions_match_one_pass_per_recommender(n_recommenders):
+    # two 30 loan histories, batched
+    reports, decisions, outcomes = random_history(np.random.default_rng(n_recommenders), 2, n_recommenders, 30)
+    for b in range(2):
+        expected = loop_contributions(reports[b], decisions[b], outcomes[b])
+        for result, batched_result, reference in zip(sim.brier_contributions(reports[b], decisions[b], outcomes[b]),
+                                                      sim.brier_contributions(reports, decisions, outcomes),
+                                                      expected):
+            np.testing.assert_allclose(result, reference)
+            np.testing.assert_allclose(batched_result[b], reference)
+        contributions = np.clip(expected[0], 0, None)
+        np.testing.assert_allclose(sim.generate_weights(reports[b], decisions[b], outcomes[b], n_recommenders, 30),
+                                   contributions / np.sum(contributions))
+
+
+def test_weights_are_equal_without_positive_contributions():
+    reports = np.tile([[.9], [.9]], (1, 4))
+    np.testing.assert_array_equal(sim.generate_weights(reports, np.ones(4), np.zeros(4), 2, 4), [.5, .5])
+
+
+def loop_misreports(honesty_type, p, misreporting_recommenders, config, draws):
+    #the honesty branches of the original round loop, ranking the given uniform draws
+    p_hat = p.copy()
+    n_recommenders, n_borrowers = p.shape
+    if honesty_type == 'random_misreports':
+        n_reports = n_recommenders * n_borrowers
+        rand_ranks = rankdata(draws).reshape(p.shape)
+        p_hat = np.where(rand_ranks <= n_reports * config.rand_misreport_rate * config.frac_misreports_1, 1, p_hat)
+        p_hat = np.where((rand_ranks > n_reports * config.rand_misreport_rate * config.frac_misreports_1) &
+                         (rand_ranks <= n_reports * config.rand_misreport_rate), 0, p_hat)
+    elif honesty_type == 'misreports_select_recommenders':
+        n_misreports = n_borrowers * config.frac_misreports_by_dishonest_recs
+        for j in range(n_recommenders):
+            if misreporting_recommenders[j] == 0.:
+                continue
+            rand_bor_ranks = rankdata(draws[j])
+            p_hat[j] = np.where(rand_bor_ranks <= n_misreports * config.frac_misreports_1, 1, p_hat[j])
+            p_hat[j] = np.where((rand_bor_ranks > n_misreports * config.frac_misreports_1) &
+                                (rand_bor_ranks <= n_misreports), 0, p_hat[j])
+    elif honesty_type == 'collusion':
+        n_misreports = n_borrowers * config.frac_misreports_by_dishonest_recs
+        rand_bor_ranks = rankdata(draws)
+        for j in range(n_borrowers):
+            if rand_bor_ranks[j] > n_misreports:
+                continue
+            value = 1 if rand_bor_ranks[j] <= n_misreports * config.frac_misreports_1 else 0
+            p_hat[:, j] = np.where(misreporting_recommenders == 1, value, p_hat[:, j])
+    elif honesty_type == 'optimistic':
+        p_hat[misreporting_recommenders == 1] = 1
+    return p_hat
+
+
+#shape of the uniforms each strategy ranks, behind the batch shape
+DRAW_SHAPES = {'honest': lambda n, m: (0,),
+               'random_misreports': lambda n, m: (n * m,),
+               'misreports_select_recommenders': lambda n, m: (n, m),
+               'collusion': lambda n, m: (m,),
+               'optimistic': lambda n, m: (0,)}
+
+
+@pytest.mark.parametrize('honesty_type', list(sim.HONESTY_TYPES))
+@pytest.mark.parametrize('fractions', [(.5, .5, .5), (.3, .8, .25)])
+def test_misreports_match_the_original_loops(honesty_type, fractions):
+    rate, frac_1, frac_by_dishonest = fractions
+    config = sim.SimulationConfig(rand_misreport_rate=rate, frac_misreports_1=frac_1,
+                                  frac_misreports_by_dishonest_recs=frac_by_dishonest, verbose=False)
+    rng = np.random.default_rng(0)
+    p = rng.uniform(.05, .95, (3, 5, 8))
+    misreporting_recommenders = sim.select_misreporting_recommenders(5, .4, (3,), rng)
+    draws = np.random.default_rng(1).random((3,) + DRAW_SHAPES[honesty_type](5, 8))
+    p_hat = sim.HONESTY_TYPES[honesty_type](p, misreporting_recommenders, config, np.random.default_rng(1))
+    assert p_hat is not p
+    for b in range(3):
+        np.testing.assert_array_equal(p_hat[b], loop_misreports(honesty_type, p[b], misreporting_recommenders[b],
+                                                                config, draws[b]))
+
+
+@pytest.mark.parametrize('mechanism', ['truncated_winkler', 'vcg_scoring', 'model_winkler', 'model_vcg'])
+def test_batched_round_matches_each_iteration(mechanism):
+    config = sim.SimulationConfig(verbose=False)
+    inputs = random_round(np.random.default_rng(0), 5, 6, 2, 3)
+    p, p_hat, repayment_probs, weights, draws = inputs
+    batched = sim.run_mechanism(mechanism, p, p_hat, repayment_probs, weights, config, draws)
+    for index in np.ndindex(2, 3):
+        single = sim.run_mechanism(mechanism, *(array[index] for array in inputs[:4]), config, draws[index])
+        for result, batched_result in zip(single, batched):
+            np.testing.assert_allclose(batched_result[index], result, atol=1e-12)
+
+
+def loop_truncated_winkler(p, p_hat, repayment_probs, c, weights, outcome_draws):
+    #truncated_winkler as it was before the scoring rules were pluggable, one ciq row per recommender
+    aggregated_reports = weights @ p_hat
+    lending_decisions = np.where(aggregated_reports > c, 1, 0)
+    ciq = np.ones(p.shape)
+    for i in range(p.shape[0]):
+        if weights[i] >= 10**-6:
+            ciq[i, :] = (c - aggregated_reports + weights[i]*p_hat[i, :]) / weights[i]
+    ciq = np.clip(ciq, 0.01, .99)
+    denominator = 2 - 4*ciq + 2*ciq*ciq
+    scores_repay = lending_decisions * (2*p_hat - p_hat*p_hat - (1-p_hat)*(1-p_hat) - 2*ciq + ciq*ciq +
+                                        (1-ciq)*(1-ciq)) / denominator
+    scores_default = lending_decisions * (2*(1-p_hat) - p_hat*p_hat - (1-p_hat)*(1-p_hat) - 2*(1-ciq) +
+                                          ciq*ciq + (1-ciq)*(1-ciq)) / denominator
+    expected_payout = scores_repay*p + scores_default*(1-p)
+    repayment_outcomes = np.where(outcome_draws > 1 - repayment_probs, 1, 0) * lending_decisions
+    actual_payout = (scores_repay*repayment_outcomes + scores_default*(1-repayment_outcomes)) * weights[:, np.newaxis]
+    return expected_payout, actual_payout, lending_decisions, repayment_outcomes
+
+
+def test_truncated_winkler_matches_the_quadratic_loop():
+    inputs = random_round(np.random.default_rng(0), 5, 6, 4)
+    p, p_hat, repayment_probs, weights, draws = inputs
+    weights[0] = [0, .5, 0, .3, .2]
+    batched = sim.truncated_winkler(p, p_hat, repayment_probs, .6, weights, 'quadratic', draws)
+    for b in range(4):
+        expected = loop_truncated_winkler(*(array[b] for array in inputs[:3]), .6, weights[b], draws[b])
+        for batched_result, reference in zip(batched, expected):
+            np.testing.assert_allclose(batched_result[b], reference, atol=1e-12)
+
+
+def test_zero_weight_recommenders_are_not_paid():
+    p, p_hat, repayment_probs, _, draws = random_round(np.random.default_rng(0), 5, 6, 8)
+    weights = np.array([0, 0, .5, .5, 0])
+    config = sim.SimulationConfig(verbose=False)
+    with np.errstate(divide='raise', invalid='raise'):
+        for mechanism in ('truncated_winkler', 'model_winkler'):
+            comp_by_recommender, lending_decisions, _ = sim.run_mechanism(mechanism, p, p_hat, repayment_probs,
+                                                                          weights, config, draws)
+            assert lending_decisions.any()
+            np.testing.assert_array_equal(comp_by_recommender[:, weights == 0], 0)
+
+
+def test_compared_mechanisms_see_the_same_random_numbers():
+    config = sim.SimulationConfig(n_rounds=3, n_iterations=4, seed=3, verbose=False)
+    mechanisms = ('truncated_winkler', 'vcg_scoring', 'model_winkler')
+    results, differences = sim.compare_mechanisms(config, mechanisms)
+    for mechanism in mechanisms:
+        alone = sim.run_simulation(sim.replace(config, mechanism=mechanism))
+        for statistic, reference in zip(results[mechanism], alone):
+            np.testing.assert_allclose(statistic, reference)
+    for mechanism in mechanisms[1:]:
+        for name, result, baseline in zip(sim.STATISTICS, results[mechanism], results[mechanisms[0]]):
+            paired = np.nanmean(result - baseline, axis=-1)
+            np.testing.assert_allclose(differences[mechanism][name],
+                                       (np.mean(paired), np.std(paired, ddof=1) / 2))
+
+
+def test_running_stats_match_the_whole_sample():
+    rng = np.random.default_rng(0)
+    batches = [rng.normal(3, 2, size) for size in (1, 5, 40, 2)]
+    batches[2][[3, 7]] = np.nan
+    stats = sim.RunningStats()
+    assert stats.variance() == np.inf
+    for batch in batches:
+        stats.update(batch)
+    stats.update([])
+    values = np.concatenate(batches)
+    values = values[~np.isnan(values)]
+    assert stats.count == len(values) == 46
+    np.testing.assert_allclose(stats.mean, np.mean(values))
+    np.testing.assert_allclose(stats.variance(), np.var(values, ddof=1))
+    np.testing.assert_allclose(stats.half_width(), 1.959964 * np.std(values, ddof=1) / np.sqrt(46), rtol=1e-6)
+
+
+def test_sequential_runs_stop_at_their_targets():
+    config = sim.SimulationConfig(n_rounds=2, n_iterations=3, seed=0, verbose=False)
+    capped = sim.run_until_precise(config, {'mean_comp': 0.}, max_iterations=8)
+    assert capped['mean_comp'].count == 8
+    loose = sim.run_until_precise(config, {'mean_comp': np.inf, 'n_loans': 100.}, max_iterations=8)
+    assert loose['mean_comp'].count == 3
+    for metric, stats in capped.items():
+        assert stats.count <= 8 and stats.half_width() > 0
+
+
+@pytest.mark.parametrize('variate_block_size', [None, 64])
+def test_seeded_results_do_not_depend_on_chunks_or_workers(variate_block_size):
+    config = sim.SimulationConfig(n_rounds=3, n_iterations=5, seed=11, variate_block_size=variate_block_size,
+                                  verbose=False)
+    reference = sim.run_simulation(sim.replace(config, batched=False))
+    runs = [sim.run_simulation(sim.replace(config, chunk_size=chunk_size)) for chunk_size in (None, 1, 2)]
+    # two workers running every other chunk of 2 iterations, in reverse
+    chunked = sim.replace(config, chunk_size=2)
+    with ThreadPoolExecutor(2) as executor:
+        chunks = list(executor.map(lambda chunk: sim.run_chunk(chunked, chunk), [2, 1, 0]))[::-1]
+    runs.append(tuple(np.concatenate(statistic) for statistic in zip(*chunks)))
+    for run in runs:
+        for statistic, expected in zip(run, reference):
+            np.testing.assert_allclose(statistic, expected, atol=1e-12)
+
+
+def test_sequential_runs_draw_the_iterations_of_a_simulation():
+    config = sim.SimulationConfig(n_rounds=2, n_iterations=4, seed=5, verbose=False)
+    stats = sim.run_until_precise(config, {'mean_comp': 0.}, max_iterations=6)
+    results = sim.run_simulation(sim.replace(config, n_iterations=6))
+    for metric, running_stats in stats.items():
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = sim.ITERATION_METRICS[metric](results)
+        np.testing.assert_allclose(running_stats.mean, np.nanmean(values))
+
+
+def test_unseeded_runs_make_one_variate_pool(monkeypatch):
+    pools = []
+
+    class CountedPool(sim.VariatePool):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.closed = False
+            pools.append(self)
+
+        def close(self):
+            self.closed = True
+            super().close()
+
+    monkeypatch.setattr(sim, 'VariatePool', CountedPool)
+    config = sim.SimulationConfig(n_rounds=2, n_iterations=3, chunk_size=1, variate_block_size=64,
+                                  variate_background=True, verbose=False)
+    sim.run_simulation(config)
+    sim.run_simulation(sim.replace(config, batched=False))
+    sim.run_until_precise(config, {'mean_comp': 0.}, max_iterations=7)
+    assert len(pools) == 3 and all(pool.closed for pool in pools)
@@ -0,0 +1,308 @@
+# test_model.py
+
+import itertools
+
+import numpy as np
+import pytest
+from scipy import sparse
+
+from model import AllocationSolver, BatchedLendingModel, BeliefNoise, ElicitationStrategy, LendingModel, \
+    OnlineLendingModel, OnlinePolicy, VCGProgram, WinklerWorkspace, sparse_aggregate
+
+
+def random_inputs(rng, n, m, *batch_shape):
+    '''true probabilities, reports in [EPSILON, 1] and normalized weights'''
+    probs = rng.random(batch_shape + (m, ))
+    reports = np.clip(probs[..., np.newaxis, :] + rng.normal(0, 0.2, batch_shape + (n, m)),
+                      LendingModel.EPSILON, 1)
+    weights = rng.random(batch_shape + (n, ))
+    return probs, reports, weights / np.sum(weights, axis=-1, keepdims=True)
+
+
+@pytest.mark.parametrize('strategy, expected', [(ElicitationStrategy.WINKLER, False),
+                                                (ElicitationStrategy.WINKLER, True),
+                                                (ElicitationStrategy.VCG, False)])
+def test_batched_model_matches_each_scenario(strategy, expected):
+    rng = np.random.default_rng(0)
+    k, n, m = 6, 4, 5
+    probs, reports, weights = random_inputs(rng, n, m, k)
+    draws = None if expected else rng.random((k, m))
+    batched = BatchedLendingModel(k, n, m, true_probabilities=probs, reports=reports,
+                                  weights=weights, liquidity=3)
+    batched.elicit(strategy, expected=expected, outcome_draws=draws)
+    for s in range(k):
+        model = LendingModel(n, m, true_probabilities=probs[s], reports=reports[s],
+                             weights=weights[s], liquidity=3)
+        model.elicit(strategy, expected=expected,
+                     outcome_draws=None if draws is None else draws[s])
+        np.testing.assert_array_equal(batched.allocation[s], model.allocation)
+        np.testing.assert_array_equal(batched.outcomes[s], model.outcomes)
+        np.testing.assert_allclose(batched.immediate_payments[s], model.immediate_payments)
+        np.testing.assert_allclose(batched.outcome_payments[s], model.outcome_payments)
+        if expected:
+            np.testing.assert_allclose(batched.outcome_payments_variance[s],
+                                       model.outcome_payments_variance)
+
+
+@pytest.mark.parametrize('liquidity', [1, 3, 6])
+def test_top_k_matches_pulp_ilp(liquidity):
+    pytest.importorskip('pulp')
+    probs, reports, weights = random_inputs(np.random.default_rng(liquidity), 4, 6)
+    models = [LendingModel(4, 6, true_probabilities=probs, reports=reports, weights=weights,
+                           liquidity=liquidity, threshold=0.4) for _ in range(2)]
+    for model, solver in zip(models, (AllocationSolver.TOP_K, AllocationSolver.PULP)):
+        model.elicit(ElicitationStrategy.VCG, solver=solver, outcome_draws=np.zeros(6))
+    np.testing.assert_array_equal(models[0].allocation, models[1].allocation)
+    np.testing.assert_allclose(models[0].immediate_payments, models[1].immediate_payments,
+                               atol=1e-9)
+
+@pytest.mark.parametrize('liquidity', [1, 3, 6])
+def test_leave_one_out_payments_match_re_solving(liquidity):
+    probs, reports, weights = random_inputs(np.random.default_rng(liquidity), 5, 6)
+    model = LendingModel(5, 6, true_probabilities=probs, reports=reports, weights=weights,
+                         liquidity=liquidity, threshold=0.4)
+    model.elicit(ElicitationStrategy.VCG, outcome_draws=np.zeros(6))
+    for i in range(5):
+        others_weights, others_reports = np.delete(weights, i), np.delete(reports, i, 0)
+        others_scores = others_weights.dot(others_reports)
+        alt_allocation = model._get_vcg_allocation(ignore_i=i)
+        np.testing.assert_allclose(model.immediate_payments[i],
+                                   others_scores.dot(alt_allocation) - others_scores.dot(model.allocation))
+
+def brute_force_allocation(scores, liquidity, threshold, sizes, capital, sectors, sector_caps):
+    '''best feasible allocation by enumeration, reserves fill the rest of the liquidity'''
+    best, best_value = None, -np.inf
+    for allocation in itertools.product([0, 1], repeat=len(scores)):
+        allocation = np.array(allocation)
+        feasible = allocation.sum() <= liquidity and sizes.dot(allocation) <= capital and \
+            all(allocation[sectors == g].sum() <= cap for g, cap in enumerate(sector_caps))
+        value = scores.dot(allocation) + threshold * (liquidity - allocation.sum())
+        if feasible and value > best_value:
+            best, best_value = allocation, value
+    return best
+
+
+def test_vcg_program_matches_brute_force():
+    pytest.importorskip('pulp')
+    constraints = dict(sizes=np.array([1.0, 2.0, 1.5, 1.0]), capital=3.0,
+                       sectors=np.array([0, 0, 1, 1]), sector_caps=[1, 2])
+    probs, reports, weights = random_inputs(np.random.default_rng(0), 3, 4)
+    program = VCGProgram(4, 3, 0.3, **constraints)
+    for _ in range(2):
+        model = LendingModel(3, 4, true_probabilities=probs, reports=reports, weights=weights,
+                             threshold=0.3, liquidity=3)
+        model.elicit(ElicitationStrategy.VCG, program=program, max_workers=2,
+                     outcome_draws=np.zeros(4))
+        np.testing.assert_array_equal(model.allocation, brute_force_allocation(
+            weights.dot(reports), 3, 0.3, **constraints))
+        for i in range(3):
+            others_scores = np.delete(weights, i).dot(np.delete(reports, i, 0))
+            alt_allocation = brute_force_allocation(others_scores, 3, 0.3, **constraints)
+            np.testing.assert_allclose(model.immediate_payments[i],
+                                       others_scores.dot(alt_allocation - model.allocation), atol=1e-9)
+    # the worker programs outlive each elicitation
+    workers = program.copies(2)
+    assert all(a is b for a, b in zip(workers, program.copies(2)))
+
+
+def test_elicit_rejects_a_program_for_another_model():
+    pytest.importorskip('pulp')
+    model = LendingModel(3, 4, threshold=0.3, liquidity=3)
+    for program in (VCGProgram(5, 3, 0.3), VCGProgram(4, 2, 0.3), VCGProgram(4, 3, 0.5)):
+        with pytest.raises(AssertionError):
+            model.elicit(ElicitationStrategy.VCG, program=program)
+
+def test_expected_payments_average_both_outcomes():
+    probs, reports, weights = random_inputs(np.random.default_rng(0), 4, 8)
+    models = [LendingModel(4, 8, true_probabilities=probs, reports=reports, weights=weights)
+              for _ in range(3)]
+    models[0].elicit(ElicitationStrategy.WINKLER, expected=True)
+    # every allocated borrower repays, then none does
+    models[1].elicit(ElicitationStrategy.WINKLER, outcome_draws=np.full(8, 1 - 1e-12))
+    models[2].elicit(ElicitationStrategy.WINKLER, outcome_draws=np.zeros(8))
+    repaid, not_repaid = models[1].outcome_payments, models[2].outcome_payments
+    allocated_probs = np.where(models[0].allocation, probs, 0)
+    np.testing.assert_allclose(models[0].outcome_payments,
+                               allocated_probs * repaid + (1 - allocated_probs) * not_repaid)
+    np.testing.assert_allclose(models[0].outcome_payments_variance,
+                               allocated_probs * (1 - allocated_probs) * (repaid - not_repaid) ** 2)
+
+@pytest.mark.parametrize('expected', [False, True])
+def test_workspace_matches_dense_winkler(expected):
+    rng = np.random.default_rng(0)
+    probs, reports, weights = random_inputs(rng, 4, 8)
+    draws = None if expected else rng.random(8)
+    workspace = WinklerWorkspace(4, block_size=3)
+    models = [LendingModel(4, 8, true_probabilities=probs, reports=reports, weights=weights,
+                           workspace=shared) for shared in (None, workspace, workspace)]
+    for model in models:
+        model.elicit(ElicitationStrategy.WINKLER, expected=expected, outcome_draws=draws)
+    for model in models[1:]:
+        np.testing.assert_allclose(model.outcome_payments, models[0].outcome_payments)
+        if expected:
+            np.testing.assert_allclose(model.outcome_payments_variance,
+                                       models[0].outcome_payments_variance)
+    if not expected:
+        np.testing.assert_allclose(workspace.recommender_totals(reports, weights, models[0].beliefs,
+                                                                0.5, models[0].outcomes),
+                                   np.sum(models[0].outcome_payments, axis=1))
+
+
+@pytest.mark.parametrize('expected', [False, True])
+def test_fully_reported_sparse_matches_dense(expected):
+    rng = np.random.default_rng(0)
+    probs, reports, weights = random_inputs(rng, 4, 8)
+    draws = None if expected else rng.random(8)
+    dense = LendingModel(4, 8, true_probabilities=probs, reports=reports, weights=weights)
+    sparse_model = LendingModel(4, 8, true_probabilities=probs, reports=sparse.csr_matrix(reports),
+                                weights=weights)
+    for model in (dense, sparse_model):
+        model.elicit(ElicitationStrategy.WINKLER, expected=expected, outcome_draws=draws)
+    np.testing.assert_array_equal(sparse_model.allocation, dense.allocation)
+    np.testing.assert_allclose(sparse_model.outcome_payments.toarray(), dense.outcome_payments)
+    if expected:
+        np.testing.assert_allclose(sparse_model.outcome_payments_variance.toarray(),
+                                   dense.outcome_payments_variance)
+
+
+def test_missing_sparse_reports_abstain():
+    weights = np.array([0.5, 0.3, 0.2])
+    reports = np.array([[0.9, 0.0, 0.0, 0.2],
+                        [0.7, 0.8, 0.0, 0.0],
+                        [0.0, 0.4, 0.0, 0.3]])
+    model = LendingModel(3, 4, true_probabilities=np.full(4, 0.5),
+                         reports=sparse.csr_matrix(reports), weights=weights)
+    model.elicit(ElicitationStrategy.WINKLER, outcome_draws=np.zeros(4))
+    # weights renormalized over each borrower's reporters; nobody reported on borrower 2
+    expected_beliefs = [(0.5 * 0.9 + 0.3 * 0.7) / 0.8, (0.3 * 0.8 + 0.2 * 0.4) / 0.5, 0,
+                        (0.5 * 0.2 + 0.2 * 0.3) / 0.7]
+    np.testing.assert_allclose(sparse_aggregate(weights, sparse.csr_matrix(reports))[0], expected_beliefs)
+    np.testing.assert_array_equal(model.allocation, [1, 1, 0, 0])
+    # a dense model reads the same gaps as reports of 0, so borrower 1 misses out
+    dense = LendingModel(3, 4, true_probabilities=np.full(4, 0.5), reports=reports, weights=weights)
+    dense.elicit(ElicitationStrategy.WINKLER, outcome_draws=np.zeros(4))
+    np.testing.assert_array_equal(dense.allocation, [1, 0, 0, 0])
+    # payments are only owed on reported entries
+    assert set(zip(*model.outcome_payments.nonzero())) <= set(zip(*reports.nonzero()))
+
+@pytest.mark.parametrize('expected', [False, True])
+def test_report_updates_match_a_full_elicitation(expected):
+    rng = np.random.default_rng(0)
+    probs, reports, weights = random_inputs(rng, 4, 8)
+    draws = None if expected else rng.random(8)
+    model = LendingModel(4, 8, true_probabilities=probs, reports=reports, weights=weights)
+    model.elicit(ElicitationStrategy.WINKLER, expected=expected, outcome_draws=draws)
+    revised = reports.copy()
+    for i, q, value in [(0, 1, 0.95), (1, 3, 0.01), (3, 1, 0.02)]:
+        model.update_report(i, q, value)
+        revised[i, q] = value
+    revised[2] = np.clip(probs[::-1], LendingModel.EPSILON, 1)
+    model.update_recommender(2, revised[2])
+    rebuilt = LendingModel(4, 8, true_probabilities=probs, reports=revised, weights=weights)
+    rebuilt.elicit(ElicitationStrategy.WINKLER, expected=expected, outcome_draws=draws)
+    np.testing.assert_allclose(model.beliefs, rebuilt.beliefs)
+    np.testing.assert_array_equal(model.allocation, rebuilt.allocation)
+    np.testing.assert_array_equal(model.outcomes, rebuilt.outcomes)
+    np.testing.assert_allclose(model.outcome_payments, rebuilt.outcome_payments, atol=1e-12)
+    if expected:
+        np.testing.assert_allclose(model.outcome_payments_variance,
+                                   rebuilt.outcome_payments_variance, atol=1e-12)
+
+
+def test_report_updates_leave_unvalidated_inputs_alone():
+    probs, reports, weights = random_inputs(np.random.default_rng(0), 4, 8)
+    saved = reports.copy()
+    model = LendingModel(4, 8, true_probabilities=probs, reports=reports, weights=weights,
+                         validate=False)
+    model.elicit(ElicitationStrategy.WINKLER)
+    model.update_report(0, 1, 0.95)
+    model.update_recommender(2, np.full(8, 0.5))
+    np.testing.assert_array_equal(reports, saved)
+    assert model.reports[0, 1] == 0.95
+
+def test_greedy_stream_funds_what_an_offline_lender_would():
+    probs, reports, weights = random_inputs(np.random.default_rng(0), 4, 12)
+    offline = LendingModel(4, 12, true_probabilities=probs, reports=reports, weights=weights)
+    offline.elicit(ElicitationStrategy.WINKLER)
+    online = OnlineLendingModel(4, 12, weights=weights)
+    allocation = np.concatenate([online.arrive(reports[:, batch], probs[batch])
+                                 for batch in np.array_split(np.arange(12), 4)])
+    # with liquidity for everyone, funding in arrival order is the offline allocation
+    np.testing.assert_array_equal(allocation, offline.allocation)
+    assert online.remaining_liquidity == 12 - np.sum(allocation)
+    tight = OnlineLendingModel(4, 2, weights=weights)
+    allocation = tight.arrive(reports, probs)
+    np.testing.assert_array_equal(np.flatnonzero(allocation),
+                                  np.flatnonzero(offline.allocation)[:2])
+
+
+def test_secretary_stream_skips_the_observed_prefix():
+    rng = np.random.default_rng(0)
+    online = OnlineLendingModel(3, 2, policy=OnlinePolicy.SECRETARY, horizon=20, observe_fraction=.3,
+                                rng=rng)
+    allocation = np.concatenate([online.arrive(rng.random((3, 4)), np.ones(4)) for _ in range(5)])
+    assert not allocation[:6].any()
+    assert np.sum(allocation) <= 2
+
+
+def test_secretary_stream_pays_against_its_cutoff():
+    weights = np.array([.5, .5])
+    online = OnlineLendingModel(2, 1, weights=weights, policy=OnlinePolicy.SECRETARY, horizon=2,
+                                observe_fraction=.5)
+    online.arrive([.8, .8], 1.)
+    assert online.cutoff == .8
+    reports = np.array([[.9], [.75]])
+    assert online.arrive(reports, 1.)[0] == 1
+    # a certain repayment, scored as an offline lender with the cutoff as threshold would
+    offline = LendingModel(2, 1, true_probabilities=[1.], reports=reports, threshold=.8, weights=weights)
+    offline.elicit(ElicitationStrategy.WINKLER, outcome_draws=np.full(1, .5))
+    np.testing.assert_allclose(online.outcome_payments, offline.outcome_payments[:, 0])
+    at_threshold = LendingModel(2, 1, true_probabilities=[1.], reports=reports, weights=weights)
+    at_threshold.elicit(ElicitationStrategy.WINKLER, outcome_draws=np.full(1, .5))
+    assert (online.outcome_payments < at_threshold.outcome_payments[:, 0]).all()
+
+def test_reset_leaves_unvalidated_inputs_alone():
+    p = np.array([0.2, 0.5, 0.9])
+    beliefs = np.tile(p, (4, 1))
+    reports = np.full((4, 3), 0.5)
+    saved = p.copy(), beliefs.copy(), reports.copy()
+    model = LendingModel(4, 3, true_probabilities=p, true_beliefs=beliefs,
+                         reports=reports, validate=False)
+    model.reset(true_probabilities=np.array([0.1, 0.3, 0.7]))
+    model.reseed(0)
+    for original, before in zip((p, beliefs, reports), saved):
+        np.testing.assert_array_equal(original, before)
+    np.testing.assert_array_equal(model.reports, model.true_beliefs)
+
+
+def test_belief_noise_leaves_unvalidated_inputs_alone():
+    beliefs = np.tile(np.array([0.2, 0.5, 0.9]), (4, 1))
+    reports = np.full((4, 3), 0.5)
+    saved = beliefs.copy(), reports.copy()
+    model = LendingModel(4, 3, true_beliefs=beliefs, reports=reports, validate=False, rng=0)
+    model.add_beliefs_noise(BeliefNoise.GAUSSIAN)
+    assert not np.array_equal(model.true_beliefs, beliefs)
+    for original, before in zip((beliefs, reports), saved):
+        np.testing.assert_array_equal(original, before)
+
+
+def test_zero_weight_recommenders_score_nothing():
+    # recommender 0 has no weight; the belief in borrower 1 sits exactly at the threshold
+    reports = np.array([[1., 1., .9], [.9, .5, .6], [.7, .5, .2]])
+    weights = np.array([0., .5, .5])
+    outcomes = np.ones(3, dtype=int)
+    with np.errstate(all='raise'):
+        models = [LendingModel(3, 3, true_probabilities=np.ones(3), reports=reports, weights=weights,
+                               workspace=workspace) for workspace in (None, WinklerWorkspace(3, block_size=2))]
+        models.append(LendingModel(3, 3, true_probabilities=np.ones(3), reports=sparse.csr_matrix(reports),
+                                   weights=weights))
+        for model in models:
+            model.elicit(ElicitationStrategy.WINKLER, outcome_draws=np.full(3, .5))
+            assert np.isfinite(model.outcome_payments.toarray() if model.SPARSE else model.outcome_payments).all()
+        np.testing.assert_array_equal(models[0].allocation, [1, 0, 0])
+        for model in models:
+            payments = model.outcome_payments.toarray() if model.SPARSE else model.outcome_payments
+            np.testing.assert_array_equal(payments[0], 0)
+            np.testing.assert_allclose(payments, models[0].outcome_payments)
+        np.testing.assert_array_equal(models[1].workspace.recommender_totals(reports, weights, models[0].beliefs,
+                                                                             .5, outcomes)[0], 0)
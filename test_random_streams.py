@@ -0,0 +1,29 @@
+# test_random_streams.py
+
+import numpy as np
+from random_streams import StreamBatch, VariatePool, get_rng, stream
+
+
+def test_variate_pool_accepts_numpy_integer_sizes():
+    with VariatePool(0) as pool:
+        assert pool.random(np.int64(3)).shape == (3, )
+        assert pool.normal(size=(np.int64(2), 3)).shape == (2, 3)
+        assert pool.random(np.array([2, 2])).shape == (2, 2)
+    with VariatePool(0) as a, VariatePool(0) as b:
+        np.testing.assert_array_equal(a.random(np.int32(5)), b.random(5))
+
+
+def test_stream_batch_rows_match_each_stream():
+    batch = StreamBatch(stream(k, 0) for k in range(3))
+    assert get_rng(batch) is batch
+    draws = [batch.random((3, 2)), batch.beta(2, 3, size=(3, 4, 2)), batch.random(3)]
+    for k in range(3):
+        alone = stream(k, 0)
+        np.testing.assert_array_equal(draws[0][k], alone.random(2))
+        np.testing.assert_array_equal(draws[1][k], alone.beta(2, 3, size=(4, 2)))
+        assert draws[2][k] == alone.random()
+    with StreamBatch(VariatePool(stream(k, 0), 8) for k in range(2)) as pools:
+        pooled = pools.normal(size=(2, 5))
+    for k in range(2):
+        with VariatePool(stream(k, 0), 8) as alone:
+            np.testing.assert_array_equal(pooled[k], alone.normal(size=5))